@@ -0,0 +1,192 @@
+# admission.py - 准入控制与降级
+"""
+过载保护：请求级准入（快速503）、阶段级并发上限、按实时延迟的降级阶梯
+
+- LoadShedder：在途请求数或翻译队列积压超过上限时直接拒绝，附带 Retry-After
+- StageLimiter：限制同时进入某阶段（翻译、编码）的线程数，拿不到许可时由调用方走降级路径
+- DegradationController：根据最近的请求延迟逐级降级 / 恢复
+    0 normal          正常
+    1 no_translation  跳过翻译（只用翻译记忆）
+    2 no_semantic     再跳过语义检索
+    3 keyword_only    只走 search_in_questions 关键词路径
+- 当前请求的降级级别放在 contextvar 中，检索和翻译函数通过 degradation_level() 读取
+- Deadline：请求的总截止时间，沿RAG流水线逐层传递，各阶段只使用剩余预算
+"""
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Sequence
+
+from metrics import percentile
+
+LEVEL_NAMES = ('normal', 'no_translation', 'no_semantic', 'keyword_only')
+SKIP_TRANSLATION = 1
+SKIP_SEMANTIC = 2
+KEYWORD_ONLY = 3
+
+_current_level = contextvars.ContextVar('rag_degradation_level', default=0)
+
+
+def degradation_level() -> int:
+    """当前请求的降级级别（请求之外为0）"""
+    return _current_level.get()
+
+
+def set_degradation_level(level: int):
+    """设置当前请求的降级级别，返回 token（交给 reset_degradation_level）"""
+    return _current_level.set(level)
+
+
+def reset_degradation_level(token):
+    _current_level.reset(token)
+
+
+class Deadline:
+    """请求截止时间（单调时钟）"""
+
+    def __init__(self, seconds: float):
+        self.seconds = max(0.0, seconds)
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def budget(self, cap: float) -> float:
+        """本阶段可用的时间：剩余时间与阶段上限取小"""
+        return min(cap, self.remaining())
+
+
+def remaining_budget(deadline: Optional[Deadline], cap: float) -> float:
+    """没有截止时间时返回阶段上限"""
+    return cap if deadline is None else deadline.budget(cap)
+
+
+def deadline_expired(deadline: Optional[Deadline]) -> bool:
+    return deadline is not None and deadline.expired()
+
+
+class LoadShedder:
+    """按在途请求数和队列积压做准入控制"""
+
+    def __init__(self, max_in_flight: int = 32, max_queue_depth: int = 200,
+                 queue_depth: Optional[Callable[[], int]] = None):
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.queue_depth = queue_depth or (lambda: 0)
+        self.in_flight = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> Optional[str]:
+        """准入成功返回 None，否则返回拒绝原因（in_flight / queue_depth）"""
+        if self.queue_depth() > self.max_queue_depth:
+            reason = 'queue_depth'
+        else:
+            with self.lock:
+                if self.in_flight < self.max_in_flight:
+                    self.in_flight += 1
+                    return None
+            reason = 'in_flight'
+        with self.lock:
+            self.shed += 1
+        return reason
+
+    def release(self):
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+
+class StageLimiter:
+    """阶段并发上限（非阻塞或限时获取）"""
+
+    def __init__(self, name: str, max_concurrent: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.semaphore = threading.BoundedSemaphore(max_concurrent)
+        self.active = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout: float = 0.0) -> bool:
+        if self.semaphore.acquire(timeout=timeout) if timeout > 0 else self.semaphore.acquire(blocking=False):
+            with self.lock:
+                self.active += 1
+            return True
+        with self.lock:
+            self.rejected += 1
+        return False
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+        self.semaphore.release()
+
+
+class DegradationController:
+    """
+    根据最近请求延迟的p95调整降级级别
+
+    只用进入当前级别之后的样本做判断：超过 thresholds[level] 升一级（间隔至少 step_interval 秒）；
+    低于 thresholds[level-1] * recover_ratio 并保持 recover_interval 秒后降一级，试探上游是否恢复。
+    """
+
+    def __init__(self, thresholds: Sequence[float] = (2.0, 4.0, 8.0), window: int = 50,
+                 min_samples: int = 5, step_interval: float = 5.0, recover_interval: float = 30.0,
+                 recover_ratio: float = 0.5):
+        self.thresholds = tuple(thresholds)
+        self.max_level = len(self.thresholds)
+        self.min_samples = min_samples
+        self.step_interval = step_interval
+        self.recover_interval = recover_interval
+        self.recover_ratio = recover_ratio
+        self.samples = deque(maxlen=window)
+        self.current = 0
+        self.changed_at = time.time()
+        self.transitions = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float, level: int):
+        """记录一个请求的延迟（只保留与当前级别相同的样本）"""
+        with self.lock:
+            if level != self.current:
+                return
+            self.samples.append(seconds)
+            self._evaluate(time.time())
+
+    def level(self) -> int:
+        with self.lock:
+            self._evaluate(time.time())
+            return self.current
+
+    def _evaluate(self, now: float):
+        elapsed = now - self.changed_at
+        p95 = percentile(list(self.samples), 95) if len(self.samples) >= self.min_samples else None
+        if (p95 is not None and self.current < self.max_level
+                and p95 > self.thresholds[self.current] and elapsed >= self.step_interval):
+            self._move(self.current + 1, now)
+        elif self.current > 0 and elapsed >= self.recover_interval and (
+                p95 is None or p95 < self.thresholds[self.current - 1] * self.recover_ratio):
+            self._move(self.current - 1, now)
+
+    def _move(self, level: int, now: float):
+        print(f"⚠️  降级级别 {self.current} -> {level} ({LEVEL_NAMES[level]})")
+        self.current = level
+        self.changed_at = now
+        self.samples.clear()
+        self.transitions += 1
+
+    def retry_after(self) -> int:
+        """建议的重试等待秒数（最近延迟的中位数，至少1秒）"""
+        with self.lock:
+            samples = list(self.samples)
+        return max(1, math.ceil(percentile(samples, 50))) if samples else 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'level': self.current, 'name': LEVEL_NAMES[self.current],
+                    'samples': len(self.samples), 'transitions': self.transitions}
@@ -0,0 +1,71 @@
+# api_client.py - Streamlit前端（app.py）访问后端API的客户端
+"""
+- ApiClient：一个 requests.Session（keep-alive 连接池），GET 请求遇到连接错误/5xx 时短暂重试
+- get_client：st.cache_resource，同一后端地址在所有会话和每次 rerun 之间共用一个客户端
+- fetch_status / fetch_stats / fetch_sample：st.cache_data 按TTL缓存，
+  Streamlit每次控件交互都会重新运行脚本，缓存期内不再请求后端（失败不缓存，下次rerun重试）
+"""
+from typing import Dict, Optional
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+STATUS_TTL = 15  # 侧边栏系统状态的缓存时间（秒）
+STATS_TTL = 300  # 数据统计和样本的缓存时间（秒）
+
+
+class ApiClient:
+    def __init__(self, base_url: str, timeout: float = 30.0, pool_size: int = 4):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, path: str, timeout: Optional[float] = None) -> Dict:
+        response = self.session.get(self.base_url + path, timeout=timeout or 5.0)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path: str, payload: Dict, timeout: Optional[float] = None) -> Dict:
+        response = self.session.post(self.base_url + path, json=payload, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def status(self) -> Dict:
+        return self.get('/api/status')
+
+    def stats(self) -> Dict:
+        return self.get('/api/stats')
+
+    def sample(self) -> Dict:
+        return self.get('/api/sample')
+
+    def query(self, question: str, answer_language: str = 'zh', **options) -> Dict:
+        """结构化结果（format=json）；options 透传 use_rag、filters、deadline_ms 等"""
+        return self.post('/api/query', dict(options, question=question, answer_language=answer_language,
+                                            format='json'))
+
+
+@st.cache_resource(show_spinner=False)
+def get_client(base_url: str) -> ApiClient:
+    return ApiClient(base_url)
+
+
+@st.cache_data(ttl=STATUS_TTL, show_spinner=False)
+def fetch_status(base_url: str) -> Dict:
+    return get_client(base_url).status()
+
+
+@st.cache_data(ttl=STATS_TTL, show_spinner=False)
+def fetch_stats(base_url: str) -> Dict:
+    return get_client(base_url).stats()
+
+
+@st.cache_data(ttl=STATS_TTL, show_spinner=False)
+def fetch_sample(base_url: str) -> Dict:
+    return get_client(base_url).sample()
@@ -5,6 +5,7 @@ import json
 import pandas as pd
 from PIL import Image
 import base64
+from api_client import get_client, fetch_status, fetch_stats, fetch_sample
 
 # 页面配置
 st.set_page_config(
@@ -104,14 +105,12 @@ def sidebar():
         # 系统状态
         st.subheader("📊 系统状态")
         
-        # 连接到后端API获取状态
+        # 连接到后端API获取状态（按TTL缓存，控件交互引起的rerun不再请求后端）
         try:
-            response = requests.get(f"{st.session_state.api_base_url}/api/status")
-            if response.status_code == 200:
-                data = response.json()
-                st.metric("问题数量", f"{data.get('question_count', 0):,}")
-                st.metric("语料库文档", f"{data.get('doc_count', 0):,}")
-                st.metric("Milvus状态", "✅ 在线" if data.get('milvus_connected', False) else "❌ 离线")
+            data = fetch_status(st.session_state.api_base_url)
+            st.metric("问题数量", f"{data.get('question_count', 0):,}")
+            st.metric("语料库文档", f"{data.get('doc_count', 0):,}")
+            st.metric("向量索引", "✅ 就绪" if data.get('vector_store_ready', False) else "❌ 未就绪")
         except:
             st.warning("后端API连接失败")
         
@@ -196,33 +195,20 @@ def process_query(query):
     """处理查询请求"""
     with st.spinner("🔍 正在检索医疗知识库..."):
         try:
-            # 发送请求到后端API
-            payload = {
-                'question': query,
-                'language': st.session_state.language
-            }
+            # 发送请求到后端API（共用连接池）
+            result = get_client(st.session_state.api_base_url).query(query, st.session_state.language)
+            st.session_state.query_result = result
+            st.session_state.current_query = query
             
-            response = requests.post(
-                f"{st.session_state.api_base_url}/api/query",
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                st.session_state.query_result = result
-                st.session_state.current_query = query
-                
-                # 添加到历史
-                st.session_state.query_history.insert(0, {
-                    'query': query,
-                    'time': pd.Timestamp.now(),
-                    'result_count': result.get('result_count', 0)
-                })
-                
-            else:
-                st.error(f"查询失败: {response.status_code}")
+            # 添加到历史
+            st.session_state.query_history.insert(0, {
+                'query': query,
+                'time': pd.Timestamp.now(),
+                'result_count': result.get('result_count', 0)
+            })
                 
+        except requests.exceptions.HTTPError as e:
+            st.error(f"查询失败: {e.response.status_code}")
         except requests.exceptions.RequestException as e:
             st.error(f"网络错误: {str(e)}")
         except Exception as e:
@@ -233,7 +219,7 @@ def display_results():
     result = st.session_state.query_result
     
     if not result.get('success', False):
-        st.error("查询失败")
+        st.error(f"查询失败: {result.get('error', '')}")
         return
     
     # 显示查询信息
@@ -249,6 +235,13 @@ def display_results():
     confidence = result.get('confidence', 0) * 100
     st.progress(confidence / 100, text=f"置信度: {confidence:.1f}%")
     
+    # RAG结果：生成的回答 + 检索到的来源
+    if result.get('used_rag'):
+        st.markdown(result.get('answer', ''))
+        for i, source in enumerate(result.get('sources', []), 1):
+            with st.expander(f"📄 来源 #{i}（{source.get('type', '')}，置信度 {source.get('confidence', 0) * 100:.0f}%）"):
+                st.write(source.get('content', ''))
+    
     # 显示结果
     for i, item in enumerate(result.get('results', []), 1):
         with st.container():
@@ -269,7 +262,7 @@ def display_results():
                     st.caption(f"类型: {item.get('type', 'Medical')} | 来源: {item.get('source', 'Unknown')}")
                 
                 with col2:
-                    score = item.get('score', 0) * 100
+                    score = item.get('confidence', item.get('score', 0)) * 100
                     st.metric("相关度", f"{score:.0f}%")
             
             st.divider()
@@ -318,41 +311,37 @@ def data_page():
     
     with tab1:
         try:
-            response = requests.get(f"{st.session_state.api_base_url}/api/stats")
-            if response.status_code == 200:
-                stats = response.json()
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("总问题数", stats.get('total_questions', 0))
-                with col2:
-                    st.metric("语料库文档", stats.get('corpus_docs', 0))
-                with col3:
-                    st.metric("Milvus向量", stats.get('vector_count', 0))
-                
-                # 问题类型分布
-                if 'question_types' in stats:
-                    st.subheader("问题类型分布")
-                    type_data = pd.DataFrame(
-                        list(stats['question_types'].items()),
-                        columns=['类型', '数量']
-                    )
-                    st.bar_chart(type_data.set_index('类型'))
-            else:
-                st.error("获取统计数据失败")
+            stats = fetch_stats(st.session_state.api_base_url)
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("总问题数", stats.get('total_questions', 0))
+            with col2:
+                st.metric("语料库文档", stats.get('corpus_docs', 0))
+            with col3:
+                st.metric("向量数", stats.get('vector_count', 0))
+            
+            # 问题类型分布
+            if stats.get('question_types'):
+                st.subheader("问题类型分布")
+                type_data = pd.DataFrame(
+                    list(stats['question_types'].items()),
+                    columns=['类型', '数量']
+                )
+                st.bar_chart(type_data.set_index('类型'))
+        except requests.exceptions.HTTPError:
+            st.error("获取统计数据失败")
         except:
             st.error("无法连接到后端API")
     
     with tab2:
         if st.button("预览数据样本"):
             try:
-                response = requests.get(f"{st.session_state.api_base_url}/api/sample")
-                if response.status_code == 200:
-                    sample = response.json()
-                    df = pd.DataFrame(sample.get('data', []))
-                    st.dataframe(df)
-                else:
-                    st.error("获取数据样本失败")
+                sample = fetch_sample(st.session_state.api_base_url)
+                df = pd.DataFrame(sample.get('data', []))
+                st.dataframe(df)
+            except requests.exceptions.HTTPError:
+                st.error("获取数据样本失败")
             except:
                 st.error("无法连接到后端API")
     
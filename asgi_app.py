@@ -0,0 +1,362 @@
+# asgi_app.py - ASGI入口（异步查询流水线）
+"""
+异步版本的RAG查询流水线，通过ASGI提供与 flask_app 相同的接口：
+POST /api/query、GET /api/data-stats、GET /api/rag-status
+
+- 等待不占线程：翻译是可等待的I/O（后端调用在线程池中执行，协程只await结果，不轮询），
+  并发上限由 asyncio.Semaphore 控制，超出的请求在事件循环里排队
+- CPU密集的编码、faiss检索、关键词打分放到线程池执行
+- 数据、索引、翻译记忆、降级控制、指标和请求日志与 flask_app 共用
+
+运行（需要 uvicorn）：
+    uvicorn asgi_app:app --port 5001
+"""
+import asyncio
+import contextvars
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import flask_app as fa
+from admission import (Deadline, LoadShedder, SKIP_SEMANTIC, SKIP_TRANSLATION, KEYWORD_ONLY,
+                       degradation_level, set_degradation_level, reset_degradation_level,
+                       remaining_budget, deadline_expired)
+from metrics import stage_timer, record_stage, enter_request_scope, exit_request_scope, count_request_event
+from partitions import parse_filters, set_filters, reset_filters
+from request_log import result_id
+
+cpu_executor = ThreadPoolExecutor(max_workers=fa.RAG_CONFIG['async_cpu_workers'],
+                                  thread_name_prefix='async-cpu')
+translation_executor = ThreadPoolExecutor(max_workers=fa.RAG_CONFIG['async_translation_workers'],
+                                          thread_name_prefix='async-translate')
+async_shedder = LoadShedder(fa.RAG_CONFIG['async_max_in_flight'], max_queue_depth=0)
+_translation_slots = None
+
+
+async def run_blocking(executor, func, *args, **kwargs):
+    """在线程池中运行阻塞函数，保留当前上下文（降级级别、请求范围）"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, lambda: context.run(func, *args, **kwargs))
+
+
+# ========== 翻译 ==========
+def translation_slots() -> asyncio.Semaphore:
+    global _translation_slots
+    if _translation_slots is None:
+        _translation_slots = asyncio.Semaphore(fa.RAG_CONFIG['async_translation_workers'])
+    return _translation_slots
+
+
+async def translate_batch_async(segments: List[str], direction: str,
+                                deadline: Optional[Deadline] = None) -> List[Optional[str]]:
+    """批量翻译：后端调用在翻译线程池中执行，超时或失败的句子返回None"""
+    skipped = [None] * len(segments)
+    if degradation_level() >= SKIP_TRANSLATION or deadline_expired(deadline):
+        count_request_event('translation_skipped', len(segments))
+        return skipped
+
+    slots = translation_slots()
+    try:
+        await asyncio.wait_for(slots.acquire(), remaining_budget(deadline, fa.RAG_CONFIG['stage_wait']))
+    except asyncio.TimeoutError:
+        count_request_event('translation_skipped', len(segments))
+        return skipped
+
+    # 许可在后端调用真正结束时才释放，等待方超时不会让更多调用堆进线程池
+    future = asyncio.ensure_future(
+        run_blocking(translation_executor, fa.translation_queue.backend.translate_batch, segments, direction)
+    )
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        with stage_timer('translation'):
+            return await asyncio.wait_for(
+                asyncio.shield(future), remaining_budget(deadline, fa.RAG_CONFIG['translation_timeout'])
+            )
+    except asyncio.TimeoutError:
+        fa.TRANSLATION_TIMEOUTS.inc(kind='async')
+        count_request_event('translation_skipped', len(segments))
+        return skipped
+    except Exception as e:
+        print(f"异步翻译失败: {e}")
+        return skipped
+
+
+async def translate_async(text: str, answer_language: str, deadline: Optional[Deadline] = None) -> str:
+    """translate_with_memory 的异步版本：按句查翻译记忆，未命中的句子一次送去翻译"""
+    if not text or not isinstance(text, str):
+        return text or ""
+    direction = 'zh_to_en' if answer_language == 'en' else 'en_to_zh'
+    plan = fa.translation_memory.lookup(text, direction)
+    if plan is None:
+        return text
+    pending = plan[2]
+    results = await translate_batch_async(pending, direction, deadline) if pending else []
+    return fa.translation_memory.complete(plan, direction, results)
+
+
+# ========== 检索与生成 ==========
+async def search_in_questions_async(query: str, questions_data: Dict, answer_language: str = 'zh',
+                                    top_k: int = 5, deadline: Optional[Deadline] = None) -> List[Dict]:
+    """问题库检索：打分在线程池中执行，top_k 个结果的问题和答案并发翻译"""
+    start = time.perf_counter()
+    ranked = await run_blocking(cpu_executor, fa.rank_questions, query, questions_data, top_k)
+
+    async def build(confidence, q):
+        display_question, display_answer = await asyncio.gather(
+            translate_async(q.get('raw_question', ''), answer_language, deadline),
+            translate_async(q.get('raw_answer', ''), answer_language, deadline),
+        )
+        return fa.format_question_result(q, confidence, answer_language, display_question, display_answer)
+
+    results = await asyncio.gather(*(build(confidence, q) for confidence, q in ranked))
+    record_stage('question_search', time.perf_counter() - start)
+    return list(results)
+
+
+async def lexical_retrieval_async(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                                  deadline: Optional[Deadline] = None) -> List[Dict]:
+    """关键词搜索语料库 + 问题库检索（并发执行）"""
+    tasks = []
+    if corpus_data and 'paragraphs' in corpus_data and not deadline_expired(deadline):
+        paragraphs = fa.corpus_paragraphs(corpus_data)
+        tasks.append(run_blocking(cpu_executor, fa.keyword_search, query, paragraphs, top_k))
+    if (fa.RAG_CONFIG['hybrid_search'] and questions_data and 'all_questions' in questions_data
+            and not deadline_expired(deadline)):
+        tasks.append(_question_contexts(query, questions_data, top_k, deadline))
+    groups = await asyncio.gather(*tasks)
+    return [result for group in groups for result in group]
+
+
+async def _question_contexts(query, questions_data, top_k, deadline):
+    search_results = await search_in_questions_async(query, questions_data, 'zh', top_k, deadline)
+    return fa.question_results_to_contexts(search_results)
+
+
+async def hybrid_retrieval_async(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                                 deadline: Optional[Deadline] = None) -> List[Dict]:
+    """混合检索：语义检索（线程池）与关键词/问题库检索并发执行"""
+    if fa.shard_coordinator is not None:
+        groups = await asyncio.gather(
+            run_blocking(cpu_executor, fa.sharded_corpus_retrieval, [query], top_k, deadline),
+            _question_contexts(query, questions_data, top_k, deadline) if (
+                fa.RAG_CONFIG['hybrid_search'] and questions_data and 'all_questions' in questions_data
+            ) else asyncio.sleep(0, []),
+        )
+        return fa.merge_retrieval_results(groups[0][0] + groups[1], top_k)
+    tasks = []
+    if (degradation_level() < SKIP_SEMANTIC and not deadline_expired(deadline)
+            and fa.vector_store['corpus_embeddings'] is not None):
+        tasks.append(run_blocking(
+            cpu_executor, fa.semantic_search, query,
+            fa.vector_store['corpus_embeddings'], fa.vector_store['corpus_chunks'], top_k
+        ))
+    tasks.append(lexical_retrieval_async(query, corpus_data, questions_data, top_k, deadline))
+    groups = await asyncio.gather(*tasks)
+    return fa.merge_retrieval_results([result for group in groups for result in group], top_k)
+
+
+async def generate_answer_async(query: str, retrieved_contexts: List[Dict], answer_language: str = 'zh',
+                                deadline: Optional[Deadline] = None) -> Dict:
+    """generate_answer_from_context 的异步版本"""
+    result = fa.extract_answer_from_context(query, retrieved_contexts, answer_language)
+    if not result['sources']:
+        return result
+    answer = result['answer']
+    if answer_language in ('zh', 'en'):
+        answer = await translate_async(answer, answer_language, deadline)
+    result['answer'] = fa.with_disclaimer(answer, answer_language)
+    return result
+
+
+async def rag_query_async(query: str, corpus_data: Dict, questions_data: Dict, answer_language: str = 'zh',
+                          deadline: Optional[Deadline] = None) -> Dict:
+    """rag_query 的异步版本，返回结构相同"""
+    start_time = time.perf_counter()
+    top_k = fa.RAG_CONFIG['top_k_retrieval']
+    candidates = await hybrid_retrieval_async(
+        query, corpus_data, questions_data, top_k=fa.first_stage_k(top_k), deadline=deadline
+    )
+    first_stage_time = time.perf_counter() - start_time
+    if fa.RAG_CONFIG['rerank'] != 'none':
+        retrieved_contexts, cascade_report = await run_blocking(
+            cpu_executor, fa.rerank_candidates, query, candidates, top_k, deadline
+        )
+    else:
+        retrieved_contexts, cascade_report = fa.rerank_candidates(query, candidates, top_k, deadline)
+    cascade_report['first_stage_ms'] = round(first_stage_time * 1000, 3)
+    retrieval_time = time.perf_counter() - start_time
+
+    generation_start = time.perf_counter()
+    result = await generate_answer_async(query, retrieved_contexts, answer_language, deadline)
+    generation_time = time.perf_counter() - generation_start
+
+    total_time = time.perf_counter() - start_time
+    return fa.build_rag_result(retrieved_contexts, result, retrieval_time, generation_time, total_time, deadline,
+                               fa.cascade_timing(cascade_report))
+
+
+# ========== 接口 ==========
+async def handle_query(data: Dict):
+    """POST /api/query，返回 (状态码, 响应, 额外响应头)"""
+    reason = async_shedder.try_acquire()
+    if reason is not None:
+        fa.SHED_REQUESTS.inc(reason=reason)
+        return 503, {'success': False, 'error': '服务繁忙，请稍后重试', 'reason': reason}, \
+            [(b'retry-after', str(fa.degradation.retry_after()).encode())]
+
+    start_time = time.perf_counter()
+    level = fa.degradation.level() if fa.RAG_CONFIG['degradation_enabled'] else 0
+    level_token = set_degradation_level(level)
+    filters_token = set_filters(None)  # _query_payload 设置本请求的过滤条件
+    scope, scope_token = enter_request_scope()
+    record = {'endpoint': 'query', 'success': False}
+    try:
+        payload = await _query_payload(data, level, record)
+    except Exception as e:
+        print(f"查询处理错误: {e}")
+        payload = {'success': False, 'error': f'服务器错误: {str(e)}'}
+    finally:
+        exit_request_scope(scope_token)
+        reset_filters(filters_token)
+        reset_degradation_level(level_token)
+        async_shedder.release()
+
+    elapsed = time.perf_counter() - start_time
+    fa.degradation.observe(elapsed, level)
+    if fa.request_logger is not None:
+        record.update({
+            'status': 200,
+            'total_ms': round(elapsed * 1000, 3),
+            'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in scope.stages.items()},
+            'cache': dict(scope.events),
+            'degradation_level': level,
+            'server': 'asgi',
+        })
+        fa.request_logger.log(record)
+    return 200, payload, [(b'x-degradation-level', str(level).encode())]
+
+
+async def _query_payload(data: Dict, level: int, record: Dict) -> Dict:
+    question = str(data.get('question', '')).strip()
+    answer_language = data.get('answer_language', 'zh')
+    use_rag = data.get('use_rag', True)
+    response_format = data.get('format', 'html')
+    deadline = fa.request_deadline(data)
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}
+    set_filters(filters)
+    record.update({'question': question, 'answer_language': answer_language,
+                   'use_rag': use_rag, 'format': response_format, 'filters': filters})
+
+    if not question:
+        return {'success': False, 'error': '请输入问题'}
+
+    _, _, corpus_data, questions_data = fa.get_data_counts()
+    if not corpus_data or not questions_data:
+        return {'success': False, 'error': '无法加载数据，请检查数据文件'}
+
+    if use_rag and fa.HAS_EMBEDDING and level < KEYWORD_ONLY:
+        fa.REQUESTS_TOTAL.inc(endpoint='query', mode='rag')
+        rag_result = await rag_query_async(question, corpus_data, questions_data, answer_language, deadline)
+        record.update({'mode': 'rag', 'success': True, 'timing': rag_result['timing'],
+                       'result_ids': [result_id(doc) for doc in rag_result['source_documents']]})
+        return fa.build_rag_response(question, rag_result, answer_language, response_format, level)
+
+    fa.REQUESTS_TOTAL.inc(endpoint='query', mode='search')
+    search_results = await search_in_questions_async(question, questions_data, answer_language, 5, deadline)
+    record.update({'mode': 'search', 'success': True,
+                   'result_ids': [result_id(r) for r in search_results]})
+    return fa.build_search_response(question, search_results, answer_language, response_format, level, deadline)
+
+
+async def handle_data_stats(data: Dict):
+    return 200, {'success': True, 'data': fa.data_stats_payload()}, []
+
+
+async def handle_rag_status(data: Dict):
+    return 200, fa.rag_status_payload(), []
+
+
+def dashboard_handler(name: str):
+    """/api/status、/api/stats、/api/sample：返回 flask_app 预先计算的响应"""
+    async def handle(data: Dict):
+        return 200, fa.DASHBOARD[name], [(b'cache-control', f"max-age={fa.RAG_CONFIG['dashboard_max_age']}".encode())]
+    return handle
+
+
+ROUTES = {
+    ('POST', '/api/query'): handle_query,
+    ('GET', '/api/data-stats'): handle_data_stats,
+    ('GET', '/api/rag-status'): handle_rag_status,
+    ('GET', '/api/status'): dashboard_handler('status'),
+    ('GET', '/api/stats'): dashboard_handler('stats'),
+    ('GET', '/api/sample'): dashboard_handler('sample'),
+}
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def _send_json(send, status: int, payload: Dict, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                if fa.GLOBAL_CORPUS_DATA is None:  # 预加载的进程（如serve.py的worker）不重复加载
+                    await run_blocking(cpu_executor, fa.initialize_data_and_vectors)
+                await send({'type': 'lifespan.startup.complete'})
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+        elif message['type'] == 'lifespan.shutdown':
+            cpu_executor.shutdown(wait=False)
+            translation_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI应用"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        await _send_json(send, 404, {'success': False, 'error': '接口不存在'})
+        return
+
+    body = await _read_body(receive)
+    data = {}
+    if body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            await _send_json(send, 200, {'success': False, 'error': '请求体不是有效的JSON'})
+            return
+        if not isinstance(data, dict):
+            data = {}
+    status, payload, headers = await handler(data)
+    await _send_json(send, status, payload, headers)
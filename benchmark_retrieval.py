@@ -0,0 +1,263 @@
+# benchmark_retrieval.py - 离线检索基准测试
+"""
+用 medical_questions.json 中的问题回放检索流程，评估速度与质量
+
+对每个问题依次运行 hybrid_retrieval / cascade_retrieval（两阶段重排，RAG_RERANK）/ semantic_search / keyword_search /
+search_in_questions，统计 recall@k、MRR 以及 p50/p95/p99 延迟和QPS，
+并按问题类型（question_type）分组。结果写入JSON，便于不同版本对比。
+
+相关性判定：
+- 语料库chunk：问题的 evidence 句子中，实词覆盖率不低于阈值的chunk视为相关
+- 问题库结果：命中问题本身（同一id）视为相关
+
+用法：
+    python benchmark_retrieval.py --limit 200 --k 1 3 5 --output bench.json
+    python benchmark_retrieval.py --compare bench_old.json --output bench_new.json
+"""
+import argparse
+import json
+import math
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set
+
+from metrics import percentile
+
+STOPWORDS = {
+    'the', 'and', 'for', 'are', 'with', 'that', 'this', 'from', 'can', 'may',
+    'was', 'were', 'has', 'have', 'its', 'into', 'such', 'also', 'than', 'which',
+    'who', 'what', 'when', 'how', 'does', 'not', 'their', 'they', 'these', 'those',
+    'been', 'being', 'more', 'most', 'some', 'other', 'used', 'use', 'include',
+    'includes', 'including', 'common', 'associated',
+}
+
+STAGES = ['hybrid_retrieval', 'cascade_retrieval', 'semantic_search', 'keyword_search', 'search_in_questions']
+
+
+def content_tokens(text: str) -> Set[str]:
+    """提取实词（小写、长度>2、去停用词）"""
+    return {t for t in re.findall(r'[a-z0-9]+', text.lower()) if len(t) > 2 and t not in STOPWORDS}
+
+
+def latency_summary(latencies: List[float]) -> Dict:
+    """延迟统计（毫秒）和串行QPS"""
+    total = sum(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(total / len(latencies) * 1000, 3) if latencies else 0.0,
+        'qps': round(len(latencies) / total, 2) if total > 0 else 0.0,
+    }
+
+
+class EvidenceJudge:
+    """根据 evidence 句子判定相关chunk（倒排索引 + 实词覆盖率）"""
+
+    def __init__(self, chunks: List[Dict], coverage: float = 0.7):
+        self.coverage = coverage
+        self.postings = defaultdict(set)
+        for i, chunk in enumerate(chunks):
+            for token in content_tokens(chunk['text']):
+                self.postings[token].add(i)
+        self.chunk_ids = [chunk['id'] for chunk in chunks]
+
+    def relevant_chunks(self, evidence: str) -> Set[str]:
+        relevant = set()
+        for sentence in evidence.split(';'):
+            tokens = content_tokens(sentence)
+            if not tokens:
+                continue
+            required = max(1, math.ceil(len(tokens) * self.coverage))
+            counts = Counter()
+            for token in tokens:
+                counts.update(self.postings.get(token, ()))
+            relevant.update(self.chunk_ids[i] for i, c in counts.items() if c >= required)
+        return relevant
+
+
+def result_key(result: Dict) -> Optional[str]:
+    """检索结果的唯一标识：chunk id 或 问题id"""
+    metadata = result.get('metadata') if isinstance(result.get('metadata'), dict) else {}
+    chunk_id = metadata.get('id', '')
+    if isinstance(chunk_id, str) and chunk_id.startswith('chunk_'):
+        return chunk_id
+    question_id = result.get('question_id') or metadata.get('question_id')
+    if question_id:
+        return f"question:{question_id}"
+    return None
+
+
+def representative_ids(questions_data: Dict) -> Dict[str, str]:
+    """被合并的近似重复问题id -> 代表问题id（检索只返回代表，金标准也要映射到代表）"""
+    return {q.get('id', ''): q['duplicate_of'] for q in questions_data.get('all_questions', []) if q.get('duplicate_of')}
+
+
+def rank_metrics(keys: List[Optional[str]], gold: Set[str], ks: List[int]) -> Dict:
+    """recall@k 和 倒数排名"""
+    metrics = {}
+    for k in ks:
+        hits = {key for key in keys[:k] if key in gold}
+        metrics[f'recall@{k}'] = len(hits) / len(gold) if gold else 0.0
+    reciprocal_rank = 0.0
+    for rank, key in enumerate(keys, 1):
+        if key in gold:
+            reciprocal_rank = 1.0 / rank
+            break
+    metrics['mrr'] = reciprocal_rank
+    return metrics
+
+
+def aggregate(records: List[Dict], ks: List[int]) -> Dict:
+    """汇总一组查询记录（只统计有相关结果的查询的质量指标）"""
+    judged = [r for r in records if r['gold_size'] > 0]
+    summary = latency_summary([r['latency'] for r in records])
+    summary['judged_queries'] = len(judged)
+    for key in [f'recall@{k}' for k in ks] + ['mrr']:
+        summary[key] = round(sum(r[key] for r in judged) / len(judged), 4) if judged else None
+    return summary
+
+
+def run_benchmark(args) -> Dict:
+    import flask_app as fa
+    from translation import create_translation_backend
+
+    # 避免基准测试受网络翻译影响
+    fa.translation_queue.backend = create_translation_backend(
+        args.translation_backend, terms_path=str(fa.MEDICAL_TERMS_PATH)
+    )
+    fa.initialize_data_and_vectors()
+    corpus_data = fa.GLOBAL_CORPUS_DATA
+    questions_data = fa.GLOBAL_QUESTIONS_DATA
+    if not corpus_data or not questions_data:
+        raise SystemExit("无法加载数据，请检查数据文件")
+
+    chunks = fa.vector_store['corpus_chunks'] or fa.create_corpus_chunks(corpus_data)
+    judge = EvidenceJudge(chunks, coverage=args.coverage)
+
+    with open(fa.QUESTIONS_PATH, 'r', encoding='utf-8') as f:
+        raw_questions = [q for q in json.load(f) if isinstance(q, dict) and q.get('question')]
+    if args.types:
+        raw_questions = [q for q in raw_questions if q.get('question_type') in args.types]
+    if args.limit and len(raw_questions) > args.limit:
+        raw_questions = random.Random(args.seed).sample(raw_questions, args.limit)
+
+    representatives = representative_ids(questions_data)
+    max_k = max(args.k)
+    stages = {
+        'hybrid_retrieval': lambda q: fa.hybrid_retrieval(q, corpus_data, questions_data, top_k=max_k),
+        'cascade_retrieval': lambda q: fa.cascade_retrieval(q, corpus_data, questions_data, top_k=max_k)[0],
+        'semantic_search': lambda q: fa.semantic_search(
+            q, fa.vector_store['corpus_embeddings'], chunks, top_k=max_k
+        ),
+        'keyword_search': lambda q: fa.keyword_search(q, chunks, top_k=max_k),
+        'search_in_questions': lambda q: fa.search_in_questions(
+            q, questions_data, answer_language=args.answer_language, top_k=max_k
+        ),
+    }
+    selected = [s for s in STAGES if s in args.stages]
+
+    records = {stage: [] for stage in selected}
+    for n, raw in enumerate(raw_questions, 1):
+        query = raw['question']
+        chunk_gold = judge.relevant_chunks(raw.get('evidence', ''))
+        question_id = raw.get('id', '')
+        question_gold = {f"question:{representatives.get(question_id, question_id)}"}
+        for stage in selected:
+            gold = question_gold if stage == 'search_in_questions' else chunk_gold
+            if stage in ('hybrid_retrieval', 'cascade_retrieval'):
+                gold = chunk_gold | question_gold
+            start = time.perf_counter()
+            results = stages[stage](query)
+            latency = time.perf_counter() - start
+            record = {
+                'type': raw.get('question_type', '其他'),
+                'latency': latency,
+                'gold_size': len(gold),
+            }
+            record.update(rank_metrics([result_key(r) for r in results], gold, args.k))
+            records[stage].append(record)
+        if n % 50 == 0:
+            print(f"   已完成 {n}/{len(raw_questions)} 个问题")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'query_count': len(raw_questions),
+            'k': args.k,
+            'seed': args.seed,
+            'coverage_threshold': args.coverage,
+            'answer_language': args.answer_language,
+            'translation_backend': args.translation_backend,
+            'chunk_count': len(chunks),
+            'merged_questions': len(representatives),
+            'rag_config': {k: v for k, v in fa.RAG_CONFIG.items() if isinstance(v, (int, float, str, bool))},
+        },
+        'stages': {},
+    }
+    for stage, stage_records in records.items():
+        by_type = defaultdict(list)
+        for record in stage_records:
+            by_type[record['type']].append(record)
+        report['stages'][stage] = {
+            'overall': aggregate(stage_records, args.k),
+            'by_type': {t: aggregate(rs, args.k) for t, rs in sorted(by_type.items())},
+        }
+    return report
+
+
+def print_report(report: Dict, baseline: Optional[Dict] = None):
+    ks = report['meta']['k']
+    columns = [f'recall@{k}' for k in ks] + ['mrr', 'p50_ms', 'p95_ms', 'p99_ms', 'qps']
+    print(f"\n📊 检索基准（{report['meta']['query_count']} 个问题）")
+    print(f"{'stage':<22}" + ''.join(f"{c:>12}" for c in columns))
+    for stage, data in report['stages'].items():
+        overall = data['overall']
+        row = f"{stage:<22}"
+        for c in columns:
+            value = overall.get(c)
+            row += f"{'-' if value is None else value:>12}"
+        print(row)
+        if baseline and stage in baseline.get('stages', {}):
+            old = baseline['stages'][stage]['overall']
+            delta = f"{'  Δ':<22}"
+            for c in columns:
+                if overall.get(c) is None or old.get(c) is None:
+                    delta += f"{'-':>12}"
+                else:
+                    delta += f"{overall[c] - old[c]:>+12.4g}"
+            print(delta)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线检索基准测试')
+    parser.add_argument('--limit', type=int, default=0, help='随机抽样的问题数（0表示全部）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 3, 5, 10])
+    parser.add_argument('--types', nargs='*', help='只测试指定的问题类型')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--coverage', type=float, default=0.7, help='evidence实词覆盖率阈值')
+    parser.add_argument('--answer-language', default='en', choices=['zh', 'en'])
+    parser.add_argument('--translation-backend', default='local', choices=['local', 'stub', 'remote', 'tiered'])
+    parser.add_argument('--output', default='retrieval_benchmark.json')
+    parser.add_argument('--compare', help='与之前的结果文件对比')
+    args = parser.parse_args()
+    args.k = sorted(set(args.k))
+
+    report = run_benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+# chunking.py - 按模型token预算切分文本
+"""
+以嵌入模型的token数（而不是字符数）切分语料库
+
+- 一次线性扫描切出句子（。！？ 以及后接空白的 .!? 和空行）
+- 句子的token数：有模型tokenizer时批量精确计算，否则估算（中文每字1个token，英文按词长估算）
+- 贪心打包：相邻句子装进一个chunk，直到达到 max_seq_length（扣除[CLS]/[SEP]）；
+  相邻chunk之间保留不超过 overlap_tokens 的尾部句子作为重叠；超长单句按比例切开
+- ChunkReport：chunk数、总token数、最大chunk的token数，用于估算一次构建要编码的量
+- ChunkStore：chunks只保存为语料库缓冲区（原文str，或分片进程中内存映射的UTF-8文件）上的偏移数组，
+  文本只在取用某个chunk（检索返回的top-k）时切片，元数据内存与chunk数成正比而不是语料库大小
+
+查看当前语料库的切分情况（与旧的按字符切分对比被截断的chunk数）：
+    python chunking.py
+"""
+import math
+import mmap
+import re
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SPECIAL_TOKENS = 2  # [CLS] [SEP]
+DEFAULT_MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2
+
+_SENTENCE_END = re.compile(r'[。！？]|[.!?](?=\s|$)|\n\s*\n')
+_ESTIMATE_TOKENS = re.compile(r'[一-鿿㐀-䶿]|[A-Za-z0-9]+|[^\sA-Za-z0-9一-鿿㐀-䶿]')
+
+
+def sentence_spans(text: str) -> List[Tuple[int, int]]:
+    """一次扫描切出句子，返回去除首尾空白后的 (start, end) 偏移"""
+    spans = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        _append_stripped(text, start, match.end(), spans)
+        start = match.end()
+    _append_stripped(text, start, len(text), spans)
+    return spans
+
+
+def _append_stripped(text: str, start: int, end: int, spans: List[Tuple[int, int]]):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if end > start:
+        spans.append((start, end))
+
+
+def estimate_tokens(text: str) -> int:
+    """没有tokenizer时的估算：中文（BERT系tokenizer逐字切分）每字1个，英文/数字按词长，标点各1个"""
+    count = 0
+    for match in _ESTIMATE_TOKENS.finditer(text):
+        piece = match.group()
+        count += 1 + (len(piece) - 1) // 6 if piece[0].isascii() and piece[0].isalnum() else 1
+    return count
+
+
+def load_tokenizer(model_name: str):
+    """只加载模型的tokenizer（不加载权重），失败返回None；sentence-transformers的简称会补全组织名"""
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        return None
+    candidates = [model_name] if '/' in model_name else [model_name, f'sentence-transformers/{model_name}']
+    for name in candidates:
+        try:
+            return AutoTokenizer.from_pretrained(name)
+        except Exception as e:
+            error = e
+    print(f"无法加载tokenizer {model_name}，按估算切分: {error}")
+    return None
+
+
+class TokenCounter:
+    """有tokenizer（如 SentenceTransformer.tokenizer）时批量精确计数，否则估算"""
+
+    def __init__(self, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.exact = tokenizer is not None
+
+    def count(self, texts: Sequence[str]) -> List[int]:
+        if not texts:
+            return []
+        if self.exact:
+            try:
+                encoded = self.tokenizer(list(texts), add_special_tokens=False)
+                return [len(ids) for ids in encoded['input_ids']]
+            except Exception as e:
+                print(f"tokenizer计数失败，改用估算: {e}")
+                self.exact = False
+        return [estimate_tokens(text) for text in texts]
+
+
+def token_budget(max_seq_length: Optional[int] = None, override: Optional[int] = None) -> int:
+    """一个chunk可用的token数：模型的 max_seq_length 扣除特殊token"""
+    if override:
+        return override
+    return max(8, (max_seq_length or DEFAULT_MAX_SEQ_LENGTH) - SPECIAL_TOKENS)
+
+
+def pack_sentences(spans: List[Tuple[int, int]], counts: List[int], max_tokens: int,
+                   overlap_tokens: int = 0) -> List[Tuple[int, int, int]]:
+    """把相邻句子装进不超过 max_tokens 的chunk，返回 [(start, end, token数)]"""
+    chunks = []
+    i, n = 0, len(spans)
+    while i < n:
+        if counts[i] > max_tokens:
+            chunks.extend(_split_long(spans[i], counts[i], max_tokens))
+            i += 1
+            continue
+        j, total = i, 0
+        while j < n and total + counts[j] <= max_tokens:
+            total += counts[j]
+            j += 1
+        chunks.append((spans[i][0], spans[j - 1][1], total))
+        if j >= n:
+            break
+        # 重叠：下一个chunk从末尾几句开始（至少前进一句，且留得下第 j 句）
+        k, carried = j, 0
+        limit = min(overlap_tokens, max_tokens - counts[j])
+        while k - 1 > i and carried + counts[k - 1] <= limit:
+            k -= 1
+            carried += counts[k]
+        i = k
+    return chunks
+
+
+def _split_long(span: Tuple[int, int], tokens: int, max_tokens: int) -> List[Tuple[int, int, int]]:
+    """超长单句按字符比例切成若干段（留10%余量，token分布不均时也不超限）"""
+    start, end = span
+    pieces = math.ceil(tokens / (max_tokens * 0.9))
+    step = math.ceil((end - start) / pieces)
+    result = []
+    for piece_start in range(start, end, step):
+        piece_end = min(end, piece_start + step)
+        result.append((piece_start, piece_end, math.ceil(tokens * (piece_end - piece_start) / (end - start))))
+    return result
+
+
+class ChunkReport(dict):
+    """切分统计：chunks、tokens（总数）、max_chunk_tokens、token_budget、tokenizer（model / estimate）"""
+
+
+def chunk_by_tokens(text: str, tokenizer=None, max_tokens: int = DEFAULT_MAX_SEQ_LENGTH - SPECIAL_TOKENS,
+                    overlap_tokens: int = 32) -> Tuple[List[Tuple[int, int, int]], ChunkReport]:
+    """按token预算切分，返回 ([(start, end, token数)], 统计)"""
+    counter = TokenCounter(tokenizer)
+    spans = sentence_spans(text or '')
+    counts = counter.count([text[start:end] for start, end in spans])
+    chunks = pack_sentences(spans, counts, max_tokens, min(overlap_tokens, max_tokens // 2))
+    report = ChunkReport(
+        chunks=len(chunks),
+        tokens=sum(tokens for _, _, tokens in chunks),
+        max_chunk_tokens=max((tokens for _, _, tokens in chunks), default=0),
+        token_budget=max_tokens,
+        tokenizer='model' if counter.exact else 'estimate',
+    )
+    return chunks, report
+
+
+class ChunkStore:
+    """
+    chunks = 一个不可变的缓冲区 + 紧凑的偏移数组（每个chunk约36字节）
+
+    buffer：str（直接共享 corpus_data['full_content']，偏移为字符偏移）或 bytes/mmap（UTF-8，偏移为字节偏移）
+    char_offsets：chunk在完整语料库中的字符偏移（返回给客户端的 start/end）
+    indices：chunk编号（chunk_id），去重或分片后不连续
+    duplicates：{chunk编号: [未索引的近似重复chunk编号]}
+    按下标取用时才切片并构造与原chunk字典相同字段的字典
+    """
+
+    def __init__(self, buffer, offsets: np.ndarray, char_offsets: Optional[np.ndarray] = None,
+                 tokens: Optional[np.ndarray] = None, indices: Optional[np.ndarray] = None,
+                 duplicates: Optional[Dict[int, List[int]]] = None):
+        self.buffer = buffer
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+        self.char_offsets = self.offsets if char_offsets is None else np.asarray(char_offsets, dtype=np.int64).reshape(-1, 2)
+        self.tokens = (np.full(len(self.offsets), -1, dtype=np.int32) if tokens is None
+                       else np.asarray(tokens, dtype=np.int32))
+        self.indices = (np.arange(len(self.offsets), dtype=np.int32) if indices is None
+                        else np.asarray(indices, dtype=np.int32))
+        self.duplicates = duplicates or {}
+
+    @classmethod
+    def from_spans(cls, text: str, spans: Sequence[Tuple]) -> 'ChunkStore':
+        """spans: [(start, end)] 或 [(start, end, token数或None)]，偏移为 text 中的字符偏移"""
+        offsets = np.array([span[:2] for span in spans], dtype=np.int64).reshape(-1, 2)
+        tokens = np.array([span[2] if len(span) > 2 and span[2] is not None else -1 for span in spans],
+                          dtype=np.int32)
+        return cls(text, offsets, tokens=tokens)
+
+    def select(self, rows: Sequence[int], duplicates: Optional[Dict[int, List[int]]] = None) -> 'ChunkStore':
+        """只保留指定行（如每组近似重复的代表），共享同一个缓冲区；duplicates 的键和值为行号"""
+        rows = np.asarray(rows, dtype=np.int64)
+        char_offsets = None if self.char_offsets is self.offsets else self.char_offsets[rows]
+        back_refs = {int(self.indices[row]): [int(self.indices[d]) for d in dups]
+                     for row, dups in (duplicates or {}).items()}
+        return ChunkStore(self.buffer, self.offsets[rows], char_offsets, self.tokens[rows], self.indices[rows], back_refs)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i) -> Dict:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        text = self.text(i)
+        start, end = self.char_offsets[i]
+        token_count = int(self.tokens[i])
+        index = int(self.indices[i])
+        item = {
+            'id': f'chunk_{index:04d}',
+            'text': text,
+            'char_count': len(text),
+            'word_count': len(text.split()),
+            'token_count': token_count if token_count >= 0 else None,
+            'chunk_index': index,
+            'start': int(start),
+            'end': int(end),
+            'source': 'corpus'
+        }
+        if index in self.duplicates:
+            item['duplicate_ids'] = [f'chunk_{d:04d}' for d in self.duplicates[index]]
+        return item
+
+    def text(self, i: int) -> str:
+        start, end = self.offsets[i]
+        piece = self.buffer[start:end]
+        return piece if isinstance(piece, str) else piece.decode('utf-8')
+
+    def texts(self) -> List[str]:
+        """全部chunk文本（构建向量时一次性使用）"""
+        return [self.text(i) for i in range(len(self))]
+
+    def __sizeof__(self) -> int:
+        """只计偏移数组；缓冲区与 corpus_data 共享或为内存映射"""
+        arrays = {id(a): a.nbytes for a in (self.offsets, self.char_offsets, self.tokens, self.indices)}
+        return object.__sizeof__(self) + sum(arrays.values()) + sys.getsizeof(self.duplicates)
+
+    def save(self, path: Path, start: int = 0, end: Optional[int] = None) -> Dict:
+        """把第 start..end 个chunk覆盖的原文写成UTF-8文件（path），偏移写入 path.npy，返回 load 需要的 duplicates（可写入JSON）"""
+        end = len(self) if end is None else end
+        path = Path(path)
+        if end <= start:
+            path.write_bytes(b'')
+            np.save(path.with_suffix('.npy'), np.zeros((0, 6), dtype=np.int64))
+            return {'duplicates': {}}
+        base = int(self.offsets[start:end, 0].min())
+        stop = int(self.offsets[start:end, 1].max())
+        text = self.buffer[base:stop]
+        data = text.encode('utf-8') if isinstance(text, str) else bytes(text)
+        local = self.offsets[start:end] - base
+        if isinstance(text, str):
+            positions = np.unique(local)
+            byte_positions = char_to_byte_offsets(text, positions)
+            local = byte_positions[np.searchsorted(positions, local)]
+        columns = np.column_stack([local, self.char_offsets[start:end], self.tokens[start:end].astype(np.int64),
+                                   self.indices[start:end].astype(np.int64)])
+        path.write_bytes(data)
+        np.save(path.with_suffix('.npy'), columns)
+        indices = set(int(i) for i in self.indices[start:end])
+        return {'duplicates': {str(i): dups for i, dups in self.duplicates.items() if i in indices}}
+
+    @classmethod
+    def load(cls, path: Path, duplicates: Optional[Dict[str, List[int]]] = None) -> 'ChunkStore':
+        """内存映射 save 写出的文件（页面由操作系统按需载入，多个进程共享）"""
+        path = Path(path)
+        columns = np.load(path.with_suffix('.npy'))
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if path.stat().st_size else b''
+        return cls(buffer, columns[:, 0:2], columns[:, 2:4], columns[:, 4], columns[:, 5],
+                   {int(i): dups for i, dups in (duplicates or {}).items()})
+
+
+def char_to_byte_offsets(text: str, positions: np.ndarray) -> np.ndarray:
+    """升序的字符偏移转换为UTF-8字节偏移（逐段编码，一次线性扫描）"""
+    result = np.empty(len(positions), dtype=np.int64)
+    prev_char, prev_byte = 0, 0
+    for k, position in enumerate(positions):
+        prev_byte += len(text[prev_char:position].encode('utf-8'))
+        prev_char = position
+        result[k] = prev_byte
+    return result
+
+
+def main():
+    import os
+    model_name = os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+    os.environ.setdefault('RAG_CHUNK_TOKENIZER', model_name)  # 只加载tokenizer
+    os.environ['RAG_EMBEDDING_MODEL'] = 'none'
+    os.environ.setdefault('RAG_REQUEST_LOG', 'none')
+    import flask_app as fa
+    corpus = fa.load_corpus_data()
+    if not corpus:
+        raise SystemExit("没有语料库数据")
+    text = corpus['full_content']
+    tokenizer, budget = fa.chunk_tokenizer()
+    _, report = chunk_by_tokens(text, tokenizer, budget, fa.RAG_CONFIG['chunk_overlap_tokens'])
+    counter = TokenCounter(tokenizer)
+    legacy = fa.split_text_into_spans(text, fa.RAG_CONFIG['chunk_size'], fa.RAG_CONFIG['chunk_overlap'])
+    legacy_counts = counter.count([text[start:end] for start, end in legacy])
+    truncated = [c for c in legacy_counts if c > report['token_budget']]
+    print(f"按token切分: {report['chunks']} 个chunk，共 {report['tokens']} tokens，"
+          f"最大 {report['max_chunk_tokens']} / 上限 {report['token_budget']}（{report['tokenizer']}）")
+    print(f"按字符切分: {len(legacy)} 个chunk，共 {sum(legacy_counts)} tokens，"
+          f"其中 {len(truncated)} 个超过上限（编码时被截断 {sum(c - report['token_budget'] for c in truncated)} tokens）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# dedup.py - 构建时的近似重复检测（MinHash + LSH）
+"""
+在建索引之前把近似重复的chunks / 问题库条目分组，每组只索引一个代表（组内下标最小的一条），
+其余条目记为代表的 duplicates（反向引用），检索时不再需要按文本md5事后去重
+
+- 文本规范化（小写、合并空白）后取字符 k-gram（中英文通用）
+- MinHash：每个 k-gram 用 crc32 得到稳定的32位哈希（不受 PYTHONHASHSEED 影响，各进程结果一致），
+  num_perm 个 multiply-shift 哈希取最小值作为签名
+- LSH：签名分成 bands 段，任一段完全相同即为候选对；候选对按签名估计的Jaccard相似度 >= threshold 确认，
+  并查集合并成组
+
+查看数据中的近似重复组：
+    python dedup.py --threshold 0.8
+"""
+import argparse
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def shingle_hashes(text: str, k: int = 5) -> np.ndarray:
+    """规范化文本的字符 k-gram 哈希（去重后）"""
+    text = _WHITESPACE.sub(' ', text.lower()).strip()
+    if len(text) <= k:
+        grams = {text}
+    else:
+        grams = {text[i:i + k] for i in range(len(text) - k + 1)}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, k: int = 5, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.k = k
+        self.a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)  # 奇数乘子
+        self.b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingle_hashes(text, self.k)
+        # multiply-shift：(a*x + b) mod 2^64 的高32位
+        with np.errstate(over='ignore'):
+            mixed = (hashes[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)
+        return mixed.min(axis=0).astype(np.uint32)
+
+    def signatures(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for i, text in enumerate(texts):
+            matrix[i] = self.signature(text)
+        return matrix
+
+
+def lsh_rows(num_perm: int, threshold: float) -> int:
+    """每段的行数：使 LSH 的S曲线拐点 (1/bands)^(1/rows) 最接近且不高于阈值（偏向召回，误报由签名比较剔除）"""
+    best = 1
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        if (1 / (num_perm // rows)) ** (1 / rows) <= threshold:
+            best = rows
+    return best
+
+
+def near_duplicate_groups(texts: Sequence[str], threshold: float = 0.8, num_perm: int = 64,
+                          k: int = 5) -> List[List[int]]:
+    """返回所有组（含单元素组），组内下标升序，组按第一个下标排序"""
+    n = len(texts)
+    if n == 0:
+        return []
+    signatures = MinHasher(num_perm, k).signatures(texts)
+    rows = lsh_rows(num_perm, threshold)
+    parent = list(range(n))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    checked = set()
+    for band in range(num_perm // rows):
+        buckets = defaultdict(list)
+        for i, key in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[key.tobytes()].append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            first = members[0]
+            for other in members[1:]:
+                pair = (first, other)
+                if pair in checked:
+                    continue
+                checked.add(pair)
+                if find(first) == find(other):
+                    continue
+                if np.mean(signatures[first] == signatures[other]) >= threshold:
+                    parent[max(find(first), find(other))] = min(find(first), find(other))
+    groups = defaultdict(list)
+    for i in range(n):
+        groups[find(i)].append(i)
+    return [groups[root] for root in sorted(groups)]
+
+
+def representatives(groups: List[List[int]]) -> Tuple[List[int], Dict[int, List[int]]]:
+    """(代表下标列表, {代表下标: 其余成员下标})"""
+    return [group[0] for group in groups], {group[0]: group[1:] for group in groups if len(group) > 1}
+
+
+def dedup_report(total: int, groups: List[List[int]]) -> Dict:
+    merged = [group for group in groups if len(group) > 1]
+    return {
+        'items': total,
+        'indexed': len(groups),
+        'removed': total - len(groups),
+        'groups_with_duplicates': len(merged),
+        'largest_group': max((len(group) for group in merged), default=1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查看语料库chunks和问题库中的近似重复')
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--num-perm', type=int, default=64)
+    parser.add_argument('--show', type=int, default=5, help='每类显示的重复组数')
+    args = parser.parse_args()
+
+    import os
+    os.environ.setdefault('RAG_CHUNK_TOKENIZER', os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'))
+    os.environ['RAG_EMBEDDING_MODEL'] = 'none'
+    os.environ.setdefault('RAG_REQUEST_LOG', 'none')
+    import flask_app as fa
+    fa.RAG_CONFIG['dedup_threshold'] = 0  # 在这里按参数分组
+    chunks = fa.create_corpus_chunks(fa.load_corpus_data())
+    questions = fa.load_questions_data()['all_questions']
+    for name, texts in (('corpus', chunks.texts()),
+                        ('questions', [fa.question_text(q) for q in questions])):
+        groups = near_duplicate_groups(texts, args.threshold, args.num_perm)
+        print(f"{name}: {dedup_report(len(texts), groups)}")
+        for group in [g for g in groups if len(g) > 1][:args.show]:
+            for i in group:
+                print(f"   [{i}] {texts[i][:100]!r}")
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# embedding_build.py - 并行、分桶、可断点续算的向量构建
+"""
+大语料库的离线/启动时向量构建
+
+- 分桶：按文本长度排序后切成固定大小的批次，同一批内长度相近，减少padding浪费
+- 并行：workers > 1 时用进程池（spawn），每个进程加载一份模型，torch线程数 = CPU核数 / 进程数
+- 断点续算：每个批次编码完立即写入 checkpoint 目录（先写临时文件再改名），
+  目录名包含文本、模型和批大小的指纹；中断后重新运行只编码缺失的批次，
+  全部完成后这些批次文件也作为缓存，下次启动直接组装
+- 报告：进度、续用的批次数和吞吐（条/秒）
+
+用法：
+    python embedding_build.py --workers 4 --batch-size 64
+    RAG_BUILD_WORKERS=4 python serve.py     # 启动时按同样方式构建
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from encoders import BACKENDS, encoder_spec, load_embedding_model, parse_spec
+
+_worker_model = None
+_worker_threads = None
+
+
+def fingerprint(texts: List[str], model_name: str, batch_size: int) -> str:
+    digest = hashlib.sha1(f"{model_name}\0{batch_size}\0{len(texts)}".encode('utf-8'))
+    for text in texts:
+        digest.update(text.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+def length_buckets(texts: List[str], batch_size: int) -> List[List[int]]:
+    """按长度从长到短排序后切批（最长的批先跑，内存峰值和剩余时间估计都偏保守）"""
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def load_encoder(model_name: str):
+    """model_name 为 encoders.encoder_spec 的格式（'模型名' 或 '模型名@onnx-int8'）"""
+    if model_name.startswith('stub'):  # stub 或 stub:延迟秒数（压测/验证用）
+        from load_test import StubEncoder
+        _, _, latency = model_name.partition(':')
+        return StubEncoder(latency=float(latency or 0))
+    return load_embedding_model(*parse_spec(model_name), threads=_worker_threads)
+
+
+def _init_worker(model_name: str, threads: int):
+    global _worker_model, _worker_threads
+    _worker_threads = threads
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker_model = load_encoder(model_name)
+
+
+def _encode_batch(batch_path: str, texts: List[str]) -> Tuple[str, int, float]:
+    """进程池任务：编码一批并写入checkpoint"""
+    start = time.perf_counter()
+    embeddings = np.asarray(_worker_model.encode(texts, show_progress_bar=False, batch_size=len(texts)),
+                            dtype=np.float32)
+    _save_batch(Path(batch_path), embeddings)
+    return batch_path, len(texts), time.perf_counter() - start
+
+
+def _save_batch(path: Path, embeddings: np.ndarray):
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")  # 多个构建进程同时运行时互不覆盖
+    np.save(tmp_path, embeddings)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingBuilder:
+    def __init__(self, checkpoint_dir: Path, model_name: str, batch_size: int = 64, workers: int = 1,
+                 encode: Optional[Callable[[List[str]], np.ndarray]] = None, progress_every: float = 5.0):
+        """
+        encode：进程内编码函数（workers <= 1 时使用，如 flask_app.encode_texts）；
+        workers > 1 时各进程按 model_name 加载模型
+        """
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.workers = workers
+        self.encode = encode
+        self.progress_every = progress_every
+
+    def build(self, name: str, texts: List[str]) -> Tuple[Optional[np.ndarray], Dict]:
+        """返回 (按原顺序排列的向量矩阵, 统计)；有批次失败时返回 None（已完成的批次保留在磁盘上）"""
+        stats = {'name': name, 'texts': len(texts), 'batches': 0, 'resumed_batches': 0,
+                 'encoded_texts': 0, 'seconds': 0.0, 'texts_per_sec': None}
+        if not texts:
+            return None, stats
+        run_dir = self.checkpoint_dir / f"{name}-{fingerprint(texts, self.model_name, self.batch_size)}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_stale_runs(name, run_dir)
+        with open(run_dir / 'meta.json', 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model_name, 'batch_size': self.batch_size, 'texts': len(texts)}, f)
+
+        buckets = length_buckets(texts, self.batch_size)
+        batch_paths = [run_dir / f"batch_{i:06d}.npy" for i in range(len(buckets))]
+        missing = [i for i, path in enumerate(batch_paths) if not path.exists()]
+        stats['batches'] = len(buckets)
+        stats['resumed_batches'] = len(buckets) - len(missing)
+        if stats['resumed_batches']:
+            print(f"   {name}: 续用 {stats['resumed_batches']}/{len(buckets)} 个已完成批次")
+
+        start = time.perf_counter()
+        failed = self._encode_missing(name, texts, buckets, batch_paths, missing, stats, start)
+        stats['seconds'] = round(time.perf_counter() - start, 3)
+        if stats['encoded_texts'] and stats['seconds'] > 0:
+            stats['texts_per_sec'] = round(stats['encoded_texts'] / stats['seconds'], 1)
+        if failed:
+            print(f"⚠️  {name}: {failed} 个批次编码失败，重新运行会从断点继续")
+            return None, stats
+
+        embeddings = None
+        for indices, path in zip(buckets, batch_paths):
+            batch = np.load(path)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            embeddings[indices] = batch
+        print(f"   {name}: {len(texts)} 条，编码 {stats['encoded_texts']} 条，"
+              f"用时 {stats['seconds']:.1f}s" + (f"，{stats['texts_per_sec']} 条/秒" if stats['texts_per_sec'] else ''))
+        return embeddings, stats
+
+    def _encode_missing(self, name, texts, buckets, batch_paths, missing, stats, start) -> int:
+        if not missing:
+            return 0
+        last_report = time.perf_counter()
+        done = 0
+        failed = 0
+
+        def progress(count: int):
+            nonlocal done, last_report
+            done += 1
+            stats['encoded_texts'] += count
+            now = time.perf_counter()
+            if now - last_report >= self.progress_every or done == len(missing):
+                last_report = now
+                rate = stats['encoded_texts'] / max(now - start, 1e-9)
+                print(f"   {name}: 编码进度 {done}/{len(missing)} 批，{rate:.1f} 条/秒")
+
+        if self.workers <= 1:
+            for i in missing:
+                batch_texts = [texts[j] for j in buckets[i]]
+                try:
+                    embeddings = self.encode(batch_texts)
+                    if embeddings is None:
+                        raise RuntimeError('编码返回空结果')
+                    _save_batch(batch_paths[i], np.asarray(embeddings, dtype=np.float32))
+                except Exception as e:
+                    print(f"批次 {i} 编码失败: {e}")
+                    return len(missing) - done
+                progress(len(batch_texts))
+            return 0
+
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        context = multiprocessing.get_context('spawn')  # 不fork已加载模型/线程池的父进程
+        with ProcessPoolExecutor(self.workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(self.model_name, threads)) as executor:
+            futures = [executor.submit(_encode_batch, str(batch_paths[i]), [texts[j] for j in buckets[i]])
+                       for i in missing]
+            for future in as_completed(futures):
+                try:
+                    _, count, _ = future.result()
+                except Exception as e:
+                    print(f"批次编码失败: {e}")
+                    failed += 1
+                    continue
+                progress(count)
+        return failed
+
+    def _remove_stale_runs(self, name: str, current: Path):
+        """同名的旧构建（文本或模型已变化）不会再被续用，删除"""
+        for path in self.checkpoint_dir.glob(f"{name}-*"):
+            if path != current and path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='并行、分桶、可断点续算的向量构建')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='编码进程数')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--checkpoint-dir', default=None, help='默认使用 RAG_CONFIG 中的 embedding_checkpoint_dir')
+    parser.add_argument('--model', default=None, help='默认使用 RAG_CONFIG 中的 embedding_model（stub[:秒] 为桩编码器）')
+    parser.add_argument('--backend', default=os.environ.get('RAG_EMBEDDING_BACKEND', 'torch'),
+                        choices=BACKENDS)
+    args = parser.parse_args()
+
+    base_model = args.model or os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+    model_name = base_model if base_model.startswith('stub') else encoder_spec(base_model, args.backend)
+    os.environ.setdefault('RAG_CHUNK_TOKENIZER', base_model)  # 与服务进程按同一tokenizer切分
+    os.environ['RAG_EMBEDDING_MODEL'] = 'none'  # flask_app 只用来读取数据和切分chunks，不加载模型
+    os.environ.setdefault('RAG_REQUEST_LOG', 'none')
+    import flask_app as fa
+    builder = EmbeddingBuilder(Path(args.checkpoint_dir or fa.BASE_DIR / fa.RAG_CONFIG['embedding_checkpoint_dir']),
+                               model_name, args.batch_size, args.workers, encode=load_encoder(model_name).encode
+                               if args.workers <= 1 else None)
+    corpus_chunks = fa.create_corpus_chunks(fa.load_corpus_data())
+    questions_data = fa.load_questions_data()
+    reports = []
+    for name, texts in (('corpus', corpus_chunks.texts()),
+                        ('questions', fa.question_texts(questions_data))):
+        _, stats = builder.build(name, texts)
+        reports.append(stats)
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+# embedding_service.py - 进程外嵌入服务
+"""
+独立进程持有嵌入模型，所有web worker通过Unix socket或localhost TCP共享
+
+- 协议：长度前缀的二进制帧，每个请求带id；同一连接上可以连续发送多个请求（流水线），
+  响应按id对应，不要求按发送顺序返回
+    请求  !QI  id, 负载长度   + JSON 文本列表
+    响应  !QBI id, 状态, 负载长度 + 成功: !II 行数, 维度 + float32矩阵；失败: 错误信息
+- EmbeddingServer：每个连接一个读线程，所有连接的请求进入同一个队列，
+  批处理线程攒够 max_batch 个文本或等待 max_wait 后一次调用 encode
+- EmbeddingClient：固定数量的连接（连接池），请求轮流分配到各连接；
+  连接失败后 retry_interval 秒内直接报错，由调用方回退到进程内编码；
+  服务端对某个请求返回的编码错误只影响该请求，不进入冷却
+
+启动服务：
+    python embedding_service.py --listen unix:/tmp/rag-embedding.sock
+    RAG_EMBEDDING_SERVER=unix:/tmp/rag-embedding.sock python serve.py --workers 4
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from encoders import BACKENDS, load_embedding_model
+
+REQUEST_HEADER = struct.Struct('!QI')
+RESPONSE_HEADER = struct.Struct('!QBI')
+MATRIX_HEADER = struct.Struct('!II')
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class EmbeddingServiceError(Exception):
+    """嵌入服务不可用、超时或返回错误"""
+
+
+class EmbeddingRequestError(EmbeddingServiceError):
+    """服务端对单个请求返回的错误（服务本身可用）"""
+
+
+def parse_address(address: str) -> Tuple[int, object]:
+    """'unix:/path/to.sock' 或 'host:port'，返回 (地址族, 地址)"""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('连接已关闭')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# ========== 服务端 ==========
+class EmbeddingServer:
+    def __init__(self, model, address: str, max_batch: int = 64, max_wait: float = 0.005):
+        self.model = model
+        self.address = address
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.running = True
+        family, bind_address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.unlink(bind_address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(bind_address)
+        self.sock.listen(128)
+        self.batch_thread = threading.Thread(target=self._batch_worker, name='embedding-batch', daemon=True)
+        self.batch_thread.start()
+
+    def serve_forever(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            if conn.family == socket.AF_INET:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._read_requests, args=(conn, threading.Lock()), daemon=True).start()
+
+    def shutdown(self):
+        self.running = False
+        self.sock.close()
+        self.pending.put(None)
+
+    def _read_requests(self, conn: socket.socket, write_lock: threading.Lock):
+        try:
+            while True:
+                request_id, length = REQUEST_HEADER.unpack(_recv_exact(conn, REQUEST_HEADER.size))
+                texts = json.loads(_recv_exact(conn, length).decode('utf-8'))
+                self.pending.put((conn, write_lock, request_id, texts))
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def _batch_worker(self):
+        while True:
+            first = self.pending.get()
+            if first is None:
+                return
+            batch = [first]
+            size = len(first[3])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+                size += len(item[3])
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch: List):
+        texts = [text for item in batch for text in item[3]]
+        try:
+            embeddings = np.asarray(self.model.encode(texts, show_progress_bar=False), dtype='<f4')
+            error = None
+        except Exception as e:
+            print(f"批量编码失败: {e}")
+            embeddings, error = None, str(e)
+        self.requests += len(batch)
+        self.batches += 1
+        self.texts += len(texts)
+        offset = 0
+        for conn, write_lock, request_id, request_texts in batch:
+            if error is None:
+                rows = embeddings[offset:offset + len(request_texts)]
+                offset += len(request_texts)
+                payload = MATRIX_HEADER.pack(*rows.shape) + rows.tobytes()
+                frame = RESPONSE_HEADER.pack(request_id, STATUS_OK, len(payload)) + payload
+            else:
+                message = error.encode('utf-8')
+                frame = RESPONSE_HEADER.pack(request_id, STATUS_ERROR, len(message)) + message
+            try:
+                with write_lock:
+                    conn.sendall(frame)
+            except OSError:
+                pass  # 客户端已断开
+
+    def stats(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'texts': self.texts,
+            'mean_batch_texts': round(self.texts / self.batches, 2) if self.batches else 0,
+        }
+
+
+# ========== 客户端 ==========
+class _Connection:
+    """一个连接：发送加锁，读线程按id把响应交给对应的Future"""
+
+    def __init__(self, address: str, connect_timeout: float):
+        family, connect_address = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(connect_timeout)
+        self.sock.connect(connect_address)
+        self.sock.settimeout(None)
+        if family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.closed = False
+        threading.Thread(target=self._read_responses, name='embedding-client', daemon=True).start()
+
+    def submit(self, request_id: int, texts: List[str]) -> Future:
+        future = Future()
+        payload = json.dumps(texts, ensure_ascii=False).encode('utf-8')
+        with self.pending_lock:
+            if self.closed:
+                raise EmbeddingServiceError('连接已关闭')
+            self.pending[request_id] = future
+        try:
+            with self.send_lock:
+                self.sock.sendall(REQUEST_HEADER.pack(request_id, len(payload)) + payload)
+        except OSError as e:
+            self.close(e)
+            raise EmbeddingServiceError(f"发送失败: {e}")
+        return future
+
+    def cancel(self, request_id: int):
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
+
+    def _read_responses(self):
+        try:
+            while True:
+                request_id, status, length = RESPONSE_HEADER.unpack(_recv_exact(self.sock, RESPONSE_HEADER.size))
+                payload = _recv_exact(self.sock, length)
+                with self.pending_lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue  # 调用方已超时
+                if status == STATUS_OK:
+                    rows, dim = MATRIX_HEADER.unpack_from(payload)
+                    matrix = np.frombuffer(payload, dtype='<f4', offset=MATRIX_HEADER.size).reshape(rows, dim)
+                    future.set_result(matrix.astype(np.float32, copy=False))
+                else:
+                    future.set_exception(EmbeddingRequestError(payload.decode('utf-8', 'replace')))
+        except (ConnectionError, OSError, struct.error) as e:
+            self.close(e)
+
+    def close(self, reason=None):
+        with self.pending_lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for future in pending.values():
+            future.set_exception(EmbeddingServiceError(f"连接断开: {reason}"))
+
+
+class EmbeddingClient:
+    def __init__(self, address: str, pool_size: int = 4, timeout: float = 2.0,
+                 connect_timeout: float = 0.5, retry_interval: float = 5.0):
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self.reset()
+
+    def reset(self):
+        """丢弃所有连接（fork后在子进程中调用，父进程的连接和读线程不可用）"""
+        self.connections = [None] * self.pool_size
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.slots = itertools.count()
+        self.retry_at = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.retry_at
+
+    def _connection(self) -> _Connection:
+        slot = next(self.slots) % self.pool_size
+        connection = self.connections[slot]
+        if connection is not None and not connection.closed:
+            return connection
+        with self.lock:
+            connection = self.connections[slot]
+            if connection is None or connection.closed:
+                connection = self.connections[slot] = _Connection(self.address, self.connect_timeout)
+            return connection
+
+    def encode(self, texts: List[str], timeout: Optional[float] = None) -> np.ndarray:
+        """编码一批文本，失败或超时抛出 EmbeddingServiceError"""
+        if not self.available():
+            raise EmbeddingServiceError('嵌入服务暂不可用')
+        self.requests += 1
+        request_id = next(self.ids)
+        connection = None
+        try:
+            connection = self._connection()
+            return connection.submit(request_id, list(texts)).result(timeout or self.timeout)
+        except FutureTimeout:
+            connection.cancel(request_id)
+            self.failures += 1
+            raise EmbeddingServiceError(f"嵌入服务超时（{len(texts)} 个文本）")
+        except OSError as e:
+            self._mark_unavailable(e)
+            raise EmbeddingServiceError(f"无法连接嵌入服务: {e}")
+        except EmbeddingRequestError:
+            self.failures += 1
+            raise
+        except EmbeddingServiceError as e:
+            self._mark_unavailable(e)
+            raise
+
+    def _mark_unavailable(self, reason):
+        self.failures += 1
+        if self.available():
+            print(f"⚠️  嵌入服务不可用（{reason}），{self.retry_interval:g}秒内使用进程内编码")
+        self.retry_at = time.monotonic() + self.retry_interval
+
+    def stats(self) -> Dict:
+        return {'requests': self.requests, 'failures': self.failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='进程外嵌入服务')
+    parser.add_argument('--listen', default=os.environ.get('RAG_EMBEDDING_SERVER', 'unix:/tmp/rag-embedding.sock'),
+                        help='监听地址：unix:/path 或 host:port')
+    parser.add_argument('--model', default=os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'))
+    parser.add_argument('--backend', default=os.environ.get('RAG_EMBEDDING_BACKEND', 'torch'),
+                        choices=BACKENDS, help='推理后端（见 encoders.py）')
+    parser.add_argument('--max-batch', type=int, default=64, help='一次编码的最多文本数')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='攒批的最长等待（毫秒）')
+    parser.add_argument('--stub', type=float, metavar='SECONDS', help='使用桩编码器（压测用），参数为每次encode的延迟')
+    args = parser.parse_args()
+
+    if args.stub is not None:
+        from load_test import StubEncoder
+        model = StubEncoder(latency=args.stub)
+    else:
+        print(f"🔄 正在加载嵌入模型 {args.model}（{args.backend}）...")
+        model = load_embedding_model(args.model, args.backend)
+    server = EmbeddingServer(model, args.listen, args.max_batch, args.max_wait_ms / 1000)
+    print(f"✅ 嵌入服务已启动: {args.listen}（max_batch={args.max_batch}, max_wait={args.max_wait_ms}ms）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        print(f"嵌入服务已停止: {server.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# encoders.py - 可替换的嵌入编码后端
+"""
+嵌入模型的CPU推理后端，接口与 SentenceTransformer 一致（encode / tokenizer / max_seq_length）
+
+- torch：sentence-transformers 原模型（参考实现）
+- onnx：导出为ONNX，用 ONNX Runtime 推理（图优化，intra-op线程数可调）
+- onnx-int8：ONNX模型再做动态int8量化（权重int8，激活运行时量化），体积和延迟更小
+
+首次使用 onnx/onnx-int8 时用 sentence-transformers 导出，写入 cache/onnx/<模型名>/
+（model.onnx、model-int8.onnx、tokenizer和池化配置），之后只需要 onnxruntime + transformers；
+onnxruntime 不可用或导出失败时回退到 torch 后端
+
+线程数：RAG_EMBEDDING_THREADS，未设置时用 OMP_NUM_THREADS（serve.py 的worker默认1），再否则为CPU核数
+
+对比各后端的延迟、吞吐和与参考后端的向量偏差：
+    python encoders.py --backends torch onnx onnx-int8 --texts 512
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import percentile
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+DEFAULT_EXPORT_DIR = Path(__file__).parent.absolute() / 'cache' / 'onnx'
+
+
+def encoder_spec(model_name: str, backend: str = 'torch') -> str:
+    """模型+后端的标识（'all-MiniLM-L6-v2@onnx-int8'），用于缓存指纹和进程间传递"""
+    return model_name if backend == 'torch' else f"{model_name}@{backend}"
+
+
+def parse_spec(spec: str) -> Tuple[str, str]:
+    model_name, _, backend = spec.partition('@')
+    return model_name, backend or 'torch'
+
+
+def default_threads() -> int:
+    for name in ('RAG_EMBEDDING_THREADS', 'OMP_NUM_THREADS'):
+        value = os.environ.get(name)
+        if value and value.isdigit() and int(value) > 0:
+            return int(value)
+    return os.cpu_count() or 1
+
+
+def load_embedding_model(model_name: str, backend: str = 'torch', export_dir: Optional[Path] = None,
+                         threads: Optional[int] = None):
+    """按后端加载编码器；onnx 后端失败时回退到 torch（sentence-transformers 未安装时抛出 ImportError）"""
+    if backend != 'torch':
+        try:
+            return OnnxEncoder.from_model(model_name, quantize=backend == 'onnx-int8',
+                                          export_dir=export_dir, threads=threads)
+        except Exception as e:
+            print(f"⚠️  {backend} 后端不可用，回退到 torch: {e}")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+# ========== 导出 ==========
+def export_dir_for(model_name: str, export_dir: Optional[Path] = None) -> Path:
+    return Path(export_dir or DEFAULT_EXPORT_DIR) / model_name.replace('/', '__')
+
+
+def export_onnx(model_name: str, output_dir: Path, quantize: bool = True) -> Path:
+    """用 sentence-transformers 模型导出 transformer 部分，池化/归一化配置写入 pooling.json"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device='cpu')
+    transformer = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    pooling = next((module for module in st_model if type(module).__name__ == 'Pooling'), None)
+    config = {
+        'pooling': 'cls' if pooling is not None and getattr(pooling, 'pooling_mode_cls_token', False) else 'mean',
+        'normalize': any(type(module).__name__ == 'Normalize' for module in st_model),
+        'max_seq_length': st_model.max_seq_length,
+    }
+
+    class HiddenStates(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, *inputs):
+            return self.model(*inputs, return_dict=False)[0]
+
+    sample = tokenizer(['export sample text'], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in sample]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names + ['last_hidden_state']}
+
+    # 先写临时目录再改名：多个进程同时首次加载时不会读到写了一半的文件
+    tmp_dir = output_dir.with_name(f"{output_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    with torch.no_grad():
+        torch.onnx.export(HiddenStates(transformer), tuple(sample[name] for name in input_names),
+                          str(tmp_dir / 'model.onnx'), input_names=input_names,
+                          output_names=['last_hidden_state'], dynamic_axes=dynamic_axes, opset_version=14)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(str(tmp_dir / 'model.onnx'), str(tmp_dir / 'model-int8.onnx'), weight_type=QuantType.QInt8)
+    tokenizer.save_pretrained(str(tmp_dir))
+    with open(tmp_dir / 'pooling.json', 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    if output_dir.exists():
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # 其它进程已导出
+    else:
+        os.replace(tmp_dir, output_dir)
+    return output_dir
+
+
+# ========== ONNX Runtime 编码器 ==========
+class OnnxEncoder:
+    def __init__(self, model_dir: Path, quantize: bool = False, threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        with open(model_dir / 'pooling.json', 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        self.pooling = config['pooling']
+        self.normalize = config['normalize']
+        self.max_seq_length = config['max_seq_length']
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+        self.threads = threads or default_threads()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        model_file = model_dir / ('model-int8.onnx' if quantize else 'model.onnx')
+        self.session = ort.InferenceSession(str(model_file), options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.backend = 'onnx-int8' if quantize else 'onnx'
+
+    @classmethod
+    def from_model(cls, model_name: str, quantize: bool = False, export_dir: Optional[Path] = None,
+                   threads: Optional[int] = None) -> 'OnnxEncoder':
+        import onnxruntime  # noqa: F401  未安装时在导出之前失败
+        model_dir = export_dir_for(model_name, export_dir)
+        if not (model_dir / ('model-int8.onnx' if quantize else 'model.onnx')).exists():
+            print(f"🔄 正在导出 {model_name} 为ONNX{'（int8量化）' if quantize else ''}...")
+            shutil.rmtree(model_dir, ignore_errors=True)
+            export_onnx(model_name, model_dir, quantize=True)
+        encoder = cls(model_dir, quantize, threads)
+        print(f"✅ 嵌入后端: {encoder.backend}（{encoder.threads} 线程）")
+        return encoder
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.session.get_outputs()[0].shape[-1])
+
+    def encode(self, texts, show_progress_bar=False, batch_size=32, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        # 与 sentence-transformers 相同：按长度排序后分批，减少padding
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        embeddings = [None] * len(texts)
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            batch = self._encode_batch([texts[i] for i in indices])
+            for i, row in zip(indices, batch):
+                embeddings[i] = row
+        result = np.vstack(embeddings) if embeddings else np.zeros((0, self.get_sentence_embedding_dimension()),
+                                                                    dtype=np.float32)
+        return result[0] if single else result
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                 return_tensors='np')
+        feeds = {name: encoded[name].astype(np.int64) for name in self.input_names}
+        hidden = self.session.run(None, feeds)[0]
+        if self.pooling == 'cls':
+            pooled = hidden[:, 0]
+        else:
+            mask = encoded['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32)
+
+
+# ========== 基准 ==========
+def benchmark_backend(encoder, texts: List[str], queries: List[str], batch_size: int) -> Tuple[Dict, np.ndarray]:
+    """单条查询延迟（批大小1）和批量吞吐，返回 (报告, 全部文本的向量)"""
+    encoder.encode(queries[:4], show_progress_bar=False)  # 预热
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        encoder.encode([query], show_progress_bar=False)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    embeddings = np.asarray(encoder.encode(texts, show_progress_bar=False, batch_size=batch_size), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+    return {
+        'query_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'query_p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'texts_per_sec': round(len(texts) / elapsed, 1) if elapsed > 0 else None,
+    }, embeddings
+
+
+def embedding_drift(reference: np.ndarray, embeddings: np.ndarray, k: int = 10) -> Dict:
+    """与参考后端的偏差：逐条余弦相似度，以及每条文本的 top-k 近邻与参考结果的重合率"""
+    def normalized(matrix):
+        return matrix / np.clip(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12, None)
+
+    ref, emb = normalized(reference), normalized(embeddings)
+    cosine = (ref * emb).sum(axis=1)
+    k = min(k, len(ref) - 1)
+    overlap = None
+    if k > 0:
+        ref_neighbors = np.argsort(-(ref @ ref.T), axis=1)[:, 1:k + 1]
+        emb_neighbors = np.argsort(-(emb @ emb.T), axis=1)[:, 1:k + 1]
+        overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(ref_neighbors, emb_neighbors)]))
+    return {
+        'cosine_mean': round(float(cosine.mean()), 5),
+        'cosine_min': round(float(cosine.min()), 5),
+        f'top{k}_overlap': round(overlap, 4) if overlap is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='嵌入后端基准：延迟、吞吐、与参考后端的向量偏差')
+    parser.add_argument('--model', default=os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'))
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS,
+                        help='第一个为参考后端')
+    parser.add_argument('--texts', type=int, default=512, help='用于吞吐和偏差的语料库chunk数')
+    parser.add_argument('--queries', type=int, default=100, help='测单条延迟的问题数')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--threads', type=int, default=None, help='ONNX Runtime intra-op线程数')
+    parser.add_argument('--export-dir', default=None)
+    parser.add_argument('--output', default='encoder_benchmark.json')
+    args = parser.parse_args()
+
+    os.environ['RAG_EMBEDDING_MODEL'] = 'none'  # flask_app 只用来读取数据和切分chunks
+    os.environ.setdefault('RAG_CHUNK_TOKENIZER', args.model)
+    os.environ.setdefault('RAG_REQUEST_LOG', 'none')
+    import flask_app as fa
+    texts = fa.create_corpus_chunks(fa.load_corpus_data()).texts()[:args.texts]
+    queries = [q['raw_question'] for q in fa.search_questions(fa.load_questions_data())][:args.queries]
+
+    reports = []
+    reference = None
+    for backend in args.backends:
+        print(f"🔄 {backend}...")
+        encoder = load_embedding_model(args.model, backend, args.export_dir, args.threads)
+        actual = getattr(encoder, 'backend', 'torch')
+        report, embeddings = benchmark_backend(encoder, texts, queries, args.batch_size)
+        report = {'backend': backend, 'actual_backend': actual, **report}
+        if reference is None:
+            reference = embeddings
+        else:
+            report.update(embedding_drift(reference, embeddings))
+        reports.append(report)
+        print(f"   {json.dumps(report, ensure_ascii=False)}")
+
+    print(f"\n📊 嵌入后端基准（{len(texts)} 个chunk，{len(queries)} 个查询，参考: {args.backends[0]}）")
+    columns = [key for key in reports[-1] if key not in ('backend', 'actual_backend')]
+    print(f"{'backend':<12}" + ''.join(f"{c:>16}" for c in columns))
+    for report in reports:
+        print(f"{report['backend']:<12}" + ''.join(f"{str(report.get(c, '-')):>16}" for c in columns))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'model': args.model, 'texts': len(texts), 'queries': len(queries), 'results': reports},
+                  f, ensure_ascii=False, indent=2)
+    print(f"\n✅ 结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
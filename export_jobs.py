@@ -0,0 +1,162 @@
+# export_jobs.py - 后台数据导出
+"""
+导出读取内存中的数据快照（不再重新读取JSON文件），完整导出问题库、语料库段落和chunks
+
+- 流式导出：CSV / JSONL 逐行生成，内存占用与数据量无关，可以直接作为响应流式返回
+- 后台任务：xlsx（openpyxl write_only 模式逐行写入）和 CSV / JSONL 在后台线程中写入缓存文件
+  <导出目录>/<快照版本>/<数据集>.<格式>；任务id = 快照版本-数据集-格式，
+  同一快照的同一导出只生成一次，重复提交直接返回已有任务或文件；
+  多worker部署时，其它进程生成的文件也能按任务id从磁盘上查到
+- 文件先写入 .part 再原子替换；新版本的文件生成后删除旧版本的目录
+- xlsx 单元格最多 32767 个字符，超出部分截断（完整内容用 CSV / JSONL 导出）
+"""
+import csv
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+EXCEL_CELL_LIMIT = 32767
+
+
+class ExportTable(NamedTuple):
+    sheet: str
+    columns: List[str]
+    rows: Callable[[], Iterable[Sequence]]  # 每次调用重新生成行
+
+
+def iter_csv(table: ExportTable, chunk_rows: int = 500) -> Iterator[str]:
+    """CSV文本块（带BOM，Excel直接打开中文不乱码），每 chunk_rows 行输出一次"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(table.columns)
+    for i, row in enumerate(table.rows(), 1):
+        writer.writerow(row)
+        if i % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl(table: ExportTable) -> Iterator[str]:
+    for row in table.rows():
+        yield json.dumps(dict(zip(table.columns, row)), ensure_ascii=False) + '\n'
+
+
+def write_xlsx(path: Path, tables: Sequence[ExportTable]):
+    """每个表一个工作表；write_only 模式不在内存中保留已写入的行"""
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    workbook = Workbook(write_only=True)
+    for table in tables:
+        sheet = workbook.create_sheet(table.sheet)
+        sheet.append(table.columns)
+        for row in table.rows():
+            sheet.append([ILLEGAL_CHARACTERS_RE.sub('', value)[:EXCEL_CELL_LIMIT] if isinstance(value, str) else value
+                          for value in row])
+    workbook.save(path)
+
+
+class ExportManager:
+    def __init__(self, root: Path, max_jobs: int = 100):
+        self.root = Path(root)
+        self.max_jobs = max_jobs
+        self.reset()
+
+    def reset(self):
+        """fork之后重建线程池（未完成的任务留在父进程）"""
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def artifact_path(self, version: str, dataset: str, fmt: str) -> Path:
+        return self.root / version / f"{dataset}.{fmt}"
+
+    def submit(self, version: str, dataset: str, fmt: str, tables: Sequence[ExportTable]) -> Dict:
+        """提交导出任务（csv/jsonl 只导出 tables[0]，xlsx 每个表一个工作表），返回任务状态"""
+        job_id = f"{version}-{dataset}-{fmt}"
+        path = self.artifact_path(version, dataset, fmt)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and job['state'] != 'failed':
+                return dict(job)
+            job = {'id': job_id, 'version': version, 'dataset': dataset, 'format': fmt,
+                   'state': 'queued', 'rows': 0, 'bytes': 0, 'cached': False, 'error': None,
+                   'submitted_at': time.time(), 'finished_at': None}
+            if path.exists():
+                job.update(state='done', cached=True, bytes=path.stat().st_size, finished_at=time.time())
+            else:
+                self.executor.submit(self._run, job, path, tables)
+            self.jobs[job_id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+            return dict(job)
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        parts = job_id.split('-', 2)
+        if len(parts) == 3 and parts[0].isalnum() and parts[1].isalnum() and parts[2] in FORMATS:
+            path = self.artifact_path(*parts)
+            if path.exists():  # 其它进程生成的文件
+                return {'id': job_id, 'version': parts[0], 'dataset': parts[1], 'format': parts[2],
+                        'state': 'done', 'cached': True, 'bytes': path.stat().st_size}
+        return None
+
+    def artifact(self, job_id: str) -> Optional[Path]:
+        job = self.status(job_id)
+        if job is None or job['state'] != 'done':
+            return None
+        return self.artifact_path(job['version'], job['dataset'], job['format'])
+
+    def _run(self, job: Dict, path: Path, tables: Sequence[ExportTable]):
+        job.update(state='running', started_at=time.time())
+        part = path.with_name(path.name + '.part')
+        counted = [ExportTable(t.sheet, t.columns, lambda t=t: self._count(job, t.rows())) for t in tables]
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if job['format'] == 'xlsx':
+                write_xlsx(part, counted)
+            else:
+                chunks = iter_csv(counted[0]) if job['format'] == 'csv' else iter_jsonl(counted[0])
+                with open(part, 'w', encoding='utf-8', newline='') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            os.replace(part, path)
+            job.update(state='done', bytes=path.stat().st_size, finished_at=time.time())
+            self.cleanup(job['version'])
+        except Exception as e:
+            print(f"导出任务 {job['id']} 失败: {e}")
+            job.update(state='failed', error=str(e), finished_at=time.time())
+            part.unlink(missing_ok=True)
+
+    @staticmethod
+    def _count(job: Dict, rows: Iterable[Sequence]) -> Iterator[Sequence]:
+        for row in rows:
+            job['rows'] += 1
+            yield row
+
+    def cleanup(self, keep_version: str):
+        """删除其它快照版本的导出目录（本进程中仍在生成的版本除外）"""
+        with self.lock:
+            active = {job['version'] for job in self.jobs.values() if job['state'] in ('queued', 'running')}
+        if not self.root.exists():
+            return
+        for child in self.root.iterdir():
+            if child.is_dir() and child.name != keep_version and child.name not in active:
+                shutil.rmtree(child, ignore_errors=True)
@@ -1,10 +1,8 @@
 # flask_app.py - RAG增强版
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, g, stream_with_context
 import json
-import pandas as pd
 from pathlib import Path
 import os
-import tempfile
 import random
 import re
 from collections import defaultdict
@@ -12,7 +10,27 @@ import hashlib
 import threading
 import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Optional
+from translation import (TranslationMemory, LocalBackend, TieredBackend,
+                         create_translation_backend, static_text, static_label)
+from metrics import (REGISTRY, observe_stage, stage_timer, record_stage, enter_request_scope,
+                     exit_request_scope, count_request_event)
+from embedding_service import EmbeddingClient, EmbeddingServiceError
+from embedding_build import EmbeddingBuilder
+from encoders import load_embedding_model, encoder_spec
+from rerank import EmbeddingReranker, CrossEncoderReranker, cascade_rerank
+from chunking import ChunkStore, chunk_by_tokens, load_tokenizer, token_budget
+from dedup import near_duplicate_groups, representatives, dedup_report
+from partitions import (PartitionIndex, parse_filters, current_filters, set_filters, reset_filters,
+                        corpus_excluded, text_language)
+from sharding import ShardCoordinator, keyword_scores, shard_authkey
+from profiling import RequestProfiler, MemorySnapshots, traced, map_with_context, deep_sizeof
+from request_log import RequestLogger, result_id, top_queries, worker_log_path
+from export_jobs import ExportManager, ExportTable, FORMATS as EXPORT_FORMATS, iter_csv, iter_jsonl
+from admission import (LoadShedder, StageLimiter, DegradationController, Deadline,
+                       SKIP_TRANSLATION, SKIP_SEMANTIC, KEYWORD_ONLY, degradation_level,
+                       set_degradation_level, reset_degradation_level, remaining_budget, deadline_expired)
 
 app = Flask(__name__)
 
@@ -20,141 +38,318 @@ app = Flask(__name__)
 BASE_DIR = Path(__file__).parent.absolute()
 CORPUS_PATH = BASE_DIR / "data" / "raw" / "medical_corpus.json"
 QUESTIONS_PATH = BASE_DIR / "data" / "raw" / "medical_questions.json"
+MEDICAL_TERMS_PATH = BASE_DIR / "medical_terms.json"
 
 # ========== RAG配置 ==========
 RAG_CONFIG = {
-    'chunk_size': 500,  # 每个chunk的字符数
-    'chunk_overlap': 50,  # chunk之间的重叠字符数
+    'chunking': 'tokens',  # 切分方式: tokens（按嵌入模型token数） / chars（按字符数，旧方式）
+    'chunk_max_tokens': None,  # 每个chunk的token上限（None表示模型的 max_seq_length 扣除特殊token）
+    'chunk_overlap_tokens': 32,  # chunk之间重叠的token数（按整句重叠）
+    'chunk_tokenizer': os.environ.get('RAG_CHUNK_TOKENIZER', ''),  # 未加载嵌入模型时用于计数的tokenizer（空表示同 embedding_model）
+    'dedup_threshold': 0.8,  # 近似重复判定的MinHash相似度，每组只索引一条（0表示不去重）
+    'dedup_num_perm': 64,  # MinHash签名长度
+    'chunk_size': 500,  # 每个chunk的字符数（chars方式）
+    'chunk_overlap': 50,  # chunk之间的重叠字符数（chars方式）
     'top_k_retrieval': 3,  # 检索返回的chunk数量
-    'embedding_model': 'all-MiniLM-L6-v2',  # 轻量级嵌入模型
+    'rerank': os.environ.get('RAG_RERANK', 'none'),  # 第二阶段重排: none / embedding（全精度嵌入） / cross-encoder
+    'rerank_candidates': 20,  # 第一阶段为重排多取的候选数
+    'rerank_budget_ms': 50.0,  # 每个查询的重排预算（毫秒），用完后剩余候选保持第一阶段顺序
+    'rerank_budget_clock': 'wall',  # 预算计时: wall（墙钟） / cpu（本线程CPU时间）
+    'rerank_batch_size': 8,  # 每批打分的候选数（每批之前检查预算）
+    'rerank_max_chars': 2000,  # 候选文本截断长度
+    'rerank_model': 'cross-encoder/ms-marco-MiniLM-L-6-v2',  # cross-encoder 重排模型
+    'embedding_model': os.environ.get('RAG_EMBEDDING_MODEL', 'all-MiniLM-L6-v2'),  # 轻量级嵌入模型（none表示不加载）
+    'embedding_backend': os.environ.get('RAG_EMBEDDING_BACKEND', 'torch'),  # 推理后端: torch / onnx / onnx-int8（见 encoders.py）
+    'embedding_export_dir': 'cache/onnx',  # ONNX导出目录
+    'embedding_server': os.environ.get('RAG_EMBEDDING_SERVER', ''),  # 进程外嵌入服务地址（unix:/path 或 host:port，空表示进程内编码）
+    'embedding_pool_size': 4,  # 到嵌入服务的连接数
+    'embedding_timeout': 2.0,  # 每32个文本等待嵌入服务的时间（秒），超时回退到进程内编码
+    'embedding_checkpoint_dir': os.environ.get('RAG_EMBEDDING_CHECKPOINT_DIR', 'cache/embeddings'),  # 构建向量的分批缓存/断点目录（none表示不缓存）
+    'embedding_build_workers': int(os.environ.get('RAG_BUILD_WORKERS', '1')),  # 构建向量的编码进程数（>1时各进程加载模型）
+    'embedding_build_batch': 64,  # 构建向量时每批的文本数（按长度分桶）
+    'shards': [a for a in os.environ.get('RAG_SHARDS', '').split(',') if a],  # 分片检索进程地址（空表示不分片）
+    'shard_timeout': 1.0,  # 等待各分片的最长时间（秒），超时的分片跳过
+    'shard_pool_size': 4,  # 到每个分片的连接数
     'use_semantic_search': True,  # 是否使用语义搜索
     'hybrid_search': True,  # 是否使用混合搜索
+    'translation_memory_size': 20000,  # 翻译记忆最多缓存的句子数
+    'translation_backend': 'tiered',  # 翻译后端: local / remote / tiered / stub
+    'translation_latency_budget': 3.0,  # 分级后端中远程翻译的延迟预算（秒）
+    'max_batch_size': 256,  # 批量查询单次最多的问题数
+    'batch_lexical_workers': 4,  # 批量查询中并行执行关键词/问题库检索的线程数
+    'profile_sample_rate': 0.0,  # 随机剖析的请求比例（0表示只在带特权请求头时剖析）
+    'profile_mode': 'both',  # 剖析方式: trace / cprofile / both
+    'profile_dir': 'profiles',  # 剖析结果目录（相对项目根目录）
+    'profile_max_files': 200,  # 最多保留的剖析结果数
+    'request_log_path': os.environ.get('RAG_REQUEST_LOG', 'logs/query_log.jsonl'),  # 请求日志（"none"表示不记录）
+    'request_log_max_bytes': 50 * 1024 * 1024,  # 单个日志文件上限，超过后轮转
+    'request_log_backups': 5,  # 保留的轮转文件数
+    'request_log_buffer': 10000,  # 日志缓冲区大小（满了丢弃，不阻塞请求）
+    'prewarm_top_queries': int(os.environ.get('RAG_PREWARM_TOP_N', '0')),  # 启动时用最常见的N个历史查询预热缓存
+    'max_in_flight': 32,  # 同时处理的查询请求上限，超过直接返回503
+    'max_translation_queue': 200,  # 翻译队列积压上限，超过直接返回503
+    'stage_concurrency': {'translation': 8, 'embedding': 4},  # 各阶段同时进入的线程数上限（翻译队列按 translation 启动工作线程）
+    'stage_wait': 0.5,  # 等待阶段许可的最长时间（秒），超时走降级路径
+    'degradation_enabled': True,  # 是否按实时延迟自动降级
+    'degradation_thresholds': [2.0, 4.0, 8.0],  # 升到1/2/3级的p95延迟阈值（秒）
+    'request_deadline': 10.0,  # 单个查询的默认总时限（秒），客户端可用 deadline_ms 指定
+    'max_request_deadline': 60.0,  # 客户端可指定的最大时限（秒）
+    'translation_timeout': 5.0,  # 单次翻译等待的上限（秒），不超过请求剩余时间
+    'async_cpu_workers': 4,  # ASGI入口：编码/faiss/关键词检索的线程数
+    'async_translation_workers': 16,  # ASGI入口：同时进行的翻译调用数
+    'async_max_in_flight': 2000,  # ASGI入口：同时处理的查询请求上限
+    'dashboard_max_age': 30,  # /api/status、/api/stats、/api/sample 响应的 Cache-Control 缓存时间（秒）
+    'dashboard_sample_size': 50,  # /api/sample 返回的样本数
+    'export_dir': 'cache/exports',  # 导出文件的缓存目录（按数据快照版本分目录，只保留当前版本）
 }
 
 # ========== 向量存储和嵌入模型 ==========
+import numpy as np
 try:
-    from sentence_transformers import SentenceTransformer
-    import numpy as np
-    try:
-        import faiss
-        HAS_FAISS = True
-    except ImportError:
-        import subprocess, sys
-        subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'faiss-cpu'])
-        import faiss
-        HAS_FAISS = True
-    
-    # 初始化嵌入模型
-    print("🔄 正在加载嵌入模型...")
-    embedding_model = SentenceTransformer(RAG_CONFIG['embedding_model'])
-    print("✅ 嵌入模型加载完成")
-    
-    # 向量存储
-    vector_store = {
-        'corpus_chunks': [],
-        'corpus_embeddings': None,
-        'corpus_faiss_index': None,
-        'question_embeddings': None,
-        'questions': [],
-        'question_faiss_index': None
-    }
-    
-    HAS_EMBEDDING = True
-except ImportError as e:
-    print(f"⚠️  未安装sentence-transformers: {e}")
-    print("  使用 pip install sentence-transformers 安装")
+    import faiss
+    HAS_FAISS = True
+except ImportError:
+    import subprocess, sys
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install', 'faiss-cpu'])
+    import faiss
+    HAS_FAISS = True
+
+# 分片检索：语料库的语义和关键词检索由分片进程完成，本进程只保留问题库索引
+shard_coordinator = (ShardCoordinator(RAG_CONFIG['shards'], shard_authkey(), RAG_CONFIG['shard_pool_size'])
+                     if RAG_CONFIG['shards'] else None)
+
+# 向量存储
+vector_store = {
+    'corpus_chunks': [],
+    'corpus_embeddings': None,
+    'corpus_faiss_index': None,
+    'corpus_partitions': None,
+    'question_embeddings': None,
+    'questions': [],
+    'question_faiss_index': None
+}
+
+embedding_client = None
+embedding_model_lock = threading.Lock()
+if RAG_CONFIG['embedding_model'] == 'none':
+    print("⚠️  RAG_EMBEDDING_MODEL=none，未加载嵌入模型")
     HAS_EMBEDDING = False
     embedding_model = None
-    vector_store = None
+elif RAG_CONFIG['embedding_server']:
+    # 模型由嵌入服务持有，本进程只在服务不可用时才加载（load_local_embedding_model）
+    embedding_client = EmbeddingClient(RAG_CONFIG['embedding_server'], RAG_CONFIG['embedding_pool_size'],
+                                       RAG_CONFIG['embedding_timeout'])
+    print(f"✅ 使用嵌入服务: {RAG_CONFIG['embedding_server']}")
+    HAS_EMBEDDING = True
+    embedding_model = None
+else:
+    try:
+        # 初始化嵌入模型
+        print("🔄 正在加载嵌入模型...")
+        embedding_model = load_embedding_model(RAG_CONFIG['embedding_model'], RAG_CONFIG['embedding_backend'],
+                                               BASE_DIR / RAG_CONFIG['embedding_export_dir'])
+        print("✅ 嵌入模型加载完成")
+        
+        HAS_EMBEDDING = True
+    except ImportError as e:
+        print(f"⚠️  未安装sentence-transformers: {e}")
+        print("  使用 pip install sentence-transformers 安装")
+        HAS_EMBEDDING = False
+        embedding_model = None
+
+def set_embedding_model(model):
+    """替换嵌入模型（如压测用的桩编码器），需在构建向量存储之前调用"""
+    global embedding_model, HAS_EMBEDDING
+    embedding_model = model
+    HAS_EMBEDDING = model is not None
+
+def load_local_embedding_model():
+    """嵌入服务不可用时按需加载进程内模型（只加载一次）"""
+    global embedding_model
+    if embedding_model is None:
+        with embedding_model_lock:
+            if embedding_model is None:
+                try:
+                    print("🔄 嵌入服务不可用，正在加载进程内嵌入模型...")
+                    embedding_model = load_embedding_model(RAG_CONFIG['embedding_model'], RAG_CONFIG['embedding_backend'],
+                                                           BASE_DIR / RAG_CONFIG['embedding_export_dir'])
+                except Exception as e:
+                    print(f"加载进程内嵌入模型失败: {e}")
+                    return None
+    return embedding_model
 
 # ========== 翻译队列系统（避免卡顿） ==========
 class TranslationQueue:
-    def __init__(self):
+    """批量翻译队列：workers 个工作线程从队列取任务交给后端（与翻译阶段的并发上限一致）"""
+    def __init__(self, backend, workers=1):
+        self.backend = backend  # 可在运行时替换（如压测时换成StubBackend）
+        self.workers = workers
         self.queue = queue.Queue()
-        self.results = {}
-        self.worker_thread = None
+        self.batch_events = {}  # task_id -> (完成事件, 结果容器)，等待方超时后移除
+        self.abandoned = 0
+        self.worker_threads = []
         self.start_worker()
     
     def start_worker(self):
         """启动翻译工作线程"""
-        self.worker_thread = threading.Thread(target=self._translation_worker, daemon=True)
-        self.worker_thread.start()
-        print("✅ 翻译队列工作线程已启动")
+        self.worker_threads = [threading.Thread(target=self._translation_worker, name=f'translation-{i}', daemon=True)
+                               for i in range(self.workers)]
+        for thread in self.worker_threads:
+            thread.start()
+        print(f"✅ 翻译队列工作线程已启动（{self.workers} 个）")
     
     def _translation_worker(self):
         """翻译工作线程"""
-        from translate import Translator
-        
-        # 创建translator实例
-        translator_en_to_zh = Translator(to_lang="zh", from_lang="en")
-        translator_zh_to_en = Translator(to_lang="en", from_lang="zh")
-        
         while True:
             try:
                 task = self.queue.get()
                 if task is None:  # 停止信号
                     break
-                    
-                task_id, text, direction = task
                 
+                task_id, texts, direction = task
+                if task_id not in self.batch_events:
+                    # 等待方已超时：跳过，不占用工作线程
+                    self.abandoned += 1
+                    self.queue.task_done()
+                    continue
+                
+                # 多句一次交给后端
                 try:
-                    if direction == 'en_to_zh':
-                        result = translator_en_to_zh.translate(text)
-                    else:  # zh_to_en
-                        result = translator_zh_to_en.translate(text)
-                    
-                    self.results[task_id] = result
+                    batch_result = self.backend.translate_batch(texts, direction)
                 except Exception as e:
-                    print(f"翻译失败 ({direction}): {e}")
-                    self.results[task_id] = text  # 失败时返回原文本
-                    
+                    print(f"批量翻译失败 ({direction}): {e}")
+                    batch_result = [None] * len(texts)
+                waiter = self.batch_events.pop(task_id, None)
+                if waiter is not None:  # 等待方已超时则丢弃结果
+                    done, holder = waiter
+                    holder.append(batch_result)
+                    done.set()
                 self.queue.task_done()
                 
             except Exception as e:
                 print(f"翻译工作线程错误: {e}")
     
-    def translate(self, text, direction='en_to_zh', timeout=10):
-        """提交翻译任务（异步）"""
-        if not text or not any('a' <= char.lower() <= 'z' for char in text) if direction == 'en_to_zh' else not any('\u4e00' <= char <= '\u9fff' for char in text):
-            return text
-        
-        task_id = hashlib.md5(f"{text}_{direction}".encode()).hexdigest()
+    @traced('translation_queue.translate_batch')
+    def translate_batch(self, texts, direction='en_to_zh', timeout=10):
+        """提交批量翻译任务，返回与texts等长的译文列表（超时或失败的句子为None）"""
+        if not texts:
+            return []
         
-        # 如果已经有结果，直接返回
-        if task_id in self.results:
-            return self.results[task_id]
+        done = threading.Event()
+        holder = []
+        task_id = f"batch_{id(done)}"  # 批量任务不复用结果，使用唯一ID
+        self.batch_events[task_id] = (done, holder)
+        self.queue.put((task_id, list(texts), direction))
         
-        # 提交任务到队列
-        self.queue.put((task_id, text, direction))
+        if not done.wait(timeout):
+            self.batch_events.pop(task_id, None)
+            TRANSLATION_TIMEOUTS.inc(kind='batch')
+            print(f"批量翻译超时: {len(texts)} 句")
+            return [None] * len(texts)
         
-        # 等待结果（带超时）
-        start_time = time.time()
-        while task_id not in self.results:
-            if time.time() - start_time > timeout:
-                print(f"翻译超时: {text[:50]}...")
-                return text  # 超时返回原文本
-            time.sleep(0.1)
-        
-        return self.results.get(task_id, text)
+        return holder[0]
 
-# 初始化翻译队列
+# 初始化翻译后端和翻译队列
 try:
     from translate import Translator
-    translation_queue = TranslationQueue()
     HAS_TRANSLATE = True
+    translation_backend_name = RAG_CONFIG['translation_backend']
     print("✅ translate库已成功初始化（使用队列系统）")
 except ImportError as e:
     HAS_TRANSLATE = False
-    print(f"⚠️  translate库未安装: {e}")
-    translation_queue = None
+    print(f"⚠️  translate库未安装: {e}，使用本地离线翻译")
+    translation_backend_name = 'local' if RAG_CONFIG['translation_backend'] in ('remote', 'tiered') else RAG_CONFIG['translation_backend']
+
+translation_backend = create_translation_backend(
+    translation_backend_name,
+    terms_path=str(MEDICAL_TERMS_PATH),
+    latency_budget=RAG_CONFIG['translation_latency_budget']
+)
+translation_queue = TranslationQueue(translation_backend, RAG_CONFIG['stage_concurrency']['translation'])
+print(f"✅ 翻译后端: {translation_backend.name}")
+
+# 阶段并发上限
+translation_limiter = StageLimiter('translation', RAG_CONFIG['stage_concurrency']['translation'])
+embedding_limiter = StageLimiter('embedding', RAG_CONFIG['stage_concurrency']['embedding'])
+
+# 句级翻译记忆（静态双语表已预置）
+translation_memory = TranslationMemory(RAG_CONFIG['translation_memory_size'])
+translation_memory.listener = lambda hit: count_request_event(
+    'translation_memory_hit' if hit else 'translation_memory_miss'
+)
+
+@observe_stage('translation')
+@traced('translate_with_memory')
+def translate_with_memory(text, direction, timeout=5, deadline=None):
+    """按句查翻译记忆，只把未命中的句子批量送去翻译（降级、翻译阶段满载或时限用完时只用翻译记忆）"""
+    def translate_missing(segments, seg_direction):
+        if degradation_level() >= SKIP_TRANSLATION or deadline_expired(deadline):
+            count_request_event('translation_skipped', len(segments))
+            return [None] * len(segments)
+        if not translation_limiter.acquire(remaining_budget(deadline, RAG_CONFIG['stage_wait'])):
+            count_request_event('translation_skipped', len(segments))
+            return [None] * len(segments)
+        try:
+            budget = remaining_budget(deadline, timeout)
+            if budget <= 0:
+                count_request_event('translation_skipped', len(segments))
+                return [None] * len(segments)
+            return translation_queue.translate_batch(segments, seg_direction, timeout=budget)
+        finally:
+            translation_limiter.release()
+    return translation_memory.translate(text, direction, translate_missing)
+
+# ========== 运行指标 ==========
+REQUESTS_TOTAL = REGISTRY.counter(
+    'rag_requests_total', 'Query requests by endpoint and mode', ('endpoint', 'mode')
+)
+TRANSLATION_TIMEOUTS = REGISTRY.counter(
+    'rag_translation_timeouts_total', 'Translation queue waits that ran out of time', ('kind',)
+)
+
+def _translation_memory_events():
+    stats = translation_memory.stats()
+    return {('translation_memory', 'hit'): stats['hits'], ('translation_memory', 'miss'): stats['misses']}
+
+def _translation_backend_events():
+    backend = translation_queue.backend
+    return dict(backend.stats) if isinstance(backend, TieredBackend) else {}
+
+def _index_sizes():
+    sizes = {
+        'corpus_chunks': len(vector_store['corpus_chunks']),
+        'questions': len(GLOBAL_QUESTIONS_DATA['all_questions']) if GLOBAL_QUESTIONS_DATA else 0,
+    }
+    for name in ('corpus_faiss_index', 'question_faiss_index'):
+        index = vector_store.get(name)
+        sizes[name] = index.ntotal if index is not None else 0
+    return sizes
+
+REGISTRY.callback('rag_cache_events_total', 'Cache lookups by cache and result',
+                  _translation_memory_events, ('cache', 'result'), metric_type='counter')
+REGISTRY.callback('rag_translation_backend_events_total',
+                  'Tiered translation backend events (local hits, remote calls, timeouts, fallbacks)',
+                  _translation_backend_events, ('event',), metric_type='counter')
+REGISTRY.callback('rag_index_size', 'Number of entries in each in-memory index',
+                  _index_sizes, ('index',))
+REGISTRY.callback('rag_translation_queue_depth', 'Pending tasks in the translation queue',
+                  lambda: {(): translation_queue.queue.qsize()})
+REGISTRY.callback('rag_translation_abandoned_total', 'Queued translation batches skipped because the caller timed out',
+                  lambda: {(): translation_queue.abandoned}, metric_type='counter')
+REGISTRY.callback('rag_embedding_service_requests_total', 'Embedding service client requests and failures',
+                  lambda: embedding_client.stats() if embedding_client else {}, ('result',), metric_type='counter')
 
 # ========== 文档处理函数 ==========
 def split_text_into_chunks(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> List[str]:
     """将文本分割成chunks"""
+    return [text[start:end] for start, end in split_text_into_spans(text, chunk_size, chunk_overlap)]
+
+def split_text_into_spans(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> List[Tuple[int, int]]:
+    """将文本分割成chunks，返回每个chunk在原文中的 (start, end) 偏移（已去除首尾空白）"""
     if not text:
         return []
     
-    chunks = []
+    spans = []
     start = 0
     text_length = len(text)
     
@@ -171,68 +366,147 @@ def split_text_into_chunks(text: str, chunk_size: int = 500, chunk_overlap: int
                     end = sep_pos + 1
                     break
         
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
+        chunk = text[start:end]
+        stripped = chunk.strip()
+        if stripped:
+            chunk_start = start + len(chunk) - len(chunk.lstrip())
+            spans.append((chunk_start, chunk_start + len(stripped)))
         
         # 移动开始位置，考虑重叠
         start = end - chunk_overlap
     
-    return chunks
+    return spans
+
+CHUNK_REPORT = {}
+DEDUP_REPORT = {}
+_chunk_tokenizers = {}
+
+def chunk_tokenizer():
+    """切分用的 (tokenizer, 每个chunk的token上限)：优先用已加载的嵌入模型，否则只加载tokenizer"""
+    model = embedding_model
+    tokenizer = getattr(model, 'tokenizer', None)
+    if tokenizer is None:
+        name = RAG_CONFIG['chunk_tokenizer'] or RAG_CONFIG['embedding_model']
+        if name != 'none' and not name.startswith('stub'):
+            if name not in _chunk_tokenizers:
+                _chunk_tokenizers[name] = load_tokenizer(name)
+            tokenizer = _chunk_tokenizers[name]
+    return tokenizer, token_budget(getattr(model, 'max_seq_length', None), RAG_CONFIG['chunk_max_tokens'])
 
-def create_corpus_chunks(corpus_data: Dict) -> List[Dict]:
-    """创建语料库chunks"""
+def create_corpus_chunks(corpus_data: Dict) -> ChunkStore:
+    """创建语料库chunks（默认按嵌入模型的token数切分，不超过模型的序列长度）：
+    只保存 full_content 上的偏移，chunk文本在检索返回时才切片"""
     if not corpus_data or 'full_content' not in corpus_data:
-        return []
+        return ChunkStore('', [])
     
     full_content = corpus_data['full_content']
-    raw_chunks = split_text_into_chunks(
-        full_content, 
-        RAG_CONFIG['chunk_size'], 
-        RAG_CONFIG['chunk_overlap']
-    )
-    
-    chunks = []
-    for i, chunk_text in enumerate(raw_chunks):
-        chunks.append({
-            'id': f'chunk_{i:04d}',
-            'text': chunk_text,
-            'char_count': len(chunk_text),
-            'word_count': len(chunk_text.split()),
-            'chunk_index': i,
-            'source': 'corpus'
-        })
-    
-    print(f"📄 已将语料库分割成 {len(chunks)} 个chunks")
+    if RAG_CONFIG['chunking'] == 'chars':
+        spans = [(start, end, None) for start, end in split_text_into_spans(
+            full_content, 
+            RAG_CONFIG['chunk_size'], 
+            RAG_CONFIG['chunk_overlap']
+        )]
+        report = {'chunks': len(spans)}
+    else:
+        tokenizer, budget = chunk_tokenizer()
+        spans, report = chunk_by_tokens(full_content, tokenizer, budget, RAG_CONFIG['chunk_overlap_tokens'])
+    CHUNK_REPORT.clear()
+    CHUNK_REPORT.update(report, mode=RAG_CONFIG['chunking'])
+    
+    chunks = ChunkStore.from_spans(full_content, spans)
+    if RAG_CONFIG['dedup_threshold']:
+        groups = near_duplicate_groups(chunks.texts(), RAG_CONFIG['dedup_threshold'], RAG_CONFIG['dedup_num_perm'])
+        DEDUP_REPORT['corpus'] = dedup_report(len(chunks), groups)
+        chunks = chunks.select(*representatives(groups))
+        if DEDUP_REPORT['corpus']['removed']:
+            print(f"   近似重复chunks: {DEDUP_REPORT['corpus']['removed']} 个并入代表，不单独索引")
+    
+    if 'tokens' in report:
+        print(f"📄 已将语料库分割成 {len(chunks)} 个chunks（共 {report['tokens']} tokens，"
+              f"最大 {report['max_chunk_tokens']}/{report['token_budget']}，{report['tokenizer']}计数）")
+    else:
+        print(f"📄 已将语料库分割成 {len(chunks)} 个chunks")
     return chunks
 
 # ========== 向量化函数 ==========
+@traced('compute_embeddings')
 def compute_embeddings(texts: List[str]) -> np.ndarray:
-    """计算文本的嵌入向量"""
-    if not HAS_EMBEDDING or not embedding_model:
+    """查询路径的编码：受编码阶段并发上限约束，拿不到许可时返回None（调用方跳过语义检索）"""
+    if not HAS_EMBEDDING:
+        return None
+    if not embedding_limiter.acquire(RAG_CONFIG['stage_wait']):
+        count_request_event('embedding_rejected')
         return None
-    
     try:
+        return encode_texts(texts)
+    finally:
+        embedding_limiter.release()
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """计算文本的嵌入向量（配置了嵌入服务时优先走服务，失败回退到进程内模型）；
+    构建索引直接调用，不占用查询的编码并发许可"""
+    if not HAS_EMBEDDING:
+        return None
+    try:
+        if embedding_client is not None and embedding_client.available():
+            try:
+                timeout = RAG_CONFIG['embedding_timeout'] * max(1, len(texts) / 32)
+                return embedding_client.encode(texts, timeout)
+            except EmbeddingServiceError as e:
+                count_request_event('embedding_fallback')
+                print(f"嵌入服务调用失败，回退到进程内编码: {e}")
+        model = embedding_model if embedding_model is not None else load_local_embedding_model()
+        if model is None:
+            return None
         # 批量计算嵌入
-        embeddings = embedding_model.encode(texts, show_progress_bar=False)
+        embeddings = model.encode(texts, show_progress_bar=False)
         return embeddings
     except Exception as e:
         print(f"计算嵌入失败: {e}")
         return None
 
+def question_text(q: Dict) -> str:
+    """问题库条目用于向量检索和近似重复检测的文本（问题+答案）"""
+    return f"问题: {q.get('raw_question', '')}\n答案: {q.get('raw_answer', '')}"
+
+def search_questions(questions_data: Dict) -> List[Dict]:
+    """参与检索的问题（每组近似重复只保留代表）"""
+    questions_data = questions_data or {}
+    return questions_data.get('search_questions', questions_data.get('all_questions', []))
+
+def question_texts(questions_data: Dict) -> List[str]:
+    """问题库中用于向量检索的文本（问题+答案）"""
+    return [question_text(q) for q in search_questions(questions_data)]
+
+def encode_for_index(name: str, texts: List[str]) -> Optional[np.ndarray]:
+    """构建索引用的向量：按长度分桶、分批写入checkpoint（中断后续算、重启时复用），可多进程并行"""
+    if RAG_CONFIG['embedding_checkpoint_dir'] == 'none':
+        return encode_texts(texts)
+    model_name = encoder_spec(RAG_CONFIG['embedding_model'], RAG_CONFIG['embedding_backend'])  # 后端不同，向量也不同
+    workers = RAG_CONFIG['embedding_build_workers']
+    if RAG_CONFIG['embedding_model'] == 'none':  # 桩编码器等替换的模型只能在本进程内编码
+        model_name, workers = type(embedding_model).__name__, 1
+    elif embedding_client is not None:
+        workers = 1  # 交给嵌入服务
+    builder = EmbeddingBuilder(BASE_DIR / RAG_CONFIG['embedding_checkpoint_dir'], model_name,
+                               RAG_CONFIG['embedding_build_batch'], workers, encode=encode_texts)
+    embeddings, _ = builder.build(name, texts)
+    return embeddings
+
 def build_vector_store(corpus_data: Dict, questions_data: Dict):
     """构建向量存储（含faiss索引）"""
     if not HAS_EMBEDDING:
         return
     print("🔄 正在构建向量存储...")
-    # 处理语料库
-    if corpus_data:
+    # 处理语料库（分片部署时由分片进程持有）
+    if corpus_data and shard_coordinator is None:
         corpus_chunks = create_corpus_chunks(corpus_data)
         if corpus_chunks:
-            chunk_texts = [chunk['text'] for chunk in corpus_chunks]
-            corpus_embeddings = compute_embeddings(chunk_texts)
+            chunk_texts = corpus_chunks.texts()
+            corpus_embeddings = encode_for_index('corpus', chunk_texts)
             vector_store['corpus_chunks'] = corpus_chunks
             vector_store['corpus_embeddings'] = corpus_embeddings
+            vector_store['corpus_partitions'] = corpus_partitions(chunk_texts)
             # 构建faiss索引
             if HAS_FAISS and corpus_embeddings is not None:
                 dim = corpus_embeddings.shape[1]
@@ -242,15 +516,10 @@ def build_vector_store(corpus_data: Dict, questions_data: Dict):
             print(f"   ✓ 语料库向量: {len(corpus_chunks)} chunks")
     # 处理问题
     if questions_data and 'all_questions' in questions_data:
-        questions = []
-        for q in questions_data['all_questions']:
-            question_text = q.get('raw_question', '')
-            answer_text = q.get('raw_answer', '')
-            combined_text = f"问题: {question_text}\n答案: {answer_text}"
-            questions.append(combined_text)
+        questions = question_texts(questions_data)
         if questions:
-            question_embeddings = compute_embeddings(questions)
-            vector_store['questions'] = questions_data['all_questions']
+            question_embeddings = encode_for_index('questions', questions)
+            vector_store['questions'] = search_questions(questions_data)
             vector_store['question_embeddings'] = question_embeddings
             # 构建faiss索引
             if HAS_FAISS and question_embeddings is not None:
@@ -262,86 +531,151 @@ def build_vector_store(corpus_data: Dict, questions_data: Dict):
     print("✅ 向量存储构建完成")
 
 # ========== 检索函数 ==========
+def corpus_partitions(texts: List[str]) -> PartitionIndex:
+    """语料库chunks / 段落的分区：source 固定为 corpus，language 按文本检测"""
+    return PartitionIndex({'source': ['corpus'] * len(texts), 'language': [text_language(t) for t in texts]})
+
+def filtered_rows(partitions: Optional[PartitionIndex]) -> Optional[np.ndarray]:
+    """当前请求的过滤条件下可检索的行号（None 表示不过滤）"""
+    filters = current_filters()
+    if not filters or partitions is None:
+        return None
+    return partitions.select(filters)
+
+def faiss_search(index, query_matrix: np.ndarray, top_k: int, rows: Optional[np.ndarray] = None):
+    """faiss检索；rows 不为 None 时用位图预过滤，只计算这些行的距离"""
+    if rows is None:
+        return index.search(query_matrix, top_k)
+    bitmap = vector_store['corpus_partitions'].bitmap(rows)
+    params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap)))
+    return index.search(query_matrix, min(top_k, len(rows)), params=params)
+
+def _semantic_result(texts: List[Dict], idx: int, similarity: float) -> Dict:
+    """构造一条语义搜索结果（ChunkStore 在这里才切出chunk文本）"""
+    item = texts[idx]
+    return {
+        'text': item['text'] if isinstance(item, dict) else item,
+        'metadata': item if isinstance(item, dict) else {},
+        'similarity': similarity,
+        'source': 'semantic_search'
+    }
+
+@traced('semantic_search')
 def semantic_search(query: str, embeddings: np.ndarray, texts: List[Dict], top_k: int = 3) -> List[Dict]:
     """语义搜索（faiss加速）"""
     if not HAS_EMBEDDING or embeddings is None:
         return []
+    rows = filtered_rows(vector_store.get('corpus_partitions'))
+    if rows is not None and len(rows) == 0:
+        return []
     try:
-        query_embedding = embedding_model.encode([query])[0]
+        with stage_timer('embedding'):
+            query_embeddings = compute_embeddings([query])
+        if query_embeddings is None:
+            return []
+        query_embedding = query_embeddings[0]
         if HAS_FAISS and vector_store.get('corpus_faiss_index') is not None:
-            D, I = vector_store['corpus_faiss_index'].search(np.array([query_embedding], dtype=np.float32), top_k)
+            with stage_timer('faiss_search'):
+                D, I = faiss_search(vector_store['corpus_faiss_index'],
+                                    np.array([query_embedding], dtype=np.float32), top_k, rows)
             results = []
             for idx, dist in zip(I[0], D[0]):
-                if idx < len(texts):
-                    results.append({
-                        'text': texts[idx]['text'] if isinstance(texts[idx], dict) else texts[idx],
-                        'metadata': texts[idx] if isinstance(texts[idx], dict) else {},
-                        'similarity': float(-dist),
-                        'source': 'semantic_search'
-                    })
+                if 0 <= idx < len(texts):
+                    results.append(_semantic_result(texts, idx, float(-dist)))
             return results
         else:
-            # fallback: numpy
-            similarities = np.dot(embeddings, query_embedding) / (
-                np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_embedding)
+            # fallback: numpy（有过滤条件时只计算选中的行）
+            candidates = embeddings if rows is None else np.asarray(embeddings)[rows]
+            similarities = np.dot(candidates, query_embedding) / (
+                np.linalg.norm(candidates, axis=1) * np.linalg.norm(query_embedding)
             )
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
+            top_positions = np.argsort(similarities)[-top_k:][::-1]
             results = []
-            for idx in top_indices:
+            for pos in top_positions:
+                idx = pos if rows is None else rows[pos]
                 if idx < len(texts):
-                    results.append({
-                        'text': texts[idx]['text'] if isinstance(texts[idx], dict) else texts[idx],
-                        'metadata': texts[idx] if isinstance(texts[idx], dict) else {},
-                        'similarity': float(similarities[idx]),
-                        'source': 'semantic_search'
-                    })
+                    results.append(_semantic_result(texts, idx, float(similarities[pos])))
             return results
     except Exception as e:
         print(f"语义搜索失败: {e}")
         return []
 
+@traced('semantic_search_batch')
+def semantic_search_batch(queries: List[str], embeddings: np.ndarray, texts: List[Dict], top_k: int = 3) -> List[List[Dict]]:
+    """批量语义搜索：一次编码所有查询，一次faiss检索整个查询矩阵"""
+    empty = [[] for _ in queries]
+    if not HAS_EMBEDDING or embeddings is None or not queries:
+        return empty
+    rows = filtered_rows(vector_store.get('corpus_partitions'))
+    if rows is not None and len(rows) == 0:
+        return empty
+    try:
+        with stage_timer('embedding'):
+            query_embeddings = compute_embeddings(queries)
+        if query_embeddings is None:
+            return empty
+        query_matrix = np.array(query_embeddings, dtype=np.float32)
+        if HAS_FAISS and vector_store.get('corpus_faiss_index') is not None:
+            with stage_timer('faiss_search'):
+                D, I = faiss_search(vector_store['corpus_faiss_index'], query_matrix, top_k, rows)
+            scores = -D
+        else:
+            # fallback: numpy，整体矩阵乘法（有过滤条件时只计算选中的行）
+            candidates = np.asarray(embeddings) if rows is None else np.asarray(embeddings)[rows]
+            similarities = np.dot(query_matrix, candidates.T) / (
+                np.linalg.norm(query_matrix, axis=1)[:, None] * np.linalg.norm(candidates, axis=1)[None, :]
+            )
+            I = np.argsort(similarities, axis=1)[:, -top_k:][:, ::-1]
+            scores = np.take_along_axis(similarities, I, axis=1)
+            if rows is not None:
+                I = rows[I]
+        
+        batch_results = []
+        for row_indices, row_scores in zip(I, scores):
+            batch_results.append([
+                _semantic_result(texts, idx, float(score))
+                for idx, score in zip(row_indices, row_scores)
+                if 0 <= idx < len(texts)
+            ])
+        return batch_results
+    except Exception as e:
+        print(f"批量语义搜索失败: {e}")
+        return empty
+
+@observe_stage('keyword_search')
+@traced('keyword_search')
 def keyword_search(query: str, texts: List[Dict], top_k: int = 3) -> List[Dict]:
-    """关键词搜索"""
-    query_terms = query.lower().split()
+    """关键词搜索（打分规则与分片进程共用 sharding.keyword_scores）"""
+    plain_texts = [text_item.get('text', '') if isinstance(text_item, dict) else text_item for text_item in texts]
     scored_texts = []
     
-    for i, text_item in enumerate(texts):
-        if isinstance(text_item, dict):
-            text = text_item.get('text', '')
-            metadata = text_item
-        else:
-            text = text_item
-            metadata = {'text': text}
-        
-        text_lower = text.lower()
-        score = 0
-        
-        # 计算匹配分数
-        for term in query_terms:
-            if term in text_lower:
-                score += 1
-            # 部分匹配
-            if len(term) > 3 and any(term in word for word in text_lower.split()):
-                score += 0.5
-        
-        if score > 0:
-            scored_texts.append({
-                'text': text,
-                'metadata': metadata,
-                'score': score,
-                'source': 'keyword_search'
-            })
+    for i, score in keyword_scores(query, plain_texts):
+        text_item = texts[i]
+        scored_texts.append({
+            'text': plain_texts[i],
+            'metadata': text_item if isinstance(text_item, dict) else {'text': text_item},
+            'score': score,
+            'source': 'keyword_search'
+        })
     
     # 按分数排序
     scored_texts.sort(key=lambda x: x['score'], reverse=True)
     return scored_texts[:top_k]
 
-def hybrid_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3) -> List[Dict]:
-    """混合检索：结合语义搜索和关键词搜索"""
+@traced('hybrid_retrieval')
+def hybrid_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                     deadline: Optional[Deadline] = None) -> List[Dict]:
+    """混合检索：结合语义搜索和关键词搜索（时限用完时返回已有结果）"""
+    if shard_coordinator is not None:
+        all_results = sharded_corpus_retrieval([query], top_k, deadline)[0]
+        all_results.extend(question_retrieval(query, questions_data, top_k, deadline))
+        return merge_retrieval_results(all_results, top_k)
+    
     all_results = []
     
-    # 1. 从语料库检索
-    if vector_store and vector_store['corpus_embeddings'] is not None:
+    # 1. 从语料库检索（降级时跳过）
+    if (degradation_level() < SKIP_SEMANTIC and not deadline_expired(deadline)
+            and vector_store and vector_store['corpus_embeddings'] is not None):
         semantic_results = semantic_search(
             query, 
             vector_store['corpus_embeddings'],
@@ -350,32 +684,128 @@ def hybrid_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k:
         )
         all_results.extend(semantic_results)
     
+    # 2-3. 关键词 + 问题库检索
+    all_results.extend(lexical_retrieval(query, corpus_data, questions_data, top_k=top_k, deadline=deadline))
+    
+    return merge_retrieval_results(all_results, top_k)
+
+@traced('hybrid_retrieval_batch')
+def hybrid_retrieval_batch(queries: List[str], corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                           deadline: Optional[Deadline] = None) -> List[List[Dict]]:
+    """批量混合检索：语义部分整体矩阵检索，关键词部分并行执行"""
+    if shard_coordinator is not None:
+        corpus_batch = sharded_corpus_retrieval(queries, top_k, deadline)
+        question_batch = map_with_context(
+            retrieval_executor, lambda q: question_retrieval(q, questions_data, top_k, deadline), queries
+        )
+        return [merge_retrieval_results(corpus_results + question_results, top_k)
+                for corpus_results, question_results in zip(corpus_batch, question_batch)]
+    
+    if (degradation_level() < SKIP_SEMANTIC and not deadline_expired(deadline)
+            and vector_store and vector_store['corpus_embeddings'] is not None):
+        semantic_batch = semantic_search_batch(
+            queries,
+            vector_store['corpus_embeddings'],
+            vector_store['corpus_chunks'],
+            top_k=top_k
+        )
+    else:
+        semantic_batch = [[] for _ in queries]
+    
+    lexical_batch = map_with_context(
+        retrieval_executor,
+        lambda q: lexical_retrieval(q, corpus_data, questions_data, top_k=top_k, deadline=deadline),
+        queries
+    )
+    
+    return [
+        merge_retrieval_results(semantic_results + lexical_results, top_k)
+        for semantic_results, lexical_results in zip(semantic_batch, lexical_batch)
+    ]
+
+@traced('lexical_retrieval')
+def lexical_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                      deadline: Optional[Deadline] = None) -> List[Dict]:
+    """关键词搜索语料库 + 问题库检索（混合检索中不依赖嵌入的部分）"""
+    all_results = []
+    
     # 2. 关键词搜索语料库
-    if corpus_data and 'paragraphs' in corpus_data:
-        paragraphs = [{'text': p, 'metadata': {}} for p in corpus_data['paragraphs']]
+    if corpus_data and 'paragraphs' in corpus_data and not deadline_expired(deadline):
+        paragraphs = corpus_paragraphs(corpus_data)
         keyword_results = keyword_search(query, paragraphs, top_k=top_k)
         all_results.extend(keyword_results)
     
     # 3. 从问题库检索
-    if RAG_CONFIG['hybrid_search'] and questions_data and 'all_questions' in questions_data:
-        # 使用传统搜索函数
-        search_results = search_in_questions(query, questions_data, answer_language='zh', top_k=top_k)
-        for result in search_results:
-            all_results.append({
-                'text': f"{result.get('display_question', '')}\n{result.get('display_answer', '')}",
-                'metadata': result,
-                'similarity': result.get('confidence', 0.5),
-                'source': 'question_search'
-            })
+    all_results.extend(question_retrieval(query, questions_data, top_k, deadline))
     
-    # 去重和排序
+    return all_results
+
+def corpus_paragraphs(corpus_data: Dict) -> List[Dict]:
+    """关键词检索的语料库段落（只包含符合当前过滤条件的段落）"""
+    paragraphs = corpus_data['paragraphs']
+    rows = filtered_rows(corpus_data.get('paragraph_partitions'))
+    if rows is not None:
+        paragraphs = [paragraphs[i] for i in rows]
+    return [{'text': p, 'metadata': {}} for p in paragraphs]
+
+def question_retrieval(query: str, questions_data: Dict, top_k: int = 3,
+                       deadline: Optional[Deadline] = None) -> List[Dict]:
+    """问题库检索，结果转换成检索上下文"""
+    if RAG_CONFIG['hybrid_search'] and questions_data and 'all_questions' in questions_data and not deadline_expired(deadline):
+        # 使用传统搜索函数
+        search_results = search_in_questions(query, questions_data, answer_language='zh', top_k=top_k, deadline=deadline)
+        return question_results_to_contexts(search_results)
+    return []
+
+@observe_stage('shard_search')
+@traced('sharded_corpus_retrieval')
+def sharded_corpus_retrieval(queries: List[str], top_k: int = 3,
+                             deadline: Optional[Deadline] = None) -> List[List[Dict]]:
+    """分片检索语料库：本进程编码查询，各分片并行做语义和关键词检索（降级时只做关键词）"""
+    if corpus_excluded(current_filters()):
+        return [[] for _ in queries]
+    query_embeddings = None
+    if degradation_level() < SKIP_SEMANTIC and not deadline_expired(deadline) and HAS_EMBEDDING:
+        with stage_timer('embedding'):
+            query_embeddings = compute_embeddings(queries)
+        if query_embeddings is not None:
+            query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+    if deadline_expired(deadline):
+        return [[] for _ in queries]
+    results, _ = shard_coordinator.search_batch(
+        queries, query_embeddings, top_k, remaining_budget(deadline, RAG_CONFIG['shard_timeout'])
+    )
+    return results
+
+def question_results_to_contexts(search_results: List[Dict]) -> List[Dict]:
+    """把问题库检索结果转换成检索上下文"""
+    return [{
+        'text': f"{result.get('display_question', '')}\n{result.get('display_answer', '')}",
+        'metadata': result,
+        'similarity': result.get('confidence', 0.5),
+        'source': 'question_search'
+    } for result in search_results]
+
+def retrieval_key(result: Dict):
+    """检索结果的标识：chunk id / 问题id（近似重复已在建索引时合并），没有id时用文本"""
+    metadata = result.get('metadata')
+    if isinstance(metadata, dict):
+        key = metadata.get('question_id') or metadata.get('id')
+        if key:
+            return result.get('source'), key
+    return result['text']
+
+@observe_stage('fusion')
+@traced('merge_retrieval_results')
+def merge_retrieval_results(all_results: List[Dict], top_k: int = 3) -> List[Dict]:
+    """合并多路检索结果：去重、归一化分数、按置信度排序"""
     unique_results = []
-    seen_texts = set()
+    seen_keys = set()
     
     for result in all_results:
-        text_hash = hashlib.md5(result['text'].encode()).hexdigest()
-        if text_hash not in seen_texts:
-            seen_texts.add(text_hash)
+        key = retrieval_key(result)
+        if key not in seen_keys:
+            seen_keys.add(key)
             
             # 归一化分数
             if 'similarity' in result:
@@ -392,12 +822,109 @@ def hybrid_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k:
     unique_results.sort(key=lambda x: x.get('confidence', 0), reverse=True)
     return unique_results[:top_k]
 
+# 批量查询中并行执行关键词/问题库检索的线程池
+retrieval_executor = ThreadPoolExecutor(max_workers=RAG_CONFIG['batch_lexical_workers'])
+
+# ========== 两阶段级联检索 ==========
+reranker = None
+reranker_failed = False
+reranker_lock = threading.Lock()
+
+def get_reranker():
+    """按 RAG_CONFIG['rerank'] 懒加载重排器（加载失败后不再重试，只用第一阶段结果）"""
+    global reranker, reranker_failed
+    mode = RAG_CONFIG['rerank']
+    if mode == 'none' or reranker_failed:
+        return None
+    if reranker is None or reranker.name != mode:
+        with reranker_lock:
+            if reranker is None or reranker.name != mode:
+                try:
+                    if mode == 'cross-encoder':
+                        reranker = CrossEncoderReranker(RAG_CONFIG['rerank_model'])
+                    elif RAG_CONFIG['embedding_backend'] == 'torch':
+                        reranker = EmbeddingReranker(compute_embeddings)
+                    else:
+                        # 第一阶段用量化/ONNX模型时，重排用全精度 torch 模型
+                        model = load_embedding_model(RAG_CONFIG['embedding_model'], 'torch')
+                        reranker = EmbeddingReranker(lambda texts: model.encode(texts, show_progress_bar=False))
+                    print(f"✅ 重排器: {mode}")
+                except Exception as e:
+                    print(f"⚠️  重排器 {mode} 加载失败，只使用第一阶段结果: {e}")
+                    reranker_failed = True
+                    return None
+    return reranker
+
+def first_stage_k(top_k: int) -> int:
+    """第一阶段取的候选数（开启重排时多取）"""
+    return max(top_k, RAG_CONFIG['rerank_candidates']) if RAG_CONFIG['rerank'] != 'none' else top_k
+
+@observe_stage('rerank')
+@traced('rerank_candidates')
+def rerank_candidates(query: str, candidates: List[Dict], top_k: int = 3,
+                      deadline: Optional[Deadline] = None) -> Tuple[List[Dict], Dict]:
+    """第二阶段：在预算内对候选重新打分（降级时跳过），返回 (前 top_k 个, 统计)"""
+    active = None if degradation_level() >= SKIP_TRANSLATION else get_reranker()
+    results, report = cascade_rerank(query, candidates, active, top_k, RAG_CONFIG['rerank_budget_ms'],
+                                     RAG_CONFIG['rerank_batch_size'], RAG_CONFIG['rerank_budget_clock'],
+                                     RAG_CONFIG['rerank_max_chars'], deadline)
+    if report['scored']:
+        count_request_event('rerank_scored', report['scored'])
+    if report['budget_exhausted']:
+        count_request_event('rerank_budget_exhausted')
+    return results, report
+
+def cascade_retrieval(query: str, corpus_data: Dict, questions_data: Dict, top_k: int = 3,
+                      deadline: Optional[Deadline] = None) -> Tuple[List[Dict], Dict]:
+    """第一阶段混合检索多取候选，第二阶段重排，返回 (结果, 各阶段统计)"""
+    start = time.perf_counter()
+    candidates = hybrid_retrieval(query, corpus_data, questions_data, top_k=first_stage_k(top_k), deadline=deadline)
+    first_stage_time = time.perf_counter() - start
+    results, report = rerank_candidates(query, candidates, top_k, deadline)
+    report['first_stage_ms'] = round(first_stage_time * 1000, 3)
+    return results, report
+
+def cascade_timing(report: Dict) -> Dict:
+    """级联各阶段的耗时，合并到响应的 timing 中"""
+    return {
+        'first_stage_ms': report.get('first_stage_ms', 0.0),
+        'rerank_ms': report['ms'],
+        'rerank_cpu_ms': report['cpu_ms'],
+        'rerank_candidates': report['candidates'],
+        'reranked': report['scored'],
+        'rerank_budget_exhausted': report['budget_exhausted'],
+    }
+
 # ========== 答案生成函数 ==========
-def generate_answer_from_context(query: str, retrieved_contexts: List[Dict], answer_language: str = 'zh') -> Dict:
+@traced('generate_answer_from_context')
+def generate_answer_from_context(query: str, retrieved_contexts: List[Dict], answer_language: str = 'zh',
+                                 deadline: Optional[Deadline] = None) -> Dict:
     """基于检索到的上下文生成答案"""
+    result = extract_answer_from_context(query, retrieved_contexts, answer_language)
+    if not result['sources']:
+        return result
+    
+    # 翻译答案（如果需要）
+    answer = result['answer']
+    if answer_language == 'en':
+        answer = translate_to_english_fast(answer, deadline)
+    elif answer_language == 'zh':
+        answer = translate_to_chinese_fast(answer, deadline)
+    result['answer'] = with_disclaimer(answer, answer_language)
+    return result
+
+def with_disclaimer(answer: str, answer_language: str) -> str:
+    """添加提示信息（取自静态双语表，不经过翻译）"""
+    if len(answer) > 0:
+        answer += "\n\n" + static_text('disclaimer', answer_language)
+    return answer
+
+def extract_answer_from_context(query: str, retrieved_contexts: List[Dict], answer_language: str = 'zh') -> Dict:
+    """从上下文中抽取答案（未翻译）；没有上下文时返回对应语言的无答案提示"""
+    extraction_start = time.perf_counter()
     if not retrieved_contexts:
         return {
-            'answer': '抱歉，我没有找到足够的信息来回答这个问题。',
+            'answer': static_text('no_answer', answer_language),
             'sources': [],
             'confidence': 0.0
         }
@@ -466,16 +993,7 @@ def generate_answer_from_context(query: str, retrieved_contexts: List[Dict], ans
     
     # 清理答案格式
     answer = re.sub(r'\s+', ' ', answer).strip()
-    
-    # 添加提示信息
-    if len(answer) > 0:
-        answer += "\n\n（以上信息基于医疗知识库，仅供参考。具体病情请咨询专业医生。）"
-    
-    # 翻译答案（如果需要）
-    if answer_language == 'en':
-        answer = translate_to_english_fast(answer)
-    elif answer_language == 'zh':
-        answer = translate_to_chinese_fast(answer)
+    record_stage('answer_extraction', time.perf_counter() - extraction_start)
     
     # 计算平均置信度
     avg_confidence = sum(s['confidence'] for s in sources) / len(sources) if sources else 0.5
@@ -487,28 +1005,36 @@ def generate_answer_from_context(query: str, retrieved_contexts: List[Dict], ans
     }
 
 # ========== RAG问答函数 ==========
-def rag_query(query: str, corpus_data: Dict, questions_data: Dict, answer_language: str = 'zh') -> Dict:
-    """RAG问答主函数"""
-    start_time = time.time()
-    
-    # 1. 检索相关上下文
-    retrieved_contexts = hybrid_retrieval(
+@traced('rag_query')
+def rag_query(query: str, corpus_data: Dict, questions_data: Dict, answer_language: str = 'zh',
+              deadline: Optional[Deadline] = None) -> Dict:
+    """RAG问答主函数（deadline 为整个请求的时限，各阶段只使用剩余时间）"""
+    start_time = time.perf_counter()
+    
+    # 1. 检索相关上下文（第一阶段多取候选，第二阶段在预算内重排）
+    retrieved_contexts, cascade_report = cascade_retrieval(
         query, 
         corpus_data, 
         questions_data, 
-        top_k=RAG_CONFIG['top_k_retrieval']
+        top_k=RAG_CONFIG['top_k_retrieval'],
+        deadline=deadline
     )
     
-    retrieval_time = time.time() - start_time
+    retrieval_time = time.perf_counter() - start_time
     
     # 2. 生成答案
-    generation_start = time.time()
-    result = generate_answer_from_context(query, retrieved_contexts, answer_language)
-    generation_time = time.time() - generation_start
+    generation_start = time.perf_counter()
+    result = generate_answer_from_context(query, retrieved_contexts, answer_language, deadline)
+    generation_time = time.perf_counter() - generation_start
     
     # 3. 准备返回结果
-    total_time = time.time() - start_time
-    
+    total_time = time.perf_counter() - start_time
+    return build_rag_result(retrieved_contexts, result, retrieval_time, generation_time, total_time, deadline,
+                            cascade_timing(cascade_report))
+
+def build_rag_result(retrieved_contexts, result, retrieval_time, generation_time, total_time, deadline=None,
+                     stage_timing=None):
+    """组装 rag_query 的返回结果（同步与异步流水线共用）"""
     # 准备源文档信息
     source_documents = []
     for i, ctx in enumerate(retrieved_contexts[:3]):
@@ -516,11 +1042,16 @@ def rag_query(query: str, corpus_data: Dict, questions_data: Dict, answer_langua
         if len(source_text) > 150:
             source_text = source_text[:150] + "..."
         
+        metadata = ctx.get('metadata', {})
         source_documents.append({
             'id': i + 1,
             'content': source_text,
             'confidence': ctx.get('confidence', 0.5),
-            'source_type': ctx.get('source', 'unknown')
+            'source_type': ctx.get('source', 'unknown'),
+            'chunk_id': metadata.get('id') if ctx.get('source') == 'semantic_search' else None,
+            'start': metadata.get('start'),
+            'end': metadata.get('end'),
+            'question_id': metadata.get('question_id')
         })
     
     return {
@@ -529,15 +1060,17 @@ def rag_query(query: str, corpus_data: Dict, questions_data: Dict, answer_langua
         'source_documents': source_documents,
         'retrieved_count': len(retrieved_contexts),
         'timing': {
-            'retrieval': f"{retrieval_time:.2f}s",
-            'generation': f"{generation_time:.2f}s",
-            'total': f"{total_time:.2f}s"
+            'retrieval_ms': round(retrieval_time * 1000, 3),
+            **(stage_timing or {}),
+            'generation_ms': round(generation_time * 1000, 3),
+            'total_ms': round(total_time * 1000, 3)
         },
+        'deadline_exceeded': deadline_expired(deadline),
         'used_rag': True
     }
 
 # ========== 优化翻译函数 ==========
-def translate_to_chinese_fast(text):
+def translate_to_chinese_fast(text, deadline=None):
     """快速翻译成中文（使用缓存和队列）"""
     if not text or not isinstance(text, str):
         return text or ""
@@ -546,14 +1079,14 @@ def translate_to_chinese_fast(text):
     if not any('a' <= char.lower() <= 'z' for char in text):
         return text
     
-    # 使用翻译队列
+    # 使用翻译记忆 + 翻译队列
     if translation_queue:
-        return translation_queue.translate(text, direction='en_to_zh', timeout=5)
+        return translate_with_memory(text, 'en_to_zh', timeout=RAG_CONFIG['translation_timeout'], deadline=deadline)
     
     # 降级到简易翻译
     return simple_translate_to_chinese(text)
 
-def translate_to_english_fast(text):
+def translate_to_english_fast(text, deadline=None):
     """快速翻译成英文（使用缓存和队列）"""
     if not text or not isinstance(text, str):
         return text or ""
@@ -562,9 +1095,9 @@ def translate_to_english_fast(text):
     if not any('\u4e00' <= char <= '\u9fff' for char in text):
         return text
     
-    # 使用翻译队列
+    # 使用翻译记忆 + 翻译队列
     if translation_queue:
-        return translation_queue.translate(text, direction='zh_to_en', timeout=5)
+        return translate_with_memory(text, 'zh_to_en', timeout=RAG_CONFIG['translation_timeout'], deadline=deadline)
     
     # 降级到简易翻译
     return simple_translate_to_english(text)
@@ -624,23 +1157,23 @@ def simple_translate_to_english(text):
     
     return result
 
-def ensure_pure_chinese(text):
+def ensure_pure_chinese(text, deadline=None):
     """确保文本是纯中文"""
     if not text:
         return text
     
     if any('a' <= char.lower() <= 'z' for char in text):
-        return translate_to_chinese_fast(text)
+        return translate_to_chinese_fast(text, deadline)
     
     return text
 
-def ensure_pure_english(text):
+def ensure_pure_english(text, deadline=None):
     """确保文本是纯英文"""
     if not text:
         return text
     
     if any('\u4e00' <= char <= '\u9fff' for char in text):
-        return translate_to_english_fast(text)
+        return translate_to_english_fast(text, deadline)
     
     return text
 
@@ -652,13 +1185,15 @@ def load_corpus_data():
                 corpus = json.load(f)
             
             if isinstance(corpus, dict) and 'context' in corpus:
-                context = corpus.get('context', '')
+                # 先去除首尾空白：只有一个段落时 paragraphs[0] 与 full_content 是同一个字符串对象
+                context = corpus.get('context', '').strip()
                 paragraphs = [p.strip() for p in context.split('\n\n') if p.strip()]
                 
                 return {
                     'corpus_name': corpus.get('corpus_name', '医疗知识库'),
                     'doc_count': 1,
                     'paragraphs': paragraphs,
+                    'paragraph_partitions': corpus_partitions(paragraphs),
                     'full_content': context
                 }
         else:
@@ -706,6 +1241,7 @@ def load_questions_data():
                             answer_cn = ""
                         
                         all_questions.append({
+                            'id': q.get('id', ''),
                             'question_cn': question_cn,
                             'question_en': question_en,
                             'answer_cn': answer_cn,
@@ -718,12 +1254,15 @@ def load_questions_data():
                         })
                 
                 sample_questions = all_questions[:50] if len(all_questions) > 50 else all_questions
+                search = deduplicate_questions(all_questions)
                 
                 return {
                     'total_count': len(all_questions),
                     'sample_questions': sample_questions,
                     'question_types': dict(question_types),
-                    'all_questions': all_questions
+                    'all_questions': all_questions,
+                    'search_questions': search,
+                    'partitions': question_partitions(search)
                 }
         else:
             print(f"问题集文件不存在: {QUESTIONS_PATH}")
@@ -732,6 +1271,30 @@ def load_questions_data():
         print(f"加载问题集失败: {e}")
         return None
 
+def deduplicate_questions(all_questions: List[Dict]) -> List[Dict]:
+    """近似重复的问题（问题+答案）分组，返回代表列表；代表记录 duplicate_ids，其余条目记录 duplicate_of"""
+    if not RAG_CONFIG['dedup_threshold']:
+        return all_questions
+    groups = near_duplicate_groups([question_text(q) for q in all_questions],
+                                   RAG_CONFIG['dedup_threshold'], RAG_CONFIG['dedup_num_perm'])
+    DEDUP_REPORT['questions'] = dedup_report(len(all_questions), groups)
+    reps, duplicates = representatives(groups)
+    for rep, members in duplicates.items():
+        all_questions[rep]['duplicate_ids'] = [all_questions[i].get('id', '') for i in members]
+        for i in members:
+            all_questions[i]['duplicate_of'] = all_questions[rep].get('id', '')
+    if duplicates:
+        print(f"   近似重复问题: {DEDUP_REPORT['questions']['removed']} 条并入代表，不单独检索")
+    return [all_questions[i] for i in reps]
+
+def question_partitions(questions: List[Dict]) -> PartitionIndex:
+    """参与检索的问题按 type / source / language（原始语言）分区，行号与 search_questions 一致"""
+    return PartitionIndex({
+        'type': [q.get('type', '其他') for q in questions],
+        'source': [q.get('source', 'Medical') for q in questions],
+        'language': [q.get('original_lang', 'en') for q in questions],
+    })
+
 def get_data_counts():
     """获取数据统计"""
     global GLOBAL_CORPUS_DATA, GLOBAL_QUESTIONS_DATA
@@ -746,23 +1309,47 @@ def get_data_counts():
 GLOBAL_CORPUS_DATA = None
 GLOBAL_QUESTIONS_DATA = None
 GLOBAL_VECTOR_STORE_READY = False
+GLOBAL_DATA_VERSION = None
 
 def initialize_data_and_vectors():
     """启动时加载数据和构建向量存储，只运行一次"""
-    global GLOBAL_CORPUS_DATA, GLOBAL_QUESTIONS_DATA, GLOBAL_VECTOR_STORE_READY
+    global GLOBAL_CORPUS_DATA, GLOBAL_QUESTIONS_DATA, GLOBAL_VECTOR_STORE_READY, GLOBAL_DATA_VERSION
     GLOBAL_CORPUS_DATA = load_corpus_data()
     GLOBAL_QUESTIONS_DATA = load_questions_data()
+    # 用问题库中中英文都存在的条目补充本地翻译短语表
+    local_backend = translation_backend.local if isinstance(translation_backend, TieredBackend) else translation_backend
+    if isinstance(local_backend, LocalBackend):
+        local_backend.load_question_bank(GLOBAL_QUESTIONS_DATA)
     if HAS_EMBEDDING and GLOBAL_CORPUS_DATA and GLOBAL_QUESTIONS_DATA:
         build_vector_store(GLOBAL_CORPUS_DATA, GLOBAL_QUESTIONS_DATA)
         GLOBAL_VECTOR_STORE_READY = True
     else:
         GLOBAL_VECTOR_STORE_READY = False
+    GLOBAL_DATA_VERSION = data_snapshot_version()
+    build_dashboard_aggregates()
+
+def data_snapshot_version():
+    """数据快照的版本：数据文件的大小、修改时间和影响切分/去重的配置（重启后版本不变时复用已导出的文件）"""
+    parts = [f"{path.name}:{path.stat().st_size}:{path.stat().st_mtime_ns}" if path.exists() else path.name
+             for path in (CORPUS_PATH, QUESTIONS_PATH)]
+    parts.append(json.dumps([RAG_CONFIG[key] for key in (
+        'chunking', 'chunk_max_tokens', 'chunk_overlap_tokens', 'chunk_tokenizer', 'chunk_size', 'chunk_overlap',
+        'dedup_threshold', 'dedup_num_perm', 'embedding_model')]))
+    parts.append(str(len(vector_store['corpus_chunks'])))
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:12]
 
 # 可选：暴露一个刷新接口（如有需要可手动刷新数据和向量）
 def refresh_data_and_vectors():
     initialize_data_and_vectors()
-def search_in_questions(query, questions_data, answer_language='zh', top_k=5):
-    """智能搜索算法（延迟翻译）"""
+@observe_stage('question_search')
+@traced('search_in_questions')
+def search_in_questions(query, questions_data, answer_language='zh', top_k=5, deadline=None):
+    """智能搜索算法（延迟翻译：先打分排序，只翻译最终返回的 top_k 个结果，时限用完后保留原文）"""
+    return [build_question_result(q, confidence, answer_language, deadline)
+            for confidence, q in rank_questions(query, questions_data, top_k)]
+
+def rank_questions(query, questions_data, top_k=5):
+    """问题库打分、排序，返回 [(置信度, 问题)]（不翻译；近似重复已在加载时合并）"""
     if not questions_data or 'all_questions' not in questions_data:
         return []
     
@@ -774,14 +1361,19 @@ def search_in_questions(query, questions_data, answer_language='zh', top_k=5):
     has_chinese = any('\u4e00' <= char <= '\u9fff' for char in query)
     query_lang = 'zh' if has_chinese else 'en'
     
+    # 有过滤条件时只对符合条件的分区打分
+    candidates = search_questions(questions_data)
+    rows = filtered_rows(questions_data.get('partitions'))
+    if rows is not None:
+        candidates = [candidates[i] for i in rows]
+    
     results = []
     
-    for q in questions_data['all_questions']:
+    for q in candidates:
         score = 0
         
         # 获取原始文本
         raw_question = q.get('raw_question', '')
-        raw_answer = q.get('raw_answer', '')
         original_lang = q.get('original_lang', 'en')
         
         # 根据查询语言进行匹配（使用原始文本）
@@ -815,64 +1407,54 @@ def search_in_questions(query, questions_data, answer_language='zh', top_k=5):
                     score += 8
         
         if score > 0:
-            # 根据用户选择的回答语言选择显示内容（延迟翻译）
-            if answer_language == 'en':
-                # 英文回答
-                if original_lang == 'en':
-                    display_question = ensure_pure_english(raw_question)
-                    display_answer = ensure_pure_english(raw_answer)
-                else:
-                    display_question = translate_to_english_fast(raw_question)
-                    display_answer = translate_to_english_fast(raw_answer)
-            else:
-                # 中文回答
-                if original_lang == 'zh':
-                    display_question = ensure_pure_chinese(raw_question)
-                    display_answer = ensure_pure_chinese(raw_answer)
-                else:
-                    display_question = translate_to_chinese_fast(raw_question)
-                    display_answer = translate_to_chinese_fast(raw_answer)
-            
-            confidence = min(score / 10, 0.95)
-            
-            # 翻译类型和来源
-            q_type = q.get('type', 'Medical')
-            source = q.get('source', 'Medical Database')
-            
-            if answer_language == 'zh':
-                if q_type == 'Fact Retrieval':
-                    q_type = '事实检索'
-                elif q_type == 'Medical':
-                    q_type = '医疗信息'
-                if source == 'Medical Database':
-                    source = '医疗数据库'
-            
-            results.append({
-                'display_question': display_question,
-                'display_answer': display_answer,
-                'type': q_type,
-                'source': source,
-                'confidence': confidence,
-                'original_lang': original_lang
-            })
+            results.append((min(score / 10, 0.95), q))
     
-    # 排序并返回
-    results.sort(key=lambda x: x['confidence'], reverse=True)
+    # 排序
+    results.sort(key=lambda x: x[0], reverse=True)
+    return results[:top_k]
+
+def build_question_result(q, confidence, answer_language='zh', deadline=None):
+    """生成问题库检索结果，按回答语言翻译问题和答案（延迟翻译）"""
+    raw_question = q.get('raw_question', '')
+    raw_answer = q.get('raw_answer', '')
+    original_lang = q.get('original_lang', 'en')
     
-    # 去重
-    unique_results = []
-    seen_questions = set()
+    # 根据用户选择的回答语言选择显示内容
+    if answer_language == 'en':
+        # 英文回答
+        if original_lang == 'en':
+            display_question = ensure_pure_english(raw_question, deadline)
+            display_answer = ensure_pure_english(raw_answer, deadline)
+        else:
+            display_question = translate_to_english_fast(raw_question, deadline)
+            display_answer = translate_to_english_fast(raw_answer, deadline)
+    else:
+        # 中文回答
+        if original_lang == 'zh':
+            display_question = ensure_pure_chinese(raw_question, deadline)
+            display_answer = ensure_pure_chinese(raw_answer, deadline)
+        else:
+            display_question = translate_to_chinese_fast(raw_question, deadline)
+            display_answer = translate_to_chinese_fast(raw_answer, deadline)
     
-    for result in results:
-        question_key = hashlib.md5(result['display_question'].encode()).hexdigest()
-        if question_key not in seen_questions:
-            seen_questions.add(question_key)
-            unique_results.append(result)
-        
-        if len(unique_results) >= top_k:
-            break
+    return format_question_result(q, confidence, answer_language, display_question, display_answer)
+
+def format_question_result(q, confidence, answer_language, display_question, display_answer):
+    """问题库检索结果（问题和答案已按回答语言翻译）"""
+    # 类型和来源的显示文本取自静态双语表
+    q_type = static_label('type', q.get('type', 'Medical'), answer_language)
+    source = static_label('source', q.get('source', 'Medical Database'), answer_language)
     
-    return unique_results
+    return {
+        'question_id': q.get('id', ''),
+        'display_question': display_question,
+        'display_answer': display_answer,
+        'type': q_type,
+        'source': source,
+        'confidence': confidence,
+        'original_lang': q.get('original_lang', 'en'),
+        'duplicate_ids': q.get('duplicate_ids', [])
+    }
 
     # ...existing code...
 @app.route('/')
@@ -907,6 +1489,22 @@ def index():
                          sample_questions=display_questions,
                          has_rag=HAS_EMBEDDING)
 
+def request_deadline(data):
+    """请求的总时限：客户端的 deadline_ms（不超过上限），否则使用配置的默认值"""
+    seconds = RAG_CONFIG['request_deadline']
+    try:
+        if data.get('deadline_ms') is not None:
+            seconds = float(data['deadline_ms']) / 1000
+    except (TypeError, ValueError):
+        pass
+    return Deadline(min(seconds, RAG_CONFIG['max_request_deadline']))
+
+def request_filters(data):
+    """解析请求的 filters 并设为本请求的过滤条件（请求结束时在 teardown 中恢复）；格式错误抛出 ValueError"""
+    filters = parse_filters(data.get('filters'))
+    g.filters_token = set_filters(filters)
+    return filters
+
 @app.route('/api/query', methods=['POST'])
 def handle_query():
     """处理查询请求"""
@@ -915,6 +1513,16 @@ def handle_query():
         question = data.get('question', '').strip()
         answer_language = data.get('answer_language', 'zh')
         use_rag = data.get('use_rag', True)  # 是否使用RAG
+        response_format = data.get('format', 'html')  # html: 服务端渲染; json: 结构化字段，由客户端渲染
+        deadline = request_deadline(data)
+        try:
+            filters = request_filters(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)})
+        query_log = g.get('query_log')
+        if query_log is not None:
+            query_log.update({'question': question, 'answer_language': answer_language,
+                              'use_rag': use_rag, 'format': response_format, 'filters': filters})
         
         if not question:
             return jsonify({'success': False, 'error': '请输入问题'})
@@ -927,63 +1535,264 @@ def handle_query():
                 'error': '无法加载数据，请检查数据文件'
             })
         
-        # 根据是否使用RAG选择不同的处理方式
-        if use_rag and HAS_EMBEDDING:
+        # 根据是否使用RAG选择不同的处理方式（最高降级级别只走关键词搜索）
+        level = degradation_level()
+        if use_rag and HAS_EMBEDDING and level < KEYWORD_ONLY:
             # 使用RAG
-            rag_result = rag_query(question, corpus_data, questions_data, answer_language)
-            
-            # 生成HTML响应
-            answer_html = generate_rag_answer_html(question, rag_result, answer_language)
+            REQUESTS_TOTAL.inc(endpoint='query', mode='rag')
+            rag_result = rag_query(question, corpus_data, questions_data, answer_language, deadline)
+            if query_log is not None:
+                query_log.update({'mode': 'rag', 'success': True, 'timing': rag_result['timing'],
+                                  'result_ids': [result_id(doc) for doc in rag_result['source_documents']]})
             
-            return jsonify({
-                'success': True,
-                'question': question,
-                'answer': answer_html,
-                'confidence': rag_result['confidence'],
-                'result_count': rag_result['retrieved_count'],
-                'query_language': 'zh' if any('\u4e00' <= char <= '\u9fff' for char in question) else 'en',
-                'answer_language': answer_language,
-                'used_rag': True,
-                'timing': rag_result['timing']
-            })
+            return jsonify(build_rag_response(question, rag_result, answer_language, response_format, level))
         else:
             # 使用传统搜索
+            REQUESTS_TOTAL.inc(endpoint='query', mode='search')
             search_results = search_in_questions(
                 question, 
                 questions_data, 
                 answer_language=answer_language,
-                top_k=5
+                top_k=5,
+                deadline=deadline
             )
+            if query_log is not None:
+                query_log.update({'mode': 'search', 'success': True,
+                                  'result_ids': [result_id(r) for r in search_results]})
             
-            answer_html = generate_answer_html(question, search_results, answer_language)
-            
-            result_count = len(search_results)
-            if search_results:
-                avg_confidence = sum(r.get('confidence', 0.5) for r in search_results) / result_count
-            else:
-                avg_confidence = 0
-            
-            has_chinese = any('\u4e00' <= char <= '\u9fff' for char in question)
-            query_language = 'zh' if has_chinese else 'en'
-            
+            return jsonify(build_search_response(question, search_results, answer_language,
+                                                 response_format, level, deadline))
+    
+    except Exception as e:
+        print(f"查询处理错误: {e}")
+        return jsonify({
+            'success': False,
+            'error': f'服务器错误: {str(e)}'
+        })
+
+@app.route('/api/query/batch', methods=['POST'])
+def handle_query_batch():
+    """批量查询：一次编码、一次faiss检索，逐题返回结构化结果（可选NDJSON流式输出）"""
+    try:
+        data = request.json or {}
+        questions = data.get('questions', [])
+        if not isinstance(questions, list):
+            return jsonify({'success': False, 'error': 'questions 必须是问题列表'}), 400
+        questions = [str(q).strip() for q in questions]
+        answer_language = data.get('answer_language', 'zh')
+        stream = data.get('stream', False)
+        deadline = request_deadline(data)
+        try:
+            request_filters(data)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        if not questions:
+            return jsonify({'success': False, 'error': '请提供问题列表'}), 400
+        if len(questions) > RAG_CONFIG['max_batch_size']:
             return jsonify({
-                'success': True,
-                'question': question,
-                'answer': answer_html,
-                'confidence': avg_confidence,
-                'result_count': result_count,
-                'query_language': query_language,
-                'answer_language': answer_language,
-                'used_rag': False
+                'success': False,
+                'error': f"单次最多 {RAG_CONFIG['max_batch_size']} 个问题"
+            }), 400
+        
+        _, _, corpus_data, questions_data = get_data_counts()
+        if not corpus_data or not questions_data:
+            return jsonify({
+                'success': False,
+                'error': '无法加载数据，请检查数据文件'
             })
+        
+        REQUESTS_TOTAL.inc(len(questions), endpoint='query_batch', mode='rag')
+        start_time = time.perf_counter()
+        valid = [(i, q) for i, q in enumerate(questions) if q]
+        top_k = RAG_CONFIG['top_k_retrieval']
+        batch_candidates = hybrid_retrieval_batch(
+            [q for _, q in valid],
+            corpus_data,
+            questions_data,
+            top_k=first_stage_k(top_k),
+            deadline=deadline
+        )
+        first_stage_time = time.perf_counter() - start_time
+        reranked = list(map_with_context(
+            retrieval_executor,
+            lambda item: rerank_candidates(item[0][1], item[1], top_k, deadline),
+            list(zip(valid, batch_candidates))
+        ))
+        contexts_by_index = {i: contexts for (i, _), (contexts, _) in zip(valid, reranked)}
+        retrieval_time = time.perf_counter() - start_time
+        
+        def iter_items():
+            for i, question in enumerate(questions):
+                if i in contexts_by_index:
+                    yield build_batch_item(i, question, contexts_by_index[i], answer_language, deadline)
+                else:
+                    yield {'index': i, 'question': question, 'success': False, 'error': '请输入问题'}
+        
+        if stream:
+            # 生成器在视图返回后才执行：保留请求上下文（降级级别、过滤条件），准入名额在响应关闭时释放
+            return Response(
+                stream_with_context(json.dumps(item, ensure_ascii=False) + '\n' for item in iter_items()),
+                mimetype='application/x-ndjson'
+            )
+        
+        results = list(iter_items())
+        total_time = time.perf_counter() - start_time
+        return jsonify({
+            'success': True,
+            'count': len(results),
+            'answer_language': answer_language,
+            'results': results,
+            'deadline_exceeded': deadline.expired(),
+            'timing': {
+                'retrieval_ms': round(retrieval_time * 1000, 3),
+                'first_stage_ms': round(first_stage_time * 1000, 3),
+                'rerank_ms': round(sum(report['ms'] for _, report in reranked), 3),
+                'reranked': sum(report['scored'] for _, report in reranked),
+                'total_ms': round(total_time * 1000, 3)
+            }
+        })
     
     except Exception as e:
-        print(f"查询处理错误: {e}")
+        print(f"批量查询处理错误: {e}")
         return jsonify({
             'success': False,
             'error': f'服务器错误: {str(e)}'
         })
 
+def build_batch_item(index, question, retrieved_contexts, answer_language='zh', deadline=None):
+    """生成批量查询中单个问题的结构化结果"""
+    result = generate_answer_from_context(question, retrieved_contexts, answer_language, deadline)
+    sources = []
+    for ctx, source in zip(retrieved_contexts, result['sources']):
+        metadata = ctx.get('metadata', {})
+        sources.append({
+            'chunk_id': metadata.get('id') if isinstance(metadata, dict) else None,
+            'text': source['text'],
+            'confidence': source['confidence'],
+            'source_type': source['source_type']
+        })
+    return {
+        'index': index,
+        'question': question,
+        'success': True,
+        'answer': result['answer'],
+        'confidence': result['confidence'],
+        'retrieved_count': len(retrieved_contexts),
+        'sources': sources
+    }
+
+def build_rag_response(question, rag_result, answer_language='zh', response_format='html', level=0):
+    """/api/query 的RAG响应（Flask与ASGI入口共用）"""
+    if response_format == 'json':
+        return build_rag_json(question, rag_result, answer_language)
+    
+    # 生成HTML响应
+    answer_html = generate_rag_answer_html(question, rag_result, answer_language)
+    
+    return {
+        'success': True,
+        'question': question,
+        'answer': answer_html,
+        'confidence': rag_result['confidence'],
+        'result_count': rag_result['retrieved_count'],
+        'query_language': 'zh' if any('\u4e00' <= char <= '\u9fff' for char in question) else 'en',
+        'answer_language': answer_language,
+        'used_rag': True,
+        'degradation_level': level,
+        'deadline_exceeded': rag_result['deadline_exceeded'],
+        'timing': rag_result['timing']
+    }
+
+def build_search_response(question, search_results, answer_language='zh', response_format='html',
+                          level=0, deadline=None):
+    """/api/query 的传统搜索响应（Flask与ASGI入口共用）"""
+    result_count = len(search_results)
+    if search_results:
+        avg_confidence = sum(r.get('confidence', 0.5) for r in search_results) / result_count
+    else:
+        avg_confidence = 0
+    
+    has_chinese = any('\u4e00' <= char <= '\u9fff' for char in question)
+    query_language = 'zh' if has_chinese else 'en'
+    
+    if response_format == 'json':
+        return {
+            'success': True,
+            'format': 'json',
+            'question': question,
+            'confidence': avg_confidence,
+            'result_count': result_count,
+            'query_language': query_language,
+            'answer_language': answer_language,
+            'used_rag': False,
+            'degradation_level': level,
+            'deadline_exceeded': deadline_expired(deadline),
+            'results': [{
+                'question_id': r.get('question_id', ''),
+                'question': r.get('display_question', ''),
+                'answer': r.get('display_answer', ''),
+                'type': r.get('type', ''),
+                'source': r.get('source', ''),
+                'confidence': r.get('confidence', 0.5)
+            } for r in search_results]
+        }
+    
+    answer_html = generate_answer_html(question, search_results, answer_language)
+    
+    return {
+        'success': True,
+        'question': question,
+        'answer': answer_html,
+        'confidence': avg_confidence,
+        'result_count': result_count,
+        'query_language': query_language,
+        'answer_language': answer_language,
+        'used_rag': False,
+        'degradation_level': level,
+        'deadline_exceeded': deadline_expired(deadline)
+    }
+
+def build_rag_json(question, rag_result, answer_language='zh'):
+    """RAG结果的结构化响应（format=json），HTML由客户端渲染"""
+    return {
+        'success': True,
+        'format': 'json',
+        'question': question,
+        'answer': rag_result['answer'],
+        'confidence': rag_result['confidence'],
+        'result_count': rag_result['retrieved_count'],
+        'query_language': 'zh' if any('\u4e00' <= char <= '\u9fff' for char in question) else 'en',
+        'answer_language': answer_language,
+        'used_rag': True,
+        'degradation_level': degradation_level(),
+        'deadline_exceeded': rag_result.get('deadline_exceeded', False),
+        'sources': [{
+            'type': doc['source_type'],
+            'chunk_id': doc['chunk_id'],
+            'offsets': [doc['start'], doc['end']] if doc['chunk_id'] else None,
+            'question_id': doc['question_id'],
+            'confidence': doc['confidence'],
+            'content': doc['content']
+        } for doc in rag_result['source_documents']],
+        'timing': rag_result['timing']
+    }
+
+def medical_advice_html(reference_key, answer_language='zh'):
+    """回答末尾的医疗建议（文本取自静态双语表）"""
+    items = ''.join(f'''
+            <li>{static_text(key, answer_language)}</li>'''
+                    for key in (reference_key, 'advice_consult', 'advice_emergency', 'advice_lifestyle'))
+    return f'''
+    <div class="medical-advice">
+        <h5>💡 {static_text('advice_title', answer_language)}</h5>
+        <ul>{items}
+        </ul>
+    </div>
+    '''
+
+@observe_stage('html_render')
+@traced('generate_answer_html')
 def generate_answer_html(question, search_results, answer_language='zh'):
     """生成传统搜索的回答HTML"""
     if not search_results:
@@ -1012,8 +1821,8 @@ def generate_answer_html(question, search_results, answer_language='zh'):
     for i, result in enumerate(search_results, 1):
         display_question = result.get('display_question', '')
         display_answer = result.get('display_answer', '')
-        source = result.get('source', '医疗数据库')
-        q_type = result.get('type', '医疗信息')
+        source = result.get('source', static_text('source_medical_database', answer_language))
+        q_type = result.get('type', static_text('type_medical', answer_language))
         confidence = result.get('confidence', 0.7) * 100
         
         html_parts.append(f'''
@@ -1033,22 +1842,12 @@ def generate_answer_html(question, search_results, answer_language='zh'):
         </div>
         ''')
     
-    advice = '''
-    <div class="medical-advice">
-        <h5>💡 医疗建议</h5>
-        <ul>
-            <li>以上信息基于医疗数据库，仅供参考</li>
-            <li>具体症状请咨询专业医生</li>
-            <li>如遇紧急情况，请立即就医</li>
-            <li>保持健康生活方式有助于疾病预防</li>
-        </ul>
-    </div>
-    '''
-    
-    html_parts.append(advice)
+    html_parts.append(medical_advice_html('advice_reference', answer_language))
     html_parts.append('</div>')
     return '\n'.join(html_parts)
 
+@observe_stage('html_render')
+@traced('generate_rag_answer_html')
 def generate_rag_answer_html(question, rag_result, answer_language='zh'):
     """生成RAG回答的HTML"""
     answer = rag_result.get('answer', '')
@@ -1068,8 +1867,8 @@ def generate_rag_answer_html(question, rag_result, answer_language='zh'):
         <div class="rag-metrics">
             <span class="rag-metric"><strong>置信度:</strong> {confidence:.0f}%</span>
             <span class="rag-metric"><strong>检索文档:</strong> {len(source_documents)} 个</span>
-            <span class="rag-metric"><strong>检索时间:</strong> {timing.get('retrieval', 'N/A')}</span>
-            <span class="rag-metric"><stron.g>生成时间:</strong> {timing.get('generation', 'N/A')}</span>
+            <span class="rag-metric"><strong>检索时间:</strong> {timing.get('retrieval_ms', 0):.1f}ms</span>
+            <span class="rag-metric"><strong>生成时间:</strong> {timing.get('generation_ms', 0):.1f}ms</span>
         </div>
     </div>
     ''')
@@ -1115,77 +1914,136 @@ def generate_rag_answer_html(question, rag_result, answer_language='zh'):
         html_parts.append('</div>')
     
     # 医疗建议
-    html_parts.append('''
-    <div class="medical-advice">
-        <h5>💡 医疗建议</h5>
-        <ul>
-            <li>以上信息基于医疗知识库的智能分析，仅供参考</li>
-            <li>具体症状请咨询专业医生</li>
-            <li>如遇紧急情况，请立即就医</li>
-            <li>保持健康生活方式有助于疾病预防</li>
-        </ul>
-    </div>
-    ''')
+    html_parts.append(medical_advice_html('advice_rag_reference', answer_language))
     
     html_parts.append('</div>')
     return '\n'.join(html_parts)
 
+# ========== 数据导出 ==========
+export_manager = ExportManager(BASE_DIR / RAG_CONFIG['export_dir'])
+
+def export_tables(corpus_data, questions_data, chunks) -> Dict[str, ExportTable]:
+    """可导出的数据表（完整数据）；行在导出时才逐行生成，读取传入的快照而不是全局变量"""
+    questions = questions_data['all_questions'] if questions_data else []
+    paragraphs = corpus_data['paragraphs'] if corpus_data else []
+    statistics = [
+        ('Corpus', corpus_data['doc_count'] if corpus_data else 0, 'Number of documents'),
+        ('Paragraphs', len(paragraphs), 'Corpus paragraphs'),
+        ('Chunks', len(chunks), 'Indexed corpus chunks (near-duplicates merged)'),
+        ('Question Set', questions_data['total_count'] if questions_data else 0, 'Total questions'),
+    ] + [(f'Type: {name}', count, 'Questions of this type')
+         for name, count in (questions_data or {}).get('question_types', {}).items()]
+    return {
+        'questions': ExportTable('Questions', ['ID', 'Question', 'Answer', 'Language', 'Type', 'Source', 'Duplicate Of'],
+                                 lambda: ((q.get('id', ''), q.get('raw_question', ''), q.get('raw_answer', ''),
+                                           q.get('original_lang', 'en'), q.get('type', 'Unknown'),
+                                           q.get('source', 'Unknown'), q.get('duplicate_of', ''))
+                                          for q in questions)),
+        'corpus': ExportTable('Corpus Content', ['Paragraph ID', 'Content', 'Character Count'],
+                              lambda: ((f'P{i+1:03d}', p, len(p)) for i, p in enumerate(paragraphs))),
+        'chunks': ExportTable('Corpus Chunks', ['Chunk ID', 'Start', 'End', 'Token Count', 'Text'],
+                              lambda: ((c['id'], c['start'], c['end'], c.get('token_count'), c['text'])
+                                       for c in (chunks[i] for i in range(len(chunks))))),
+        'statistics': ExportTable('Statistics', ['Item', 'Value', 'Description'], lambda: iter(statistics)),
+    }
+
+EXPORT_CHUNKS = {}  # 快照版本 -> 导出用的chunks（本进程没有向量存储时）
+
+def export_chunks(corpus_data):
+    """导出用的chunks：本进程没有构建向量存储（未启用嵌入或分片部署）时按当前快照切分一次并缓存"""
+    if len(vector_store['corpus_chunks']) or not corpus_data:
+        return vector_store['corpus_chunks']
+    chunks = EXPORT_CHUNKS.get(GLOBAL_DATA_VERSION)
+    if chunks is None:
+        EXPORT_CHUNKS.clear()
+        chunks = EXPORT_CHUNKS[GLOBAL_DATA_VERSION] = create_corpus_chunks(corpus_data)
+    return chunks
+
+def current_export_tables():
+    _, _, corpus_data, questions_data = get_data_counts()
+    return export_tables(corpus_data, questions_data, export_chunks(corpus_data))
+
+def submit_export(dataset, fmt):
+    """提交后台导出任务：xlsx 导出全部数据表（dataset 为 all），csv/jsonl 导出一个数据表"""
+    tables = current_export_tables()
+    if fmt == 'xlsx':
+        return export_manager.submit(GLOBAL_DATA_VERSION, 'all', fmt, list(tables.values()))
+    return export_manager.submit(GLOBAL_DATA_VERSION, dataset, fmt, [tables[dataset]])
+
+def export_job_payload(job):
+    job = dict(job)
+    if job['state'] == 'done':
+        job['download_url'] = f"/api/export-jobs/{job['id']}/download"
+    return job
+
+def export_request_args(args):
+    """(数据集, 格式)；参数错误抛出 ValueError"""
+    fmt = args.get('format', 'xlsx')
+    dataset = args.get('dataset', 'all' if fmt == 'xlsx' else 'questions')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}（可用: {', '.join(EXPORT_FORMATS)}）")
+    if fmt != 'xlsx' and dataset not in ('questions', 'corpus', 'chunks', 'statistics'):
+        raise ValueError(f"不支持的数据集: {dataset}（可用: questions / corpus / chunks / statistics）")
+    return dataset, fmt
+
 @app.route('/api/export-data')
 def export_data():
-    """导出数据为Excel"""
+    """导出数据：csv/jsonl 直接流式返回完整数据集；xlsx 有当前快照的缓存文件时直接下载，否则提交后台任务返回202"""
     try:
-        corpus_data = load_corpus_data()
-        questions_data = load_questions_data()
-        
-        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as tmp:
-            with pd.ExcelWriter(tmp.name, engine='openpyxl') as writer:
-                if corpus_data and 'paragraphs' in corpus_data:
-                    corpus_df = pd.DataFrame({
-                        'Paragraph ID': [f'P{i+1:03d}' for i in range(len(corpus_data['paragraphs']))],
-                        'Content': corpus_data['paragraphs'][:100],
-                        'Character Count': [len(p) for p in corpus_data['paragraphs'][:100]]
-                    })
-                    corpus_df.to_excel(writer, sheet_name='Corpus Content', index=False)
-                
-                if questions_data and 'sample_questions' in questions_data:
-                    questions_list = []
-                    for i, q in enumerate(questions_data['sample_questions'][:200]):
-                        questions_list.append({
-                            'No.': i+1,
-                            'Question (CN)': q.get('question_cn', ''),
-                            'Question (EN)': q.get('question_en', ''),
-                            'Answer (CN)': q.get('answer_cn', '')[:200] if q.get('answer_cn') else '',
-                            'Answer (EN)': q.get('answer_en', '')[:200] if q.get('answer_en') else '',
-                            'Type': q.get('type', 'Unknown'),
-                            'Source': q.get('source', 'Unknown')
-                        })
-                    
-                    questions_df = pd.DataFrame(questions_list)
-                    questions_df.to_excel(writer, sheet_name='Question Samples', index=False)
-                
-                stats_data = [
-                    {'Item': 'Corpus', 'Value': corpus_data['doc_count'] if corpus_data else 1, 'Description': 'Number of documents'},
-                    {'Item': 'Question Set', 'Value': questions_data['total_count'] if questions_data else 0, 'Description': 'Total questions'},
-                ]
-                
-                stats_df = pd.DataFrame(stats_data)
-                stats_df.to_excel(writer, sheet_name='Statistics', index=False)
-            
-            tmp_path = tmp.name
-        
-        return send_file(
-            tmp_path,
-            as_attachment=True,
-            download_name='Medical_RAG_System_Data.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        
+        if GLOBAL_DATA_VERSION is None:
+            return jsonify({'success': False, 'error': '数据尚未加载'})
+        dataset, fmt = export_request_args(request.args)
+        if fmt != 'xlsx':
+            table = current_export_tables()[dataset]
+            chunks = iter_csv(table) if fmt == 'csv' else iter_jsonl(table)
+            return Response(chunks, mimetype=EXPORT_FORMATS[fmt], headers={
+                'Content-Disposition': f'attachment; filename=Medical_RAG_{dataset}.{fmt}'})
+        job = submit_export(dataset, fmt)
+        if job['state'] == 'done':
+            return send_file(export_manager.artifact(job['id']), as_attachment=True,
+                             download_name='Medical_RAG_System_Data.xlsx', mimetype=EXPORT_FORMATS[fmt])
+        return jsonify({'success': True, 'job': export_job_payload(job)}), 202
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/export-jobs', methods=['POST'])
+def create_export_job():
+    """提交后台导出任务（同一快照的同一导出只生成一次）"""
+    if GLOBAL_DATA_VERSION is None:
+        return jsonify({'success': False, 'error': '数据尚未加载'})
+    try:
+        dataset, fmt = export_request_args(request.json or {})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    job = submit_export(dataset, fmt)
+    return jsonify({'success': True, 'job': export_job_payload(job)}), 200 if job['state'] == 'done' else 202
+
+@app.route('/api/export-jobs/<job_id>')
+def export_job_status(job_id):
+    """导出任务状态：queued / running / done / failed，完成后带 download_url"""
+    job = export_manager.status(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '导出任务不存在'}), 404
+    return jsonify({'success': True, 'job': export_job_payload(job)})
+
+@app.route('/api/export-jobs/<job_id>/download')
+def download_export(job_id):
+    path = export_manager.artifact(job_id)
+    if path is None:
+        return jsonify({'success': False, 'error': '导出文件尚未生成'}), 404
+    fmt = path.suffix[1:]
+    download_name = 'Medical_RAG_System_Data.xlsx' if fmt == 'xlsx' else f'Medical_RAG_{path.stem}.{fmt}'
+    return send_file(path, as_attachment=True, download_name=download_name, mimetype=EXPORT_FORMATS[fmt])
+
 @app.route('/api/data-stats')
 def data_stats():
     """获取数据统计API"""
+    return jsonify({'success': True, 'data': data_stats_payload()})
+
+def data_stats_payload():
+    """数据统计（Flask与ASGI入口共用）"""
     doc_count, question_count, corpus_data, questions_data = get_data_counts()
     
     stats = {
@@ -1202,22 +2060,378 @@ def data_stats():
         'rag': {
             'enabled': HAS_EMBEDDING,
             'chunk_size': RAG_CONFIG['chunk_size'],
+            'chunking': dict(CHUNK_REPORT),
+            'dedup': dict(DEDUP_REPORT),
             'top_k_retrieval': RAG_CONFIG['top_k_retrieval'],
             'hybrid_search': RAG_CONFIG['hybrid_search']
+        },
+        'partitions': {
+            'questions': questions_data['partitions'].sizes() if questions_data else {},
+            'corpus_paragraphs': (corpus_data['paragraph_partitions'].sizes()
+                                  if corpus_data else {}),
+            'corpus_chunks': (vector_store['corpus_partitions'].sizes()
+                              if vector_store['corpus_partitions'] is not None else {})
         }
     }
     
-    return jsonify({'success': True, 'data': stats})
+    return stats
+
+# ========== 前端看板接口（app.py） ==========
+DASHBOARD = {'status': {'success': False, 'error': '数据尚未加载'},
+             'stats': {'success': False, 'error': '数据尚未加载'},
+             'sample': {'success': False, 'error': '数据尚未加载'}}
+
+def build_dashboard_aggregates():
+    """数据加载后预先计算 /api/status、/api/stats、/api/sample 的响应，接口直接返回，不再逐次统计"""
+    doc_count, question_count, corpus_data, questions_data = get_data_counts()
+    vector_count = sum(index.ntotal for index in (vector_store['corpus_faiss_index'],
+                                                  vector_store['question_faiss_index']) if index is not None)
+    # 三种分布都按全部问题（含被合并的近似重复条目，与 total_questions 一致）统计
+    all_questions = questions_data.get('all_questions', []) if questions_data else []
+    breakdown = question_partitions(all_questions).sizes() if all_questions else {}
+    samples = questions_data['sample_questions'][:RAG_CONFIG['dashboard_sample_size']] if questions_data else []
+    generated_at = time.time()
+    DASHBOARD['status'] = {
+        'success': True,
+        'question_count': question_count,
+        'doc_count': doc_count,
+        'rag_enabled': HAS_EMBEDDING,
+        'vector_store_ready': GLOBAL_VECTOR_STORE_READY,
+        'generated_at': generated_at
+    }
+    DASHBOARD['stats'] = {
+        'success': True,
+        'total_questions': question_count,
+        'corpus_docs': doc_count,
+        'corpus_chunks': len(vector_store['corpus_chunks']),
+        'vector_count': vector_count,
+        'searchable_questions': len(search_questions(questions_data)),
+        'question_breakdown_population': 'all_questions',
+        'question_types': breakdown.get('type', {}),
+        'question_languages': breakdown.get('language', {}),
+        'question_sources': breakdown.get('source', {}),
+        'generated_at': generated_at
+    }
+    DASHBOARD['sample'] = {
+        'success': True,
+        'data': [{
+            'id': q.get('id', ''),
+            'type': q.get('type', ''),
+            'source': q.get('source', ''),
+            'language': q.get('original_lang', 'en'),
+            'question': q.get('raw_question', ''),
+            'answer': q.get('raw_answer', '')
+        } for q in samples],
+        'generated_at': generated_at
+    }
+
+def dashboard_response(name):
+    response = jsonify(DASHBOARD[name])
+    response.headers['Cache-Control'] = f"max-age={RAG_CONFIG['dashboard_max_age']}"
+    return response
+
+@app.route('/api/status')
+def api_status():
+    """前端侧边栏的系统状态"""
+    return dashboard_response('status')
+
+@app.route('/api/stats')
+def api_stats():
+    """前端数据管理页的统计"""
+    return dashboard_response('stats')
+
+@app.route('/api/sample')
+def api_sample():
+    """前端数据预览的问题库样本"""
+    return dashboard_response('sample')
+
+# ========== 准入控制与降级 ==========
+ADMISSION_PATHS = ('/api/query', '/api/query/batch')
+load_shedder = LoadShedder(RAG_CONFIG['max_in_flight'], RAG_CONFIG['max_translation_queue'],
+                           queue_depth=lambda: translation_queue.queue.qsize())
+degradation = DegradationController(RAG_CONFIG['degradation_thresholds'])
+SHED_REQUESTS = REGISTRY.counter(
+    'rag_shed_requests_total', 'Requests rejected with 503 by the load shedder', ('reason',)
+)
+REGISTRY.callback('rag_degradation_level', 'Active degradation level (0 = normal)',
+                  lambda: {(): degradation.stats()['level']})
+REGISTRY.callback('rag_in_flight_requests', 'Admitted query requests in flight',
+                  lambda: {(): load_shedder.in_flight})
+REGISTRY.callback('rag_stage_active', 'Threads inside a concurrency-limited stage',
+                  lambda: {limiter.name: limiter.active for limiter in (translation_limiter, embedding_limiter)},
+                  ('stage',))
+REGISTRY.callback('rag_stage_rejections_total', 'Stage permits not granted in time',
+                  lambda: {limiter.name: limiter.rejected for limiter in (translation_limiter, embedding_limiter)},
+                  ('stage',), metric_type='counter')
+
+@app.before_request
+def admit_request():
+    """查询接口的准入控制：过载时快速返回503，否则确定本请求的降级级别"""
+    if request.path not in ADMISSION_PATHS:
+        return
+    reason = load_shedder.try_acquire()
+    if reason is not None:
+        SHED_REQUESTS.inc(reason=reason)
+        response = jsonify({'success': False, 'error': '服务繁忙，请稍后重试', 'reason': reason})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(degradation.retry_after())
+        return response
+    level = degradation.level() if RAG_CONFIG['degradation_enabled'] else 0
+    g.admission = (time.perf_counter(), level, set_degradation_level(level))
+
+@app.after_request
+def add_degradation_header(response):
+    admission = g.get('admission')
+    if admission is not None:
+        response.headers['X-Degradation-Level'] = str(admission[1])
+        if response.is_streamed:
+            # 流式响应：名额占用到响应发送完毕
+            g.pop('admission')
+            path = request.path
+            response.call_on_close(lambda: finish_admission(admission, path))
+    return response
+
+@app.teardown_request
+def release_admission(exc):
+    filters_token = g.pop('filters_token', None)
+    if filters_token is not None:
+        reset_filters(filters_token)
+    admission = g.pop('admission', None)
+    if admission is not None:
+        finish_admission(admission, request.path)
+
+def finish_admission(admission, path):
+    start_time, level, token = admission
+    reset_degradation_level(token)
+    load_shedder.release()
+    if path == '/api/query':
+        degradation.observe(time.perf_counter() - start_time, level)
+
+# ========== 请求日志 ==========
+if RAG_CONFIG['request_log_path'] == 'none':
+    REQUEST_LOG_PATH = None
+    request_logger = None
+else:
+    REQUEST_LOG_PATH = BASE_DIR / RAG_CONFIG['request_log_path']
+    request_logger = RequestLogger(REQUEST_LOG_PATH, RAG_CONFIG['request_log_max_bytes'],
+                                   RAG_CONFIG['request_log_backups'], RAG_CONFIG['request_log_buffer'])
+
+@app.before_request
+def start_request_log():
+    if request_logger is None or request.path != '/api/query' or request.method != 'POST':
+        return
+    g.request_log_scope = enter_request_scope()
+    g.request_log_start = time.perf_counter()
+    g.query_log = {'endpoint': 'query', 'success': False}
+
+@app.after_request
+def finish_request_log(response):
+    scope_token = g.pop('request_log_scope', None)
+    if scope_token is None:
+        return response
+    scope, token = scope_token
+    record = g.pop('query_log', {})
+    record['status'] = response.status_code
+    record['degradation_level'] = degradation_level()
+    start_time = g.pop('request_log_start')
+    
+    def write_log():
+        exit_request_scope(token)
+        record['total_ms'] = round((time.perf_counter() - start_time) * 1000, 3)
+        record['stages_ms'] = {stage: round(seconds * 1000, 3) for stage, seconds in scope.stages.items()}
+        record['cache'] = dict(scope.events)
+        request_logger.log(record)
+    
+    if response.is_streamed:
+        response.call_on_close(write_log)  # 流式响应发送完毕后再记录
+    else:
+        write_log()
+    return response
+
+def prewarm_from_request_log(n):
+    """用请求日志中最常见的 n 个查询预热翻译记忆等缓存"""
+    if REQUEST_LOG_PATH is None or n <= 0:
+        return 0
+    queries = top_queries(REQUEST_LOG_PATH, n)
+    _, _, corpus_data, questions_data = get_data_counts()
+    for q in queries:
+        try:
+            if q['use_rag'] and HAS_EMBEDDING:
+                rag_query(q['question'], corpus_data, questions_data, q['answer_language'])
+            else:
+                search_in_questions(q['question'], questions_data, answer_language=q['answer_language'], top_k=5)
+        except Exception as e:
+            print(f"预热查询失败: {e}")
+    return len(queries)
+
+REGISTRY.callback(
+    'rag_request_log_records', 'Request log records by state',
+    lambda: request_logger.stats() if request_logger else {},
+    ('state',)
+)
+
+# ========== 请求剖析与追踪 ==========
+# 剖析令牌只从环境变量读取，不放入RAG_CONFIG（/api/rag-status 会返回RAG_CONFIG）
+PROFILE_TOKEN = os.environ.get('RAG_PROFILE_TOKEN', '')
+request_profiler = RequestProfiler(BASE_DIR / RAG_CONFIG['profile_dir'], RAG_CONFIG['profile_max_files'])
+
+def debug_authorized():
+    """调试接口需要携带与 RAG_PROFILE_TOKEN 一致的 X-Profile-Token 请求头"""
+    return request_profiler.should_profile(request.headers.get('X-Profile-Token'), PROFILE_TOKEN, 0.0)
+
+@app.before_request
+def start_request_profiling():
+    """带特权请求头或被采样的请求开启剖析/追踪"""
+    if request.path.startswith('/debug/') or request.path == '/metrics':
+        return
+    if not request_profiler.should_profile(request.headers.get('X-Profile-Token'), PROFILE_TOKEN,
+                                           RAG_CONFIG['profile_sample_rate']):
+        return
+    mode = request.headers.get('X-Profile-Mode', RAG_CONFIG['profile_mode'])
+    if mode not in ('trace', 'cprofile', 'both'):
+        mode = RAG_CONFIG['profile_mode']
+    g.profile_session = request_profiler.start(
+        f"{request.method} {request.path}", mode,
+        {'http.method': request.method, 'http.target': request.path}
+    )
+
+@app.after_request
+def finish_request_profiling(response):
+    session = g.pop('profile_session', None)
+    if session is not None:
+        try:
+            profile_id = request_profiler.finish(session, {'http.status_code': response.status_code})
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception as e:
+            print(f"保存剖析结果失败: {e}")
+    return response
+
+@app.route('/debug/profiles')
+def list_profiles():
+    """列出已保存的剖析结果"""
+    if not debug_authorized():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    return jsonify({'success': True, 'profiles': request_profiler.list_profiles()})
+
+@app.route('/debug/profiles/<profile_id>')
+def get_profile(profile_id):
+    """下载剖析结果：kind=trace.json（OTLP/JSON追踪）/ txt（pstats摘要）/ prof（pstats原始数据）"""
+    if not debug_authorized():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    kind = request.args.get('kind', 'trace.json')
+    path = request_profiler.profile_path(profile_id, kind)
+    if path is None:
+        return jsonify({'success': False, 'error': '剖析结果不存在'}), 404
+    mimetype = {'trace.json': 'application/json', 'txt': 'text/plain'}.get(kind, 'application/octet-stream')
+    return send_file(str(path), mimetype=mimetype, as_attachment=(kind == 'prof'))
+
+# ========== 内存统计 ==========
+memory_snapshots = MemorySnapshots()
+
+def _faiss_index_bytes(index):
+    """FAISS索引中向量数据的字节数（Flat索引每个向量 code_size 字节）"""
+    if index is None:
+        return 0
+    code_size = getattr(index, 'code_size', index.d * 4)
+    return int(index.ntotal) * int(code_size)
+
+def collect_memory_usage():
+    """各主要结构的字节数；total 跨结构去重（如 vector_store['questions'] 与问题库共享对象）"""
+    backend = translation_queue.backend
+    local_backend = getattr(backend, 'local', backend)
+    structures = {
+        'corpus_embeddings': vector_store['corpus_embeddings'],
+        'question_embeddings': vector_store['question_embeddings'],
+        'corpus_chunks': vector_store['corpus_chunks'],
+        'vector_store_questions': vector_store['questions'],
+        'corpus_data': GLOBAL_CORPUS_DATA,
+        'questions_data': GLOBAL_QUESTIONS_DATA,
+        'translation_memory': translation_memory.entries,
+        'translation_memory_static': translation_memory.static_entries,
+        'translation_queue_batch_events': translation_queue.batch_events,
+        'translation_phrases': getattr(local_backend, 'phrases', None),
+        'translation_terms': getattr(local_backend, 'terms', None),
+    }
+    sizes = {name: deep_sizeof(obj) if obj is not None else 0 for name, obj in structures.items()}
+    seen = set()
+    total = sum(deep_sizeof(obj, seen) for obj in structures.values() if obj is not None)
+    sizes['corpus_faiss_index'] = _faiss_index_bytes(vector_store['corpus_faiss_index'])
+    sizes['question_faiss_index'] = _faiss_index_bytes(vector_store['question_faiss_index'])
+    total += sizes['corpus_faiss_index'] + sizes['question_faiss_index']
+    return {
+        'structures': sizes,
+        'counts': {
+            'corpus_chunks': len(vector_store['corpus_chunks']),
+            'questions': len(vector_store['questions']),
+            'translation_memory': len(translation_memory.entries),
+            'translation_queue_waiting': len(translation_queue.batch_events),
+            'translation_queue_pending': translation_queue.queue.qsize(),
+        },
+        'total_bytes': total,
+    }
+
+@app.route('/debug/memory')
+def debug_memory():
+    """内存统计：各结构字节数；tracemalloc=start|diff|stop 控制快照差异（diff 与上次调用比较）"""
+    if not debug_authorized():
+        return jsonify({'success': False, 'error': '无权访问'}), 403
+    result = {'success': True, 'memory': collect_memory_usage()}
+    action = request.args.get('tracemalloc')
+    if action == 'start':
+        result['tracemalloc'] = memory_snapshots.start()
+    elif action == 'diff':
+        limit = request.args.get('limit', 20, type=int)
+        result['tracemalloc'] = memory_snapshots.diff(limit=limit)
+    elif action == 'stop':
+        result['tracemalloc'] = memory_snapshots.stop()
+    elif action:
+        return jsonify({'success': False, 'error': 'tracemalloc 参数只能是 start / diff / stop'}), 400
+    else:
+        result['tracemalloc'] = memory_snapshots.status()
+    return jsonify(result)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus文本格式的运行指标"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/rag-status')
 def rag_status():
     """获取RAG系统状态"""
-    return jsonify({
+    return jsonify(rag_status_payload())
+
+def rag_status_payload():
+    """RAG系统状态（Flask与ASGI入口共用）"""
+    return {
         'success': True,
         'rag_enabled': HAS_EMBEDDING,
+        'embedding_backend': getattr(embedding_model, 'backend', 'torch') if embedding_model is not None else None,
         'vector_store_ready': vector_store is not None and len(vector_store.get('corpus_chunks', [])) > 0,
+        'degradation': degradation.stats(),
+        'shards': shard_coordinator.stats() if shard_coordinator else [],
+        'chunking': dict(CHUNK_REPORT),
         'config': RAG_CONFIG
-    })
+    }
+
+# ========== 多进程部署（serve.py） ==========
+def after_fork(worker_id=None):
+    """serve.py 在fork出的worker中调用：fork只保留调用线程，重建后台线程和线程池"""
+    global retrieval_executor, request_logger
+    translation_queue.queue = queue.Queue()
+    translation_queue.batch_events = {}
+    translation_queue.start_worker()
+    if isinstance(translation_backend, TieredBackend):
+        translation_backend.reset_after_fork()
+    retrieval_executor = ThreadPoolExecutor(max_workers=RAG_CONFIG['batch_lexical_workers'])
+    export_manager.reset()
+    if embedding_client is not None:
+        embedding_client.reset()
+    if shard_coordinator is not None:
+        shard_coordinator.reset()
+    if REQUEST_LOG_PATH is not None and worker_id is not None:
+        request_logger = RequestLogger(worker_log_path(REQUEST_LOG_PATH, worker_id),
+                                       RAG_CONFIG['request_log_max_bytes'],
+                                       RAG_CONFIG['request_log_backups'], RAG_CONFIG['request_log_buffer'])
 
 if __name__ == '__main__':
     print("=" * 60)
@@ -1240,6 +2454,9 @@ if __name__ == '__main__':
     print(f"\n📊 数据统计:")
     print(f"   语料库: {doc_count} 篇文档")
     print(f"   问题集: {question_count} 个问题")
+    if RAG_CONFIG['prewarm_top_queries'] > 0:
+        warmed = prewarm_from_request_log(RAG_CONFIG['prewarm_top_queries'])
+        print(f"   已用 {warmed} 个历史查询预热缓存")
     if GLOBAL_VECTOR_STORE_READY:
         print(f"\n🔧 RAG系统已就绪")
     else:
@@ -0,0 +1,435 @@
+# load_test.py - HTTP压测工具
+"""
+对 /api/query 做压力测试，可替换翻译后端和嵌入模型为本地桩
+
+- 目标：进程内（Flask test_client）或 localhost HTTP（--url 指定已有服务，
+  或 --serve 在本进程起一个多线程服务）
+- 负载模型：闭环（固定并发数）或开环（泊松到达，固定请求速率）
+- 查询集：从 medical_questions.json 按问题类型权重抽样，可配置回答语言和RAG比例
+- 桩：StubBackend 翻译（可配延迟）、StubEncoder 嵌入（可配延迟，不需要加载MiniLM）
+- 输出：吞吐、延迟分位数、错误率/超时率；--find-saturation 逐级提高到达速率，
+  找出当前 worker 配置的饱和点；--scale-workers 比较 serve.py 不同worker数下的吞吐
+
+用法：
+    python load_test.py --stub-encoder 0.005 --stub-translator 0.05 --concurrency 8 --duration 30
+    python load_test.py --mode open --rate 20 --duration 30
+    python load_test.py --serve --find-saturation --rate 5 --rate-step 1.5 --slo-p99 2.0
+    python load_test.py --scale-workers 1 2 4 --stub-encoder 0.005 --concurrency 16
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from metrics import percentile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS_PATH = os.path.join(BASE_DIR, 'data', 'raw', 'medical_questions.json')
+
+
+# ========== 桩编码器 ==========
+class StubEncoder:
+    """确定性桩编码器：词哈希向量 + 可配置延迟，接口与SentenceTransformer.encode一致"""
+
+    def __init__(self, dim: int = 384, latency: float = 0.0, per_text_latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.max_seq_length = 256
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, show_progress_bar=False, batch_size=32, **kwargs):
+        import numpy as np
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        delay = self.latency + self.per_text_latency * len(texts)
+        if delay > 0:
+            time.sleep(delay)
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                h = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+                embeddings[i, h % self.dim] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, 1e-9)
+        return embeddings[0] if single else embeddings
+
+
+# ========== 查询集 ==========
+class QueryMix:
+    """按问题类型权重从问题库抽样请求体"""
+
+    def __init__(self, type_weights: Optional[Dict[str, float]] = None, zh_ratio: float = 0.5,
+                 rag_ratio: float = 1.0, response_format: str = 'html', seed: int = 42):
+        with open(QUESTIONS_PATH, 'r', encoding='utf-8') as f:
+            questions = [q for q in json.load(f) if isinstance(q, dict) and q.get('question')]
+        self.by_type = {}
+        for q in questions:
+            self.by_type.setdefault(q.get('question_type', '其他'), []).append(q['question'])
+        weights = type_weights or {t: len(qs) for t, qs in self.by_type.items()}
+        self.types = [t for t in weights if t in self.by_type]
+        self.weights = [weights[t] for t in self.types]
+        if not self.types:
+            raise ValueError(f"查询集为空，可选类型: {sorted(self.by_type)}")
+        self.zh_ratio = zh_ratio
+        self.rag_ratio = rag_ratio
+        self.response_format = response_format
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self) -> Dict:
+        with self.lock:
+            q_type = self.random.choices(self.types, self.weights)[0]
+            return {
+                'question': self.random.choice(self.by_type[q_type]),
+                'answer_language': 'zh' if self.random.random() < self.zh_ratio else 'en',
+                'use_rag': self.random.random() < self.rag_ratio,
+                'format': self.response_format,
+            }
+
+
+# ========== 压测目标 ==========
+class InProcessTarget:
+    """进程内目标：每个线程一个 Flask test_client"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, payload: Dict, timeout: float):
+        """返回 (状态码, 响应JSON)"""
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.post('/api/query', json=payload)
+        body = response.get_json(silent=True) or {}
+        if response.status_code == 200 and not body.get('success', False):
+            return 500, body
+        return response.status_code, body
+
+    def post(self, payload: Dict, timeout: float) -> int:
+        return self.request(payload, timeout)[0]
+
+
+class HttpTarget:
+    """HTTP目标：每个线程一个keep-alive的requests.Session"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, payload: Dict, timeout: float):
+        """返回 (状态码, 响应JSON)；超时返回状态码0"""
+        import requests
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        try:
+            response = session.post(f"{self.base_url}/api/query", json=payload, timeout=timeout)
+        except requests.exceptions.Timeout:
+            return 0, {}
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code == 200 and not body.get('success', False):
+            return 500, body
+        return response.status_code, body
+
+    def post(self, payload: Dict, timeout: float) -> int:
+        return self.request(payload, timeout)[0]
+
+
+def start_local_server(app, port: int):
+    """在后台线程启动多线程WSGI服务，返回 (server, base_url)"""
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # 不逐条打印请求日志
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# ========== 负载生成 ==========
+class Recorder:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.latencies = defaultdict(list)  # 状态码 -> 延迟
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, latency: float, status: int):
+        if status == 200 and latency > self.timeout:
+            status = 0  # 进程内无法中断请求，超过超时时间按超时统计
+        with self.lock:
+            self.latencies[status].append(latency)
+            self.statuses[status] += 1
+
+    def summary(self, elapsed: float, offered_rate: Optional[float] = None) -> Dict:
+        """延迟分位数只统计成功（200）的请求：快速失败的503和超时不拉低分位数"""
+        total = sum(self.statuses.values())
+        ok = self.statuses.get(200, 0)
+        timeouts = self.statuses.get(0, 0)
+        ok_latencies = sorted(self.latencies.get(200, []))
+        return {
+            'requests': total,
+            'elapsed_s': round(elapsed, 3),
+            'offered_rate': offered_rate,
+            'throughput_rps': round(ok / elapsed, 2) if elapsed > 0 else 0.0,
+            'error_rate': round((total - ok - timeouts) / total, 4) if total else 0.0,
+            'timeout_rate': round(timeouts / total, 4) if total else 0.0,
+            'status_counts': {str(k): v for k, v in sorted(self.statuses.items())},
+            'p50_s': round(percentile(ok_latencies, 50), 4),
+            'p95_s': round(percentile(ok_latencies, 95), 4),
+            'p99_s': round(percentile(ok_latencies, 99), 4),
+            'max_s': round(ok_latencies[-1], 4) if ok_latencies else 0.0,
+        }
+
+
+def _send(target, mix: QueryMix, recorder: Recorder, scheduled: float):
+    """发送一个请求，延迟从计划发送时间算起（开环模式下包含排队时间）"""
+    payload = mix.sample()
+    try:
+        status = target.post(payload, recorder.timeout)
+    except Exception as e:
+        print(f"请求异常: {e}")
+        status = -1
+    recorder.record(time.perf_counter() - scheduled, status)
+
+
+def run_closed_loop(target, mix: QueryMix, concurrency: int, duration: float, timeout: float) -> Dict:
+    """闭环：concurrency 个用户各自循环发送请求"""
+    recorder = Recorder(timeout)
+    deadline = time.perf_counter() + duration
+
+    def user():
+        while time.perf_counter() < deadline:
+            _send(target, mix, recorder, time.perf_counter())
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder.summary(time.perf_counter() - start)
+
+
+def run_open_loop(target, mix: QueryMix, rate: float, duration: float, timeout: float,
+                  max_workers: int = 256, seed: int = 42) -> Dict:
+    """开环：按泊松过程以 rate 请求/秒到达，不受响应速度影响"""
+    recorder = Recorder(timeout)
+    arrivals = random.Random(seed)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    start = time.perf_counter()
+    next_arrival = start
+    while next_arrival < start + duration:
+        now = time.perf_counter()
+        if next_arrival > now:
+            time.sleep(next_arrival - now)
+        executor.submit(_send, target, mix, recorder, next_arrival)
+        next_arrival += arrivals.expovariate(rate)
+    executor.shutdown(wait=True)
+    return recorder.summary(time.perf_counter() - start, offered_rate=rate)
+
+
+def find_saturation(target, mix: QueryMix, args) -> Dict:
+    """逐级提高到达速率，直到p99超过SLO、错误/超时率超阈值或吞吐跟不上到达速率"""
+    steps = []
+    rate = args.rate
+    saturation = None
+    for _ in range(args.max_steps):
+        result = run_open_loop(target, mix, rate, args.duration, args.timeout, args.max_workers, args.seed)
+        failed_rate = result['error_rate'] + result['timeout_rate']
+        saturated = (
+            result['p99_s'] > args.slo_p99
+            or failed_rate > args.max_error_rate
+            or result['throughput_rps'] < rate * 0.9
+        )
+        result['saturated'] = saturated
+        steps.append(result)
+        print_summary(f"rate={rate:.2f}/s", result)
+        if saturated:
+            break
+        saturation = rate
+        rate *= args.rate_step
+    return {'max_sustainable_rate': saturation, 'steps': steps}
+
+
+def run_worker_scaling(mix: QueryMix, args) -> Dict:
+    """用 serve.py 分别以不同worker数启动服务，同一闭环负载下比较吞吐（worker间共享预加载的数据和索引）"""
+    import socket
+    import subprocess
+    import sys
+    import requests
+
+    steps = []
+    for workers in args.scale_workers:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+                   '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+                   '--threads', str(args.scale_threads), '--reload-interval', '0']
+        for flag, value in (('--stub-encoder', args.stub_encoder), ('--stub-translator', args.stub_translator),
+                            ('--translation-backend', args.translation_backend)):
+            if value is not None:
+                command += [flag, str(value)]
+        env = dict(os.environ)
+        env.setdefault('RAG_REQUEST_LOG', 'none')
+        process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            started = time.time()
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError(f"serve.py 启动失败（workers={workers}）")
+                try:
+                    if requests.get(f"{base_url}/api/rag-status", timeout=1).status_code == 200:
+                        break
+                except requests.exceptions.RequestException:
+                    pass
+                if time.time() - started > args.scale_startup_timeout:
+                    raise RuntimeError(f"serve.py 启动超时（workers={workers}）")
+                time.sleep(0.5)
+            result = run_closed_loop(HttpTarget(base_url), mix, args.concurrency, args.duration, args.timeout)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        result['workers'] = workers
+        steps.append(result)
+        print_summary(f"workers={workers}", result)
+
+    base = steps[0]['throughput_rps'] if steps and steps[0]['throughput_rps'] else None
+    for step in steps:
+        step['speedup'] = round(step['throughput_rps'] / base, 3) if base else None
+    return {'cpu_count': os.cpu_count(), 'threads_per_worker': args.scale_threads, 'steps': steps}
+
+
+def print_summary(label: str, result: Dict):
+    print(f"   {label:<16} 吞吐 {result['throughput_rps']:>8.2f} rps | "
+          f"p50 {result['p50_s']:.3f}s p95 {result['p95_s']:.3f}s p99 {result['p99_s']:.3f}s | "
+          f"错误 {result['error_rate']:.2%} 超时 {result['timeout_rate']:.2%} | 请求 {result['requests']}")
+
+
+def parse_mix(spec: Optional[str]) -> Optional[Dict[str, float]]:
+    """解析 "Fact Retrieval=3,Complex Reasoning=1" 形式的类型权重"""
+    if not spec:
+        return None
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def setup_app(args):
+    """导入 flask_app 并按参数替换翻译后端和嵌入模型"""
+    if args.stub_encoder is not None:
+        os.environ['RAG_EMBEDDING_MODEL'] = 'none'  # 不加载真实模型
+    os.environ.setdefault('RAG_REQUEST_LOG', 'none')  # 压测流量不写入请求日志
+    import flask_app as fa
+    from translation import create_translation_backend
+
+    if args.stub_encoder is not None:
+        fa.set_embedding_model(StubEncoder(latency=args.stub_encoder))
+    if args.stub_translator is not None:
+        fa.translation_queue.backend = create_translation_backend('stub', stub_latency=args.stub_translator)
+    elif args.translation_backend:
+        fa.translation_queue.backend = create_translation_backend(
+            args.translation_backend, terms_path=str(fa.MEDICAL_TERMS_PATH),
+            latency_budget=fa.RAG_CONFIG['translation_latency_budget']
+        )
+    fa.initialize_data_and_vectors()
+    return fa
+
+
+def main():
+    parser = argparse.ArgumentParser(description='/api/query 压测工具')
+    parser.add_argument('--url', help='压测已运行的服务（如 http://localhost:5000），不指定则在本进程内压测')
+    parser.add_argument('--serve', action='store_true', help='在本进程启动多线程HTTP服务并通过localhost压测')
+    parser.add_argument('--port', type=int, default=0, help='--serve 使用的端口（0为随机）')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=8, help='闭环模式并发用户数')
+    parser.add_argument('--rate', type=float, default=10.0, help='开环模式到达速率（请求/秒），饱和搜索的起始速率')
+    parser.add_argument('--duration', type=float, default=30.0, help='每轮压测时长（秒）')
+    parser.add_argument('--timeout', type=float, default=30.0, help='单请求超时（秒）')
+    parser.add_argument('--max-workers', type=int, default=256, help='开环模式最大在途请求数')
+    parser.add_argument('--mix', help='问题类型权重，如 "Fact Retrieval=3,Complex Reasoning=1"')
+    parser.add_argument('--zh-ratio', type=float, default=0.5, help='要求中文回答的比例')
+    parser.add_argument('--rag-ratio', type=float, default=1.0, help='使用RAG的比例')
+    parser.add_argument('--format', default='html', choices=['html', 'json'])
+    parser.add_argument('--stub-encoder', type=float, metavar='SECONDS', help='使用桩编码器，参数为每次encode的延迟')
+    parser.add_argument('--stub-translator', type=float, metavar='SECONDS', help='使用桩翻译后端，参数为每批翻译的延迟')
+    parser.add_argument('--translation-backend', choices=['local', 'remote', 'tiered'], help='不使用桩时的翻译后端')
+    parser.add_argument('--find-saturation', action='store_true', help='逐级提高速率寻找饱和点')
+    parser.add_argument('--rate-step', type=float, default=1.5, help='饱和搜索每级速率倍数')
+    parser.add_argument('--max-steps', type=int, default=10)
+    parser.add_argument('--slo-p99', type=float, default=2.0, help='饱和判定：p99延迟上限（秒）')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='饱和判定：错误+超时率上限')
+    parser.add_argument('--scale-workers', type=int, nargs='+', metavar='N',
+                        help='用 serve.py 依次以 N 个worker启动服务并压测（如 1 2 4），比较吞吐扩展')
+    parser.add_argument('--scale-threads', type=int, default=8, help='--scale-workers 每个worker的线程数')
+    parser.add_argument('--scale-startup-timeout', type=float, default=300.0, help='等待 serve.py 就绪的最长时间（秒）')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='结果写入JSON文件')
+    args = parser.parse_args()
+
+    if args.scale_workers:
+        mix = QueryMix(parse_mix(args.mix), args.zh_ratio, args.rag_ratio, args.format, args.seed)
+        print(f"🎯 serve.py 多进程扩展测试（CPU核数 {os.cpu_count()}，并发={args.concurrency}）")
+        report = run_worker_scaling(mix, args)
+        for step in report['steps']:
+            print(f"   workers={step['workers']:<3} 吞吐 {step['throughput_rps']:.2f} rps，加速比 {step['speedup']}")
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({'config': vars(args), 'result': report}, f, ensure_ascii=False, indent=2)
+            print(f"✅ 结果已写入 {args.output}")
+        return
+
+    if args.url:
+        target = HttpTarget(args.url)
+        print(f"🎯 压测目标: {args.url}")
+    else:
+        fa = setup_app(args)
+        if args.serve:
+            server, base_url = start_local_server(fa.app, args.port)
+            target = HttpTarget(base_url)
+            print(f"🎯 压测目标: {base_url}（本进程多线程服务）")
+        else:
+            target = InProcessTarget(fa.app)
+            print("🎯 压测目标: 进程内 test_client")
+
+    mix = QueryMix(parse_mix(args.mix), args.zh_ratio, args.rag_ratio, args.format, args.seed)
+
+    if args.find_saturation:
+        report = find_saturation(target, mix, args)
+        print(f"\n📈 饱和点: {report['max_sustainable_rate']} 请求/秒")
+    elif args.mode == 'open':
+        report = run_open_loop(target, mix, args.rate, args.duration, args.timeout, args.max_workers, args.seed)
+        print_summary(f"rate={args.rate:.2f}/s", report)
+    else:
+        report = run_closed_loop(target, mix, args.concurrency, args.duration, args.timeout)
+        print_summary(f"并发={args.concurrency}", report)
+
+    report = {'config': {k: v for k, v in vars(args).items()}, 'result': report}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
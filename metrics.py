@@ -0,0 +1,264 @@
+# metrics.py - 运行指标
+"""
+进程内指标（Prometheus文本格式）
+
+提供直方图、计数器、仪表和回调指标，线程安全，无外部依赖。
+flask_app 在 /metrics 暴露 REGISTRY.render() 的输出。
+request_scope() 另外收集单个请求内的阶段耗时和事件计数，供请求日志使用。
+percentile() 是基准、压测和降级控制共用的分位数计算。
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# 各阶段延迟的默认分桶（秒），覆盖亚毫秒级到十秒级
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def _label_key(label_names: Tuple[str, ...], labels: Dict) -> Tuple:
+    return tuple(str(labels.get(name, '')) for name in label_names)
+
+
+def _format_labels(label_names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        return self.header() + list(self.samples())
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(self.label_names, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    metric_type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class CallbackMetric(Metric):
+    """渲染时调用回调取值，适合从已有结构（索引大小、队列长度、缓存统计）读数"""
+
+    def __init__(self, name, documentation, callback: Callable[[], Dict[Tuple, float]],
+                 label_names=(), metric_type='gauge'):
+        super().__init__(name, documentation, label_names)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def samples(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"指标回调失败 ({self.name}): {e}")
+            return
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.series = {}  # key -> [bucket_counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.label_names, labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self.series.items())
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name, documentation, callback, label_names=(), metric_type='gauge') -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, label_names, metric_type))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_LATENCY = REGISTRY.histogram(
+    'rag_stage_latency_seconds', 'Latency of each RAG pipeline stage', ('stage',)
+)
+
+
+_request_scope = contextvars.ContextVar('rag_request_scope', default=None)
+
+
+class RequestScope:
+    """单个请求内的阶段耗时（秒，同一阶段累加）和事件计数"""
+
+    def __init__(self):
+        self.stages = {}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_event(self, name: str, amount: int = 1):
+        with self.lock:
+            self.events[name] = self.events.get(name, 0) + amount
+
+
+def enter_request_scope():
+    """开启请求范围的收集，返回 (scope, token)；token 交给 exit_request_scope"""
+    scope = RequestScope()
+    return scope, _request_scope.set(scope)
+
+
+def exit_request_scope(token):
+    _request_scope.reset(token)
+
+
+def count_request_event(name: str, amount: int = 1):
+    """在当前请求范围内计数（没有请求范围时忽略）"""
+    scope = _request_scope.get()
+    if scope is not None:
+        scope.add_event(name, amount)
+
+
+def record_stage(stage: str, seconds: float):
+    """把一个阶段的耗时记入 rag_stage_latency_seconds{stage=...}，以及当前请求范围"""
+    STAGE_LATENCY.observe(seconds, stage=stage)
+    scope = _request_scope.get()
+    if scope is not None:
+        scope.add_stage(stage, seconds)
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """with 块形式的 observe_stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def observe_stage(stage: str):
+    """装饰器：把函数耗时记入 rag_stage_latency_seconds{stage=...}，以及当前请求范围"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
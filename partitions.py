@@ -0,0 +1,106 @@
+# partitions.py - 按元数据分区的过滤检索
+"""
+问题库条目按 type / source / language 分区，语料库chunks和段落按 source（'corpus'）/ language 分区，
+每个分区值保存一个有序的行号数组；过滤检索先按分区取出候选行号（同一字段内取并集，不同字段取交集），
+关键词/问题库打分只扫描这些行，FAISS检索用这些行的位图（IDSelectorBitmap）预过滤，其余向量不计算距离
+
+- 过滤条件只约束具有该字段的数据：type 只作用于问题库，chunks没有 type 字段，不受限制；
+  source 的取值中不含 'corpus' 时语料库结果被排除
+- 当前请求的过滤条件放在 contextvar 中（与降级级别相同），检索函数不需要逐层传参，
+  批量查询和ASGI线程池通过复制上下文继承
+"""
+import contextvars
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+FILTER_FIELDS = ('type', 'source', 'language')
+EMPTY_ROWS = np.zeros(0, dtype=np.int32)
+
+_current_filters = contextvars.ContextVar('rag_filters', default=None)
+
+
+def text_language(text: str, min_ratio: float = 0.2) -> str:
+    """语料库文本的语言：中文字符占非空白字符的比例不低于 min_ratio 为 zh，否则 en
+    （英文原文中夹杂的零星中文字符不改变语言）"""
+    chars = len(text) - text.count(' ') - text.count('\n')
+    chinese = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+    return 'zh' if chars and chinese / chars >= min_ratio else 'en'
+
+
+def parse_filters(raw) -> Optional[Dict[str, List[str]]]:
+    """请求中的 filters：{"type": "Fact Retrieval" 或 [...], "source": ..., "language": "en"}；格式错误抛出 ValueError"""
+    if not raw:
+        return None
+    if not isinstance(raw, dict):
+        raise ValueError('filters 必须是对象')
+    filters = {}
+    for field, values in raw.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"不支持的过滤字段: {field}（可用: {', '.join(FILTER_FIELDS)}）")
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not values or not all(isinstance(v, str) for v in values):
+            raise ValueError(f"过滤字段 {field} 的值必须是字符串或非空字符串列表")
+        filters[field] = [v.strip().lower() for v in values]
+    return filters or None
+
+
+def current_filters() -> Optional[Dict[str, List[str]]]:
+    return _current_filters.get()
+
+
+def set_filters(filters: Optional[Dict[str, List[str]]]):
+    """设置当前请求的过滤条件，返回 token（交给 reset_filters）"""
+    return _current_filters.set(filters)
+
+
+def reset_filters(token):
+    _current_filters.reset(token)
+
+
+def corpus_excluded(filters: Optional[Dict[str, List[str]]]) -> bool:
+    """source 过滤不包含语料库（分片部署时web进程没有chunks分区，只按这个判断是否查询分片）"""
+    return bool(filters) and 'source' in filters and 'corpus' not in filters['source']
+
+
+class PartitionIndex:
+    """每个字段的每个取值 -> 有序行号数组（int32）"""
+
+    def __init__(self, fields: Dict[str, Sequence[str]]):
+        self.size = len(next(iter(fields.values()), []))
+        self.rows = {}
+        self.labels = {}
+        for field, values in fields.items():
+            groups = {}
+            labels = {}
+            for row, value in enumerate(values):
+                key = str(value).lower()
+                groups.setdefault(key, []).append(row)
+                labels.setdefault(key, str(value))
+            self.rows[field] = {key: np.asarray(rows, dtype=np.int32) for key, rows in groups.items()}
+            self.labels[field] = labels
+
+    def select(self, filters: Optional[Dict[str, List[str]]]) -> Optional[np.ndarray]:
+        """符合过滤条件的行号（升序）；没有适用的过滤条件时返回 None（表示全部）"""
+        if not filters:
+            return None
+        selected = None
+        for field, values in filters.items():
+            partitions = self.rows.get(field)
+            if partitions is None:
+                continue  # 这类数据没有该字段
+            parts = [partitions.get(value, EMPTY_ROWS) for value in values]
+            rows = parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts))
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        return selected
+
+    def bitmap(self, rows: np.ndarray) -> np.ndarray:
+        """行号 -> faiss IDSelectorBitmap 使用的位图（每字节低位在前）"""
+        mask = np.zeros(self.size, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask, bitorder='little')
+
+    def sizes(self) -> Dict[str, Dict[str, int]]:
+        return {field: {self.labels[field][key]: int(len(rows)) for key, rows in sorted(partitions.items())}
+                for field, partitions in self.rows.items()}
@@ -0,0 +1,287 @@
+# profiling.py - 按需请求剖析与链路追踪
+"""
+单个请求的 cProfile 剖析和 span 级链路追踪
+
+- 追踪：@traced(name) 装饰的函数在请求开启追踪时记录span，
+  请求结束后写成 OpenTelemetry(OTLP/JSON) 兼容的本地文件；未开启追踪时几乎无开销
+- 剖析：对该请求所在线程启用 cProfile，保存 .prof（pstats格式）和文本摘要
+- 开启方式：特权请求头（令牌匹配）或按采样率随机开启，由 flask_app 的请求钩子决定
+- 内存：deep_sizeof 估算结构的字节数，MemorySnapshots 做两次调用之间的 tracemalloc 差异
+"""
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import secrets
+import threading
+import sys
+import time
+import tracemalloc
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Optional
+
+_current_trace = contextvars.ContextVar('rag_current_trace', default=None)
+_current_span = contextvars.ContextVar('rag_current_span', default=None)
+
+
+class Trace:
+    """一个请求内的全部span"""
+
+    def __init__(self, name: str, attributes: Optional[Dict] = None):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+        self.lock = threading.Lock()
+        self.root = Span(self, name, None, attributes)
+
+    def add(self, span: 'Span'):
+        with self.lock:
+            self.spans.append(span)
+
+    def to_otlp(self, service_name: str = 'medical-rag') -> Dict:
+        with self.lock:
+            spans = [span.to_otlp() for span in self.spans]
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_attribute('service.name', service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'medical-rag.profiling'},
+                    'spans': spans,
+                }],
+            }]
+        }
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str, parent: Optional['Span'], attributes: Optional[Dict] = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else ''
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.trace.add(self)
+
+    def to_otlp(self) -> Dict:
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id,
+            'name': self.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or self.start_ns),
+            'attributes': [_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        return span
+
+
+def _attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def traced(name: str):
+    """装饰器：请求开启追踪时，为函数调用记录一个span"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            span = Span(trace, name, _current_span.get(), {'thread': threading.current_thread().name})
+            token = _current_span.set(span)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                span.error = repr(e)
+                raise
+            finally:
+                _current_span.reset(token)
+                span.end()
+        return wrapper
+    return decorator
+
+
+def map_with_context(executor, func, items):
+    """executor.map 的变体：每个任务在提交线程上下文的副本中运行，保留span父子关系"""
+    tasks = [(contextvars.copy_context(), item) for item in items]
+    return executor.map(lambda task: task[0].run(func, task[1]), tasks)
+
+
+class RequestProfiler:
+    """管理单个请求的剖析会话，以及剖析结果的存储、列出和清理"""
+
+    def __init__(self, output_dir: Path, max_files: int = 200):
+        self.output_dir = Path(output_dir)
+        self.max_files = max_files
+
+    def should_profile(self, header_token: Optional[str], expected_token: str, sample_rate: float) -> bool:
+        if expected_token and header_token and secrets.compare_digest(header_token, expected_token):
+            return True
+        return sample_rate > 0 and random.random() < sample_rate
+
+    def start(self, name: str, mode: str = 'both', attributes: Optional[Dict] = None) -> Dict:
+        """在当前线程开启追踪和/或cProfile，返回会话对象（交给finish）"""
+        session = {
+            'id': time.strftime('%Y%m%d-%H%M%S') + '-' + secrets.token_hex(4),
+            'mode': mode,
+            'trace': None,
+            'profiler': None,
+            'tokens': None,
+        }
+        if mode in ('trace', 'both'):
+            trace = Trace(name, attributes)
+            session['trace'] = trace
+            session['tokens'] = (_current_trace.set(trace), _current_span.set(trace.root))
+        if mode in ('cprofile', 'both'):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                session['profiler'] = profiler
+            except ValueError as e:  # 同一线程已有其它剖析器
+                print(f"无法启动cProfile: {e}")
+        return session
+
+    def finish(self, session: Dict, attributes: Optional[Dict] = None) -> str:
+        """结束会话并写出文件，返回剖析ID"""
+        profiler = session.get('profiler')
+        if profiler is not None:
+            profiler.disable()
+        trace = session.get('trace')
+        if session.get('tokens'):
+            trace_token, span_token = session['tokens']
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        profile_id = session['id']
+        if trace is not None:
+            trace.root.attributes.update(attributes or {})
+            trace.root.end()
+            with open(self.output_dir / f"{profile_id}.trace.json", 'w', encoding='utf-8') as f:
+                json.dump(trace.to_otlp(), f, ensure_ascii=False)
+        if profiler is not None:
+            profiler.dump_stats(str(self.output_dir / f"{profile_id}.prof"))
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(50)
+            with open(self.output_dir / f"{profile_id}.txt", 'w', encoding='utf-8') as f:
+                f.write(summary.getvalue())
+        self.cleanup()
+        return profile_id
+
+    def list_profiles(self) -> List[Dict]:
+        if not self.output_dir.exists():
+            return []
+        profiles = {}
+        for path in self.output_dir.iterdir():
+            profile_id, _, kind = path.name.partition('.')
+            entry = profiles.setdefault(profile_id, {'id': profile_id, 'files': [], 'mtime': 0})
+            entry['files'].append(kind)
+            entry['mtime'] = max(entry['mtime'], path.stat().st_mtime)
+        return sorted(profiles.values(), key=lambda p: p['mtime'], reverse=True)
+
+    def profile_path(self, profile_id: str, kind: str) -> Optional[Path]:
+        """kind: trace.json / prof / txt；只允许访问剖析目录下的文件"""
+        if kind not in ('trace.json', 'prof', 'txt') or not profile_id.replace('-', '').isalnum():
+            return None
+        path = self.output_dir / f"{profile_id}.{kind}"
+        return path if path.exists() else None
+
+    def cleanup(self):
+        """只保留最近 max_files 个剖析结果"""
+        profiles = self.list_profiles()
+        for entry in profiles[self.max_files:]:
+            for kind in entry['files']:
+                try:
+                    os.remove(self.output_dir / f"{entry['id']}.{kind}")
+                except OSError:
+                    pass
+
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    """递归估算对象占用的字节数（seen用于跨结构去重）"""
+    if seen is None:
+        seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)  # numpy数组持有数据时已包含nbytes，视图只计数组头
+        if hasattr(item, 'dtype'):
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return total
+
+
+class MemorySnapshots:
+    """tracemalloc 快照差异：每次 diff 与上一次快照比较，然后以新快照为基准"""
+
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self.baseline = None
+        self.lock = threading.Lock()
+
+    def start(self) -> Dict:
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            self.baseline = tracemalloc.take_snapshot()
+        return self.status()
+
+    def stop(self) -> Dict:
+        with self.lock:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self.baseline = None
+        return self.status()
+
+    def status(self) -> Dict:
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        return {'tracing': tracemalloc.is_tracing(), 'traced_bytes': current, 'traced_peak_bytes': peak}
+
+    def diff(self, limit: int = 20, group_by: str = 'lineno') -> Dict:
+        """返回与上次快照相比增长最多的分配位置；未开启时先开启并记录基准"""
+        with self.lock:
+            if not tracemalloc.is_tracing() or self.baseline is None:
+                started = True
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(self.frames)
+                self.baseline = tracemalloc.take_snapshot()
+                top = []
+            else:
+                started = False
+                snapshot = tracemalloc.take_snapshot()
+                stats = snapshot.compare_to(self.baseline, group_by)
+                self.baseline = snapshot
+                top = [{
+                    'location': str(stat.traceback),
+                    'size_diff_bytes': stat.size_diff,
+                    'size_bytes': stat.size,
+                    'count_diff': stat.count_diff,
+                    'count': stat.count,
+                } for stat in stats[:limit]]
+        result = self.status()
+        result.update({'baseline_started': started, 'top': top})
+        return result
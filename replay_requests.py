@@ -0,0 +1,147 @@
+# replay_requests.py - 请求日志回放
+"""
+把 request_log 记录的真实流量回放到 /api/query
+
+- 节奏：--speed 1 按原始到达间隔，--speed 10 加速十倍，--speed 0 不等待（尽快发送）
+- 目标：与 load_test.py 相同（进程内 test_client、--url 已有服务、--serve 本进程HTTP服务）
+- 输出：吞吐、延迟分位数、错误率，以及与日志中结果id的重合度（评估索引/缓存改动对结果的影响）
+
+用法：
+    python replay_requests.py --log logs/query_log.jsonl --speed 5 --translation-backend local
+    python replay_requests.py --url http://localhost:5000 --speed 0 --limit 500 --output replay.json
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from load_test import HttpTarget, InProcessTarget, Recorder, print_summary, setup_app, start_local_server
+from request_log import read_log, result_id
+
+
+def load_records(path: str, limit: int = 0) -> List[Dict]:
+    """读取日志中的 /api/query 记录，按时间排序"""
+    records = [r for r in read_log(path) if r.get('endpoint') == 'query' and r.get('question')]
+    records.sort(key=lambda r: r.get('ts', 0))
+    return records[:limit] if limit else records
+
+
+def response_result_ids(body: Dict) -> List:
+    """format=json 响应中的结果id（与日志中的 result_ids 格式一致）"""
+    return [result_id(item) for item in body.get('sources') or body.get('results') or []]
+
+
+class OverlapRecorder(Recorder):
+    """在延迟统计之外记录回放结果与日志结果的重合度"""
+
+    def __init__(self, timeout: float):
+        super().__init__(timeout)
+        self.overlaps = []
+        self.exact_matches = 0
+
+    def record_results(self, recorded: List, replayed: List):
+        recorded_ids = {i for i in recorded if i}
+        replayed_ids = {i for i in replayed if i}
+        if not recorded_ids and not replayed_ids:
+            return
+        overlap = len(recorded_ids & replayed_ids) / len(recorded_ids | replayed_ids)
+        with self.lock:
+            self.overlaps.append(overlap)
+            if recorded == replayed:
+                self.exact_matches += 1
+
+    def summary(self, elapsed: float, offered_rate=None) -> Dict:
+        result = super().summary(elapsed, offered_rate)
+        compared = len(self.overlaps)
+        result['compared'] = compared
+        result['mean_result_overlap'] = round(sum(self.overlaps) / compared, 4) if compared else None
+        result['exact_result_match_rate'] = round(self.exact_matches / compared, 4) if compared else None
+        return result
+
+
+def replay(target, records: List[Dict], speed: float, timeout: float, max_workers: int) -> Dict:
+    """按日志时间戳（除以speed）调度请求"""
+    recorder = OverlapRecorder(timeout)
+    if not records:
+        return recorder.summary(0.0)
+    first_ts = records[0].get('ts', 0)
+
+    def send(record: Dict, scheduled: float):
+        payload = {
+            'question': record['question'],
+            'answer_language': record.get('answer_language', 'zh'),
+            'use_rag': record.get('use_rag', True),
+            'filters': record.get('filters'),
+            'format': 'json',
+        }
+        try:
+            status, body = target.request(payload, timeout)
+        except Exception as e:
+            print(f"请求异常: {e}")
+            status, body = -1, {}
+        recorder.record(time.perf_counter() - scheduled, status)
+        if status == 200 and 'result_ids' in record:
+            recorder.record_results(record['result_ids'], response_result_ids(body))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for n, record in enumerate(records, 1):
+            offset = (record.get('ts', first_ts) - first_ts) / speed if speed > 0 else 0.0
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, record, max(scheduled, start))
+            if n % 100 == 0:
+                print(f"   已发送 {n}/{len(records)} 个请求")
+    elapsed = time.perf_counter() - start
+    offered_rate = len(records) / offset if speed > 0 and offset > 0 else None
+    return recorder.summary(elapsed, round(offered_rate, 2) if offered_rate else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='请求日志回放')
+    parser.add_argument('--log', default=os.path.join('logs', 'query_log.jsonl'), help='请求日志路径（含轮转文件）')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放速度倍数（0表示不等待）')
+    parser.add_argument('--limit', type=int, default=0, help='最多回放的请求数（0表示全部）')
+    parser.add_argument('--url', help='回放到已运行的服务，不指定则在本进程内回放')
+    parser.add_argument('--serve', action='store_true', help='在本进程启动多线程HTTP服务并通过localhost回放')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=30.0, help='单请求超时（秒）')
+    parser.add_argument('--max-workers', type=int, default=64, help='最大在途请求数')
+    parser.add_argument('--stub-encoder', type=float, metavar='SECONDS', help='使用桩编码器，参数为每次encode的延迟')
+    parser.add_argument('--stub-translator', type=float, metavar='SECONDS', help='使用桩翻译后端，参数为每批翻译的延迟')
+    parser.add_argument('--translation-backend', choices=['local', 'remote', 'tiered'], help='不使用桩时的翻译后端')
+    parser.add_argument('--output', help='结果写入JSON文件')
+    args = parser.parse_args()
+
+    records = load_records(args.log, args.limit)
+    if not records:
+        raise SystemExit(f"日志中没有可回放的请求: {args.log}")
+    print(f"📼 读取 {len(records)} 个请求（{args.log}）")
+
+    if args.url:
+        target = HttpTarget(args.url)
+    else:
+        fa = setup_app(args)
+        if args.serve:
+            server, base_url = start_local_server(fa.app, args.port)
+            target = HttpTarget(base_url)
+        else:
+            target = InProcessTarget(fa.app)
+
+    report = replay(target, records, args.speed, args.timeout, args.max_workers)
+    print_summary(f"speed={args.speed:g}", report)
+    if report['compared']:
+        print(f"   结果重合度 {report['mean_result_overlap']:.2%}，完全一致 {report['exact_result_match_rate']:.2%}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'log': args.log, 'speed': args.speed, 'result': report}, f, ensure_ascii=False, indent=2)
+        print(f"\n✅ 结果已写入 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+# request_log.py - 结构化请求日志
+"""
+异步JSONL请求日志与历史查询统计
+
+- RequestLogger：请求线程只把记录放进有界缓冲（满了就丢弃并计数，不阻塞请求），
+  后台线程批量写入JSONL，文件超过 max_bytes 时轮转为 .1 .. .N
+- read_log：读取日志（含轮转文件和多进程部署下各worker的文件）
+- top_queries：统计最常见的查询，用于启动时预热缓存
+- replay_requests.py 读取同一日志按原始节奏或加速回放
+"""
+import json
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+_STOP = object()
+
+
+class RequestLogger:
+    def __init__(self, path: Path, max_bytes: int = 50 * 1024 * 1024, backup_count: int = 5,
+                 buffer_size: int = 10000):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.written = 0
+        self.dropped = 0
+        self.file = None
+        self.worker_thread = threading.Thread(target=self._worker, name='request-log', daemon=True)
+        self.worker_thread.start()
+
+    def log(self, record: Dict):
+        """非阻塞写入：缓冲区满时丢弃该记录"""
+        record.setdefault('ts', time.time())
+        try:
+            self.buffer.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _worker(self):
+        while True:
+            batch = [self.buffer.get()]
+            while len(batch) < 256:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(item is _STOP for item in batch)
+            records = [item for item in batch if item is not _STOP]
+            try:
+                if records:
+                    self._write(records)
+            except Exception as e:
+                print(f"请求日志写入失败: {e}")
+            finally:
+                for _ in batch:
+                    self.buffer.task_done()
+            if stop:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+
+    def _write(self, records: List[Dict]):
+        if self.file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self.file.flush()
+        self.written += len(records)
+        if self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for i in range(self.backup_count - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            os.remove(self.path)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待缓冲区写完，返回是否在超时前完成"""
+        deadline = time.time() + timeout
+        while self.buffer.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+        return not self.buffer.unfinished_tasks
+
+    def close(self, timeout: float = 5.0):
+        self.buffer.put(_STOP)
+        self.worker_thread.join(timeout)
+
+    def stats(self) -> Dict:
+        return {'written': self.written, 'dropped': self.dropped, 'buffered': self.buffer.qsize()}
+
+
+def result_id(result: Dict):
+    """检索结果的标识：语料库chunk id 或 question:<问题id>"""
+    if result.get('chunk_id'):
+        return result['chunk_id']
+    question_id = result.get('question_id')
+    return f"question:{question_id}" if question_id else None
+
+
+def worker_log_path(path: Path, worker_id: int) -> Path:
+    """多进程部署时每个worker写自己的日志文件（避免多进程同时轮转同一文件）"""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.w{worker_id}{path.suffix}")
+
+
+def _family_files(path: Path) -> List[Path]:
+    rotated = sorted((p for p in path.parent.glob(f"{path.name}.*") if p.suffix[1:].isdigit()),
+                     key=lambda p: int(p.suffix[1:]), reverse=True)
+    return rotated + ([path] if path.exists() else [])
+
+
+def log_files(path: Path) -> List[Path]:
+    """日志文件列表（含轮转文件和各worker的文件），每组中最旧的在前"""
+    path = Path(path)
+    files = _family_files(path)
+    if path.parent.exists():
+        for worker_path in sorted(path.parent.glob(f"{path.stem}.w*{path.suffix}")):
+            files.extend(_family_files(worker_path))
+    return files
+
+
+def read_log(path: Path) -> Iterator[Dict]:
+    """逐个文件读取日志记录（跳过损坏的行）；多worker日志需要按 ts 排序"""
+    for log_file in log_files(path):
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def top_queries(path: Path, n: int = 50) -> List[Dict]:
+    """最常见的 n 个成功查询（按问题、回答语言、是否RAG分组）"""
+    counts = Counter()
+    for record in read_log(path):
+        if record.get('success') and record.get('question'):
+            counts[(record['question'], record.get('answer_language', 'zh'), bool(record.get('use_rag', True)))] += 1
+    return [{'question': question, 'answer_language': language, 'use_rag': use_rag, 'count': count}
+            for (question, language, use_rag), count in counts.most_common(n)]
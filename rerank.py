@@ -0,0 +1,98 @@
+# rerank.py - 两阶段级联检索的重排阶段
+"""
+第一阶段（关键词 + 向量检索）多取 N 个候选，第二阶段只对这些候选用更重的打分器重新打分
+
+- EmbeddingReranker：全精度嵌入（如第一阶段用 onnx-int8 时用 torch 模型）的查询-候选余弦相似度
+- CrossEncoderReranker：sentence-transformers 的 CrossEncoder，对 (查询, 候选) 成对打分
+- cascade_rerank：按第一阶段顺序分批打分，每批之前检查预算（墙钟或本线程CPU时间，
+  以及请求的剩余时限），预计下一批会超出预算时停止；
+  已打分的候选按重排分数排在前面，未打分的保持第一阶段顺序排在后面
+"""
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from admission import Deadline
+
+CLOCKS = {'wall': time.perf_counter, 'cpu': time.thread_time}
+
+
+class EmbeddingReranker:
+    name = 'embedding'
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray]):
+        self.encode = encode
+
+    def scorer(self, query: str) -> Callable[[Sequence[str]], np.ndarray]:
+        query_embedding = None
+
+        def score(texts: Sequence[str]) -> np.ndarray:
+            nonlocal query_embedding
+            embeddings = self.encode(list(texts) if query_embedding is not None else [query] + list(texts))
+            if embeddings is None:
+                raise RuntimeError('编码返回空结果')
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if query_embedding is None:
+                query_embedding, candidates = embeddings[0], embeddings[1:]
+            else:
+                candidates = embeddings
+            norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(query_embedding)
+            return candidates @ query_embedding / np.clip(norms, 1e-12, None)
+        return score
+
+
+class CrossEncoderReranker:
+    name = 'cross-encoder'
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name)
+
+    def scorer(self, query: str) -> Callable[[Sequence[str]], np.ndarray]:
+        def score(texts: Sequence[str]) -> np.ndarray:
+            pairs = [(query, text) for text in texts]
+            return np.asarray(self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False),
+                              dtype=np.float32).reshape(-1)
+        return score
+
+
+def cascade_rerank(query: str, candidates: List[Dict], reranker, top_k: int, budget_ms: float,
+                   batch_size: int = 8, clock: str = 'wall', max_chars: int = 2000,
+                   deadline: Optional[Deadline] = None) -> Tuple[List[Dict], Dict]:
+    """返回 (重排后的前 top_k 个, 统计)"""
+    now = CLOCKS[clock]
+    report = {'candidates': len(candidates), 'scored': 0, 'batches': 0, 'budget_exhausted': False,
+              'ms': 0.0, 'cpu_ms': 0.0}
+    if reranker is None or not candidates:
+        return candidates[:top_k], report
+    start, wall_start, cpu_start = now(), time.perf_counter(), time.thread_time()
+    budget = budget_ms / 1000
+    score = reranker.scorer(query)
+    scores = []
+    last_batch = 0.0
+    for offset in range(0, len(candidates), batch_size):
+        elapsed = now() - start
+        if elapsed + last_batch > budget or (deadline is not None and deadline.remaining() <= last_batch):
+            report['budget_exhausted'] = True
+            break
+        batch_start = now()
+        texts = [candidate['text'][:max_chars] for candidate in candidates[offset:offset + batch_size]]
+        try:
+            scores.extend(float(value) for value in score(texts))
+        except Exception as e:
+            print(f"重排打分失败，保留第一阶段顺序: {e}")
+            break
+        last_batch = now() - batch_start
+        report['batches'] += 1
+
+    scored = []
+    for candidate, value in zip(candidates, scores):
+        result = dict(candidate)
+        result['rerank_score'] = value
+        scored.append(result)
+    scored.sort(key=lambda result: result['rerank_score'], reverse=True)
+    report['scored'] = len(scored)
+    report['ms'] = round((time.perf_counter() - wall_start) * 1000, 3)
+    report['cpu_ms'] = round((time.thread_time() - cpu_start) * 1000, 3)
+    return (scored + candidates[len(scored):])[:top_k], report
@@ -0,0 +1,334 @@
+# serve.py - 生产部署入口（预加载 + fork 多进程）
+"""
+主进程只加载一次数据、嵌入模型、向量索引和问题库，然后fork出N个worker；
+fork后这些只读结构以写时复制方式在worker间共享，不会按worker数成倍占用内存
+
+- 每个worker：共享监听socket，固定大小的线程池处理连接（--threads）
+- 就绪：worker通过管道通知主进程；崩溃的worker自动重启
+- 滚动重载：SIGHUP 或数据文件（语料库/问题集）修改时间变化 ->
+  主进程重新加载数据，再逐个替换worker（新worker就绪后才优雅停止旧worker），服务不中断
+- 优雅停止：SIGTERM/SIGINT -> 各worker停止接受新连接，处理完在途请求后退出（--graceful-timeout 后强制结束）
+- BLAS/OpenMP 线程数默认设为1（RAG_OMP_THREADS），避免 N 个worker × 多线程争抢CPU，
+  也避免fork时继承已启动的OpenMP线程池
+
+用法：
+    python serve.py --workers 4 --threads 8 --port 5000
+    python load_test.py --scale-workers 1 2 4 --stub-encoder 0.005   # 吞吐随worker数的扩展情况
+"""
+import argparse
+import gc
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+for _var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_var, os.environ.get('RAG_OMP_THREADS', '1'))
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 keep-alive：一个连接在处理期间占用一个池线程，
+    所以有连接在排队时响应后关闭当前连接让出线程，空闲连接 timeout 秒后关闭
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def handle_one_request(self):
+        super().handle_one_request()
+        if self.server.waiting > 0:
+            self.close_connection = True
+
+    def log_request(self, code='-', size='-'):
+        if self.server.access_log:
+            super().log_request(code, size)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """使用已绑定的socket（fd）和固定大小线程池的WSGI服务"""
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads: int, fd: int, access_log: bool = False):
+        super().__init__(host, port, app, handler=KeepAliveHandler, fd=fd)
+        self.access_log = access_log
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self.waiting = 0  # 已接受、还没有线程处理的连接数
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.waiting += 1
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        with self.lock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def drain(self):
+        """等待在途连接处理完"""
+        self.pool.shutdown(wait=True)
+
+
+def load_app(args):
+    """导入 flask_app、按参数替换桩，并加载数据和向量（在主进程中执行）"""
+    if args.stub_encoder is not None:
+        os.environ['RAG_EMBEDDING_MODEL'] = 'none'
+    import flask_app as fa
+    from translation import create_translation_backend
+
+    if args.stub_encoder is not None:
+        from load_test import StubEncoder
+        fa.set_embedding_model(StubEncoder(latency=args.stub_encoder))
+    if args.stub_translator is not None:
+        fa.translation_queue.backend = create_translation_backend('stub', stub_latency=args.stub_translator)
+    elif args.translation_backend:
+        fa.translation_queue.backend = create_translation_backend(
+            args.translation_backend, terms_path=str(fa.MEDICAL_TERMS_PATH),
+            latency_budget=fa.RAG_CONFIG['translation_latency_budget']
+        )
+    prepare(fa)
+    return fa
+
+
+def prepare(fa):
+    """加载数据和索引、预热缓存，然后冻结GC（fork后GC不再改写这些对象的头部，保持页共享）"""
+    gc.unfreeze()
+    fa.initialize_data_and_vectors()
+    if fa.RAG_CONFIG['prewarm_top_queries'] > 0:
+        warmed = fa.prewarm_from_request_log(fa.RAG_CONFIG['prewarm_top_queries'])
+        print(f"   已用 {warmed} 个历史查询预热缓存")
+    gc.collect()
+    gc.freeze()
+
+
+def data_mtimes(fa):
+    return tuple(path.stat().st_mtime if path.exists() else None
+                 for path in (fa.CORPUS_PATH, fa.QUESTIONS_PATH))
+
+
+def run_worker(fa, slot: int, sock: socket.socket, args, ready_fd: int):
+    """worker进程主体（不返回）"""
+    status = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C 由主进程统一处理
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        fa.after_fork(slot)
+        server = PooledWSGIServer(args.host, args.port, fa.app, args.threads, sock.fileno(), args.access_log)
+        stopping = threading.Event()
+
+        def on_term(signum, frame):
+            if not stopping.is_set():
+                stopping.set()
+                threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, on_term)
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+        server.serve_forever(poll_interval=0.5)
+        server.drain()
+        if fa.request_logger is not None:
+            fa.request_logger.close()
+    except Exception as e:
+        print(f"worker {slot} 异常退出: {e}")
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class Master:
+    def __init__(self, fa, args):
+        self.fa = fa
+        self.args = args
+        self.workers = {}  # pid -> slot
+        self.started_at = {}
+        self.stopping = False
+        self.reload_requested = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((args.host, args.port))
+        self.sock.listen(args.backlog)
+        self.sock.setblocking(False)  # 多个worker竞争accept，没抢到的立即返回而不是阻塞
+        self.sock.set_inheritable(True)
+
+    def spawn(self, slot: int):
+        """fork一个worker并等待就绪，返回pid（未就绪返回None）"""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            run_worker(self.fa, slot, self.sock, self.args, write_fd)
+        os.close(write_fd)
+        try:
+            ready, _, _ = select.select([read_fd], [], [], self.args.ready_timeout)
+            ok = bool(ready) and os.read(read_fd, 1) == b'1'
+        finally:
+            os.close(read_fd)
+        if not ok:
+            print(f"❌ worker {slot} (pid {pid}) 未能就绪")
+            self.kill(pid)
+            return None
+        self.workers[pid] = slot
+        self.started_at[pid] = time.time()
+        return pid
+
+    def kill(self, pid: int):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+    def stop_worker(self, pid: int):
+        """SIGTERM 后等待退出，超过 graceful_timeout 强制结束"""
+        self.workers.pop(pid, None)
+        self.started_at.pop(pid, None)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        deadline = time.time() + self.args.graceful_timeout
+        while time.time() < deadline:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if done:
+                return
+            time.sleep(0.05)
+        print(f"⚠️  worker pid {pid} 未在 {self.args.graceful_timeout}s 内退出，强制结束")
+        self.kill(pid)
+
+    def reap(self):
+        """回收意外退出的worker并在同一槽位重启"""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.workers.pop(pid, None)
+            started = self.started_at.pop(pid, time.time())
+            if slot is None or self.stopping:
+                continue
+            print(f"⚠️  worker {slot} (pid {pid}) 退出，状态 {status}，重启中")
+            if time.time() - started < 1.0:
+                time.sleep(1.0)  # 启动即崩溃时避免快速循环重启
+            self.spawn(slot)
+
+    def reload(self):
+        """重新加载数据，然后逐个替换worker"""
+        print("🔄 重新加载数据...")
+        try:
+            prepare(self.fa)
+        except Exception as e:
+            print(f"重新加载失败，继续使用旧worker: {e}")
+            return
+        for old_pid, slot in sorted(self.workers.items(), key=lambda item: item[1]):
+            if self.spawn(slot) is None:
+                print("滚动重载中止：新worker未就绪，保留其余旧worker")
+                return
+            self.stop_worker(old_pid)
+        print(f"✅ 滚动重载完成（{len(self.workers)} 个worker）")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for slot in range(self.args.workers):
+            self.spawn(slot)
+        host, port = self.sock.getsockname()[:2]
+        print(f"🌐 http://{host}:{port}  {len(self.workers)} 个worker × {self.args.threads} 线程（主进程 pid {os.getpid()}）")
+
+        mtimes = data_mtimes(self.fa)
+        last_check = time.time()
+        while not self.stopping:
+            time.sleep(0.2)
+            self.reap()
+            if self.args.reload_interval > 0 and time.time() - last_check >= self.args.reload_interval:
+                last_check = time.time()
+                current = data_mtimes(self.fa)
+                if current != mtimes:
+                    print("📂 数据文件已修改")
+                    self.reload_requested = True
+            if self.reload_requested and not self.stopping:
+                self.reload_requested = False
+                mtimes = data_mtimes(self.fa)
+                self.reload()
+
+        print("🛑 停止所有worker...")
+        pids = list(self.workers)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.args.graceful_timeout
+        for pid in pids:
+            while time.time() < deadline:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if done:
+                    break
+                time.sleep(0.05)
+            else:
+                self.kill(pid)
+        self.workers.clear()
+        self.sock.close()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='预加载 + fork 多进程服务')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('RAG_WORKERS', os.cpu_count() or 1)),
+                        help='worker进程数（默认CPU核数）')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('RAG_THREADS', '8')),
+                        help='每个worker的请求线程数')
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--reload-interval', type=float, default=5.0,
+                        help='检查数据文件修改的间隔（秒，0表示只响应SIGHUP）')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0, help='worker优雅退出的最长等待（秒）')
+    parser.add_argument('--ready-timeout', type=float, default=60.0, help='等待新worker就绪的最长时间（秒）')
+    parser.add_argument('--access-log', action='store_true', help='打印每个请求的访问日志')
+    parser.add_argument('--stub-encoder', type=float, metavar='SECONDS', help='使用桩编码器（压测用）')
+    parser.add_argument('--stub-translator', type=float, metavar='SECONDS', help='使用桩翻译后端（压测用）')
+    parser.add_argument('--translation-backend', choices=['local', 'remote', 'tiered'], help='不使用桩时的翻译后端')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("🧠 双语医疗RAG问答系统（多进程部署）")
+    print("=" * 60)
+    fa = load_app(args)
+    doc_count, question_count, _, _ = fa.get_data_counts()
+    print(f"📊 语料库 {doc_count} 篇文档，问题集 {question_count} 个问题，"
+          f"RAG{'已就绪' if fa.GLOBAL_VECTOR_STORE_READY else '未启用'}")
+    Master(fa, args).run()
+
+
+if __name__ == '__main__':
+    main()
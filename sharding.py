@@ -0,0 +1,399 @@
+# sharding.py - 分片检索
+"""
+语料库分成N个分片，每个分片由独立的检索进程（本机或其它节点）持有自己的faiss索引和关键词数据，
+协调器把查询并行发给所有分片，合并各分片的top-k
+
+- 构建：按顺序把chunks（含向量）和段落切成N个连续区间，写入 shard_<i>.json（段落）/ shard_<i>.npy（向量）/
+  shard_<i>.chunks.txt（该区间覆盖的原文，UTF-8）/ shard_<i>.chunks.npy（chunk偏移）；分片进程内存映射原文
+- 分片进程：multiprocessing.connection 监听（unix:/path 或 host:port，authkey 认证），
+  每个连接一个线程，请求为一批查询（文本 + 查询向量），返回每个查询的语义和关键词top-k
+- 认证密钥：multiprocessing.connection 会反序列化（pickle）收到的数据，认证是唯一的保护，
+  因此分片进程和web进程都必须设置相同的 RAG_SHARD_AUTHKEY（没有默认值，未设置时拒绝启动）；
+  launch 在未设置时生成随机密钥传给子进程并打印出来
+- 协调器：查询向量只在web进程计算一次；在时限内等待各分片，超时或不可用的分片跳过
+  （结果只来自按时返回的分片），每个分片的延迟和状态记入 /metrics 和 /api/rag-status
+- 连续区间 + 稳定排序：合并结果与不分片时一致（同分情况下顺序也相同）
+
+用法：
+    python sharding.py build --num-shards 4 --dir shards
+    python sharding.py launch --dir shards            # 本机启动全部分片进程，打印 RAG_SHARD_AUTHKEY 和 RAG_SHARDS
+    RAG_SHARD_AUTHKEY=<密钥> python sharding.py serve --dir shards --shard 0 --listen 10.0.0.5:7100
+    RAG_SHARD_AUTHKEY=<密钥> RAG_SHARDS=unix:/tmp/rag-shard-0.sock,unix:/tmp/rag-shard-1.sock python flask_app.py
+"""
+import argparse
+import json
+import os
+import queue
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from chunking import ChunkStore
+from embedding_service import parse_address
+from metrics import REGISTRY, count_request_event
+
+SHARD_LATENCY = REGISTRY.histogram(
+    'rag_shard_latency_seconds', 'Per-shard retrieval latency seen by the coordinator', ('shard',)
+)
+SHARD_REQUESTS = REGISTRY.counter(
+    'rag_shard_requests_total', 'Shard requests by outcome (ok / timeout / error / unavailable)', ('shard', 'status')
+)
+
+
+def shard_authkey() -> bytes:
+    """分片连接的认证密钥（RAG_SHARD_AUTHKEY），未设置时抛出 ValueError"""
+    key = os.environ.get('RAG_SHARD_AUTHKEY', '')
+    if not key:
+        raise ValueError('未设置 RAG_SHARD_AUTHKEY：分片进程和web进程需要相同的认证密钥')
+    return key.encode('utf-8')
+
+
+def connection_address(address: str):
+    """unix:/path 或 host:port 转换为 multiprocessing.connection 的地址"""
+    return parse_address(address)[1]
+
+
+def keyword_scores(query: str, texts: Sequence[str]) -> List[Tuple[int, float]]:
+    """关键词打分：完整匹配+1，长词部分匹配+0.5，返回 [(下标, 分数)]（分数>0，保持原顺序）"""
+    query_terms = query.lower().split()
+    scored = []
+    for i, text in enumerate(texts):
+        text_lower = text.lower()
+        score = 0
+        for term in query_terms:
+            if term in text_lower:
+                score += 1
+            # 部分匹配
+            if len(term) > 3 and any(term in word for word in text_lower.split()):
+                score += 0.5
+        if score > 0:
+            scored.append((i, score))
+    return scored
+
+
+# ========== 构建 ==========
+def split_ranges(total: int, num_shards: int) -> List[Tuple[int, int]]:
+    bounds = np.linspace(0, total, num_shards + 1).astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(num_shards)]
+
+
+def write_shards(chunks: ChunkStore, embeddings: np.ndarray, paragraphs: List[str],
+                 num_shards: int, output_dir: Path) -> List[Dict]:
+    """把chunks（及向量）和段落按连续区间切分写入 output_dir"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    summary = []
+    for shard_id, ((c_start, c_end), (p_start, p_end)) in enumerate(
+            zip(split_ranges(len(chunks), num_shards), split_ranges(len(paragraphs), num_shards))):
+        np.save(output_dir / f"shard_{shard_id}.npy", embeddings[c_start:c_end])
+        store_meta = chunks.save(output_dir / f"shard_{shard_id}.chunks.txt", c_start, c_end)
+        with open(output_dir / f"shard_{shard_id}.json", 'w', encoding='utf-8') as f:
+            json.dump({'shard': shard_id, 'num_shards': num_shards, 'chunks': store_meta,
+                       'paragraphs': paragraphs[p_start:p_end]}, f, ensure_ascii=False)
+        summary.append({'shard': shard_id, 'chunks': c_end - c_start, 'paragraphs': p_end - p_start})
+    return summary
+
+
+# ========== 分片进程 ==========
+class ShardIndex:
+    """一个分片的语义索引（faiss，未安装时用numpy）和关键词数据"""
+
+    def __init__(self, shard_dir: Path, shard_id: int):
+        shard_dir = Path(shard_dir)
+        with open(shard_dir / f"shard_{shard_id}.json", 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.shard_id = shard_id
+        self.chunks = ChunkStore.load(shard_dir / f"shard_{shard_id}.chunks.txt", data['chunks']['duplicates'])
+        self.paragraphs = data['paragraphs']
+        self.embeddings = np.load(shard_dir / f"shard_{shard_id}.npy").astype(np.float32)
+        self.index = None
+        try:
+            import faiss
+            if len(self.embeddings):
+                self.index = faiss.IndexFlatL2(self.embeddings.shape[1])
+                self.index.add(self.embeddings)
+        except ImportError:
+            pass
+
+    def search(self, queries: List[str], query_embeddings: Optional[np.ndarray], top_k: int) -> List[Dict]:
+        """返回每个查询的 {'semantic': [...], 'keyword': [...]}，格式与 flask_app 的检索结果一致"""
+        semantic = [[] for _ in queries]
+        if query_embeddings is not None and len(self.embeddings):
+            matrix = np.asarray(query_embeddings, dtype=np.float32)
+            if self.index is not None:
+                D, I = self.index.search(matrix, min(top_k, len(self.embeddings)))
+            else:
+                distances = ((matrix[:, None, :] - self.embeddings[None, :, :]) ** 2).sum(axis=2)
+                I = np.argsort(distances, axis=1, kind='stable')[:, :top_k]
+                D = np.take_along_axis(distances, I, axis=1)
+            for row, (indices, dists) in enumerate(zip(I, D)):
+                chunks = [(self.chunks[idx], dist) for idx, dist in zip(indices, dists) if 0 <= idx < len(self.chunks)]
+                semantic[row] = [{
+                    'text': chunk['text'],
+                    'metadata': chunk,
+                    'similarity': float(-dist),
+                    'source': 'semantic_search'
+                } for chunk, dist in chunks]
+
+        results = []
+        for row, query in enumerate(queries):
+            scored = sorted(keyword_scores(query, self.paragraphs), key=lambda item: item[1], reverse=True)
+            keyword = [{
+                'text': self.paragraphs[i],
+                'metadata': {'text': self.paragraphs[i], 'metadata': {}},
+                'score': score,
+                'source': 'keyword_search'
+            } for i, score in scored[:top_k]]
+            results.append({'semantic': semantic[row], 'keyword': keyword})
+        return results
+
+    def info(self) -> Dict:
+        return {'shard': self.shard_id, 'chunks': len(self.chunks), 'paragraphs': len(self.paragraphs)}
+
+
+def serve_shard(index: ShardIndex, address: str, authkey: bytes):
+    if not authkey:
+        raise ValueError('分片进程必须设置认证密钥')
+    listen_address = connection_address(address)
+    if isinstance(listen_address, str) and os.path.exists(listen_address):
+        os.unlink(listen_address)  # 上次运行残留的socket文件
+    listener = Listener(listen_address, authkey=authkey)
+    print(f"✅ 分片 {index.shard_id} 已启动: {address}（{len(index.chunks)} chunks, {len(index.paragraphs)} 段落）")
+
+    def handle(conn):
+        try:
+            while True:
+                request = conn.recv()
+                try:
+                    if request[0] == 'search':
+                        _, queries, query_embeddings, top_k = request
+                        conn.send(('ok', index.search(queries, query_embeddings, top_k)))
+                    elif request[0] == 'info':
+                        conn.send(('ok', index.info()))
+                    else:
+                        conn.send(('error', f"未知请求: {request[0]}"))
+                except Exception as e:
+                    conn.send(('error', str(e)))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    while True:
+        try:
+            conn = listener.accept()
+        except (OSError, EOFError, AuthenticationError) as e:  # 认证失败等
+            print(f"分片连接失败: {e}")
+            continue
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+# ========== 协调器 ==========
+class ShardUnavailable(Exception):
+    pass
+
+
+class ShardClient:
+    """到一个分片的连接池（每个连接同时只承载一个请求）"""
+
+    def __init__(self, shard_id: int, address: str, authkey: bytes, pool_size: int = 4,
+                 retry_interval: float = 5.0):
+        self.shard_id = shard_id
+        self.address = address
+        self.authkey = authkey
+        self.pool_size = pool_size
+        self.retry_interval = retry_interval
+        self.reset()
+
+    def reset(self):
+        self.idle = queue.LifoQueue()
+        self.retry_at = 0.0
+        self.stats_lock = threading.Lock()
+        self.counts = {'ok': 0, 'timeout': 0, 'error': 0, 'unavailable': 0}
+        self.last_ms = None
+        self.total_ms = 0.0
+
+    def call(self, request):
+        if time.monotonic() < self.retry_at:
+            raise ShardUnavailable(f"分片 {self.shard_id} 暂不可用")
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = Client(connection_address(self.address), authkey=self.authkey)
+            except Exception as e:
+                self.retry_at = time.monotonic() + self.retry_interval
+                raise ShardUnavailable(f"无法连接分片 {self.shard_id} ({self.address}): {e}")
+        try:
+            conn.send(request)
+            status, payload = conn.recv()
+        except Exception:
+            conn.close()
+            self._close_idle()  # 分片进程重启后旧连接都已失效
+            raise
+        if self.idle.qsize() < self.pool_size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        if status != 'ok':
+            raise RuntimeError(payload)
+        return payload
+
+    def _close_idle(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def record(self, status: str, seconds: Optional[float] = None):
+        with self.stats_lock:
+            self.counts[status] += 1
+            if seconds is not None:
+                self.last_ms = round(seconds * 1000, 3)
+                self.total_ms += seconds * 1000
+        SHARD_REQUESTS.inc(shard=self.shard_id, status=status)
+        if seconds is not None:
+            SHARD_LATENCY.observe(seconds, shard=self.shard_id)
+
+    def stats(self) -> Dict:
+        with self.stats_lock:
+            ok = self.counts['ok']
+            return {'shard': self.shard_id, 'address': self.address,
+                    'available': time.monotonic() >= self.retry_at, **self.counts,
+                    'last_ms': self.last_ms, 'mean_ms': round(self.total_ms / ok, 3) if ok else None}
+
+
+class ShardCoordinator:
+    def __init__(self, addresses: Sequence[str], authkey: bytes, pool_size: int = 4, retry_interval: float = 5.0):
+        self.shards = [ShardClient(i, address, authkey, pool_size, retry_interval)
+                       for i, address in enumerate(addresses)]
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards) * pool_size, thread_name_prefix='shard')
+
+    def reset(self):
+        """fork后在子进程中调用：丢弃父进程的连接和线程池"""
+        for shard in self.shards:
+            shard.reset()
+        self.executor = ThreadPoolExecutor(max_workers=len(self.shards) * self.pool_size, thread_name_prefix='shard')
+
+    def _call(self, shard: ShardClient, request):
+        start = time.perf_counter()
+        try:
+            return shard.call(request), time.perf_counter() - start
+        except ShardUnavailable:
+            return None, None
+
+    def search_batch(self, queries: List[str], query_embeddings: Optional[np.ndarray], top_k: int,
+                     timeout: float) -> Tuple[List[List[Dict]], Dict]:
+        """并行查询所有分片，合并每个查询的语义top-k和关键词top-k；返回 (结果, 各分片状态)"""
+        request = ('search', list(queries), query_embeddings, top_k)
+        futures = {self.executor.submit(self._call, shard, request): shard for shard in self.shards}
+        done, _ = wait(futures, timeout=timeout)
+
+        semantic = [[] for _ in queries]
+        keyword = [[] for _ in queries]
+        report = {}
+        for future, shard in futures.items():  # 按分片顺序合并，保证同分时顺序稳定
+            if future not in done:
+                status, seconds = 'timeout', None
+            elif future.exception() is not None:
+                status, seconds = 'error', None
+                print(f"分片 {shard.shard_id} 检索失败: {future.exception()}")
+            else:
+                payload, seconds = future.result()
+                status = 'ok' if payload is not None else 'unavailable'
+                if payload is not None:
+                    for row, shard_results in enumerate(payload):
+                        semantic[row].extend(shard_results['semantic'])
+                        keyword[row].extend(shard_results['keyword'])
+            shard.record(status, seconds)
+            if status != 'ok':
+                count_request_event(f'shard_{status}')
+            report[shard.shard_id] = {'status': status,
+                                      'ms': round(seconds * 1000, 3) if seconds is not None else None}
+
+        merged = []
+        for row in range(len(queries)):
+            semantic_top = sorted(semantic[row], key=lambda r: r['similarity'], reverse=True)[:top_k]
+            keyword_top = sorted(keyword[row], key=lambda r: r['score'], reverse=True)[:top_k]
+            merged.append(semantic_top + keyword_top)
+        return merged, report
+
+    def stats(self) -> List[Dict]:
+        return [shard.stats() for shard in self.shards]
+
+
+def launch_local_shards(shard_dir: Path, num_shards: int, socket_dir: str = '/tmp') -> Tuple[List, List[str]]:
+    """以本机子进程启动所有分片，返回 (进程列表, 地址列表)；未设置 RAG_SHARD_AUTHKEY 时生成随机密钥（子进程继承）"""
+    if not os.environ.get('RAG_SHARD_AUTHKEY'):
+        os.environ['RAG_SHARD_AUTHKEY'] = secrets.token_hex(32)
+    script = os.path.abspath(__file__)
+    processes, addresses = [], []
+    for shard_id in range(num_shards):
+        address = f"unix:{socket_dir}/rag-shard-{shard_id}.sock"
+        processes.append(subprocess.Popen([sys.executable, script, 'serve', '--dir', str(shard_dir),
+                                           '--shard', str(shard_id), '--listen', address]))
+        addresses.append(address)
+    return processes, addresses
+
+
+def main():
+    parser = argparse.ArgumentParser(description='分片检索：构建分片、启动分片进程')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='用 flask_app 的chunks和向量生成分片文件')
+    build.add_argument('--num-shards', type=int, required=True)
+    build.add_argument('--dir', default='shards')
+    serve = sub.add_parser('serve', help='启动一个分片进程')
+    serve.add_argument('--dir', default='shards')
+    serve.add_argument('--shard', type=int, required=True)
+    serve.add_argument('--listen', required=True, help='unix:/path 或 host:port')
+    launch = sub.add_parser('launch', help='本机启动全部分片进程')
+    launch.add_argument('--dir', default='shards')
+    launch.add_argument('--socket-dir', default='/tmp')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        os.environ['RAG_SHARDS'] = ''  # 构建时需要完整的向量存储
+        import flask_app as fa
+        fa.initialize_data_and_vectors()
+        if fa.vector_store['corpus_embeddings'] is None:
+            raise SystemExit("没有语料库向量，无法构建分片")
+        paragraphs = fa.GLOBAL_CORPUS_DATA.get('paragraphs', []) if fa.GLOBAL_CORPUS_DATA else []
+        for entry in write_shards(fa.vector_store['corpus_chunks'], fa.vector_store['corpus_embeddings'],
+                                  paragraphs, args.num_shards, Path(args.dir)):
+            print(f"   分片 {entry['shard']}: {entry['chunks']} chunks, {entry['paragraphs']} 段落")
+        print(f"✅ 分片已写入 {args.dir}")
+    elif args.command == 'serve':
+        try:
+            authkey = shard_authkey()
+        except ValueError as e:
+            raise SystemExit(str(e))
+        serve_shard(ShardIndex(Path(args.dir), args.shard), args.listen, authkey)
+    else:
+        num_shards = len(list(Path(args.dir).glob('shard_*.json')))
+        if not num_shards:
+            raise SystemExit(f"{args.dir} 中没有分片文件，先运行 build")
+        processes, addresses = launch_local_shards(Path(args.dir), num_shards, args.socket_dir)
+        print(f"RAG_SHARD_AUTHKEY={os.environ['RAG_SHARD_AUTHKEY']}")
+        print(f"RAG_SHARDS={','.join(addresses)}")
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# flask_app 导入时读取的配置：不加载嵌入模型、不写请求日志、不写向量缓存
+os.environ.setdefault('RAG_EMBEDDING_MODEL', 'none')
+os.environ.setdefault('RAG_REQUEST_LOG', 'none')
+os.environ.setdefault('RAG_EMBEDDING_CHECKPOINT_DIR', 'none')
@@ -0,0 +1,62 @@
+import time
+
+from admission import Deadline, DegradationController, LoadShedder, StageLimiter, remaining_budget
+
+
+def test_load_shedder_rejects_over_limits():
+    backlog = [0]
+    shedder = LoadShedder(max_in_flight=2, max_queue_depth=10, queue_depth=lambda: backlog[0])
+    assert shedder.try_acquire() is None
+    assert shedder.try_acquire() is None
+    assert shedder.try_acquire() == 'in_flight'
+    shedder.release()
+    backlog[0] = 11
+    assert shedder.try_acquire() == 'queue_depth'
+    backlog[0] = 0
+    assert shedder.try_acquire() is None
+    assert shedder.in_flight == 2 and shedder.shed == 2
+
+
+def test_stage_limiter_counts_rejections():
+    limiter = StageLimiter('translation', 1)
+    assert limiter.acquire()
+    assert not limiter.acquire(timeout=0.01)
+    limiter.release()
+    assert limiter.acquire()
+    assert limiter.rejected == 1 and limiter.active == 1
+
+
+def test_degradation_steps_up_and_recovers():
+    controller = DegradationController(thresholds=(1.0, 2.0), min_samples=3, step_interval=0, recover_interval=60)
+    for _ in range(3):
+        controller.observe(1.5, 0)
+    assert controller.level() == 1
+    controller.observe(5.0, 0)  # 旧级别的样本被忽略
+    assert controller.stats() == {'level': 1, 'name': 'no_translation', 'samples': 0, 'transitions': 1}
+    controller.recover_interval = 0
+    for _ in range(3):
+        controller.observe(0.1, 1)
+    assert controller.level() == 0
+    assert controller.transitions == 2
+
+
+def test_deadline_caps_stage_budget():
+    deadline = Deadline(0.05)
+    assert remaining_budget(None, 3.0) == 3.0
+    assert 0 < remaining_budget(deadline, 3.0) <= 0.05
+    time.sleep(0.06)
+    assert deadline.expired() and remaining_budget(deadline, 3.0) == 0.0
+
+
+def test_index_builds_bypass_the_query_embedding_limit(monkeypatch):
+    import flask_app as fa
+    from load_test import StubEncoder
+
+    monkeypatch.setattr(fa, 'HAS_EMBEDDING', True)
+    monkeypatch.setattr(fa, 'embedding_model', StubEncoder(dim=8))
+    monkeypatch.setattr(fa, 'embedding_client', None)
+    monkeypatch.setattr(fa, 'embedding_limiter', StageLimiter('embedding', 1))
+    monkeypatch.setitem(fa.RAG_CONFIG, 'stage_wait', 0)
+    assert fa.embedding_limiter.acquire()  # 查询占满编码许可
+    assert fa.compute_embeddings(['fever']) is None
+    assert fa.encode_for_index('questions', ['fever', 'rash']).shape == (2, 8)
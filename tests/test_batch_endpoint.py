@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import flask_app as fa
+from admission import degradation_level
+from partitions import current_filters
+
+
+@pytest.fixture
+def batch_app(monkeypatch):
+    """替换检索和生成：只验证批量接口本身（校验、流式输出、请求上下文）"""
+    seen = []
+
+    def build_item(index, question, contexts, answer_language='zh', deadline=None):
+        seen.append({'level': degradation_level(), 'filters': current_filters(),
+                     'in_flight': fa.load_shedder.in_flight})
+        return {'index': index, 'question': question, 'success': True, 'answer': question.upper()}
+
+    monkeypatch.setattr(fa, 'get_data_counts', lambda: (1, 1, [{'text': 'c'}], [{'question': 'q'}]))
+    monkeypatch.setattr(fa, 'hybrid_retrieval_batch', lambda questions, *args, **kwargs: [[] for _ in questions])
+    monkeypatch.setattr(fa, 'rerank_candidates', lambda question, candidates, top_k, deadline: ([], {'ms': 0.0, 'scored': 0}))
+    monkeypatch.setattr(fa, 'build_batch_item', build_item)
+    monkeypatch.setitem(fa.RAG_CONFIG, 'degradation_enabled', True)
+    monkeypatch.setattr(fa.degradation, 'level', lambda: 1)
+    return fa.app.test_client(), seen
+
+
+def test_batch_returns_one_result_per_question(batch_app):
+    client, _ = batch_app
+    data = client.post('/api/query/batch', json={'questions': ['a', '', 'b']}).get_json()
+    assert data['success'] and data['count'] == 3
+    assert [item['success'] for item in data['results']] == [True, False, True]
+    assert data['results'][2]['answer'] == 'B'
+
+
+@pytest.mark.parametrize('payload', [
+    {'questions': 'abc'},
+    {'questions': []},
+    {'questions': ['a'], 'filters': {'color': 'red'}},
+    {'questions': ['a'] * 1000},
+])
+def test_invalid_requests_are_rejected_with_400(batch_app, payload):
+    client, seen = batch_app
+    response = client.post('/api/query/batch', json=payload)
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+    assert seen == []
+    assert fa.load_shedder.in_flight == 0
+
+
+def test_stream_keeps_request_context_until_closed(batch_app):
+    client, seen = batch_app
+    response = client.post('/api/query/batch', json={
+        'questions': ['a', 'b'], 'stream': True, 'filters': {'language': 'en'}}, buffered=False)
+    assert response.headers['X-Degradation-Level'] == '1'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    response.close()
+    assert [line['answer'] for line in lines] == ['A', 'B']
+    # 生成器执行时降级级别、过滤条件和准入名额仍属于本请求
+    assert seen == [{'level': 1, 'filters': {'language': ['en']}, 'in_flight': 1}] * 2
+    assert fa.load_shedder.in_flight == 0
+    assert degradation_level() == 0 and current_filters() is None
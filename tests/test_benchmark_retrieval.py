@@ -0,0 +1,16 @@
+from benchmark_retrieval import rank_metrics, representative_ids, result_key
+
+
+def test_gold_for_merged_questions_maps_to_the_representative():
+    questions_data = {'all_questions': [
+        {'id': 'q1', 'duplicate_ids': ['q2']},
+        {'id': 'q2', 'duplicate_of': 'q1'},
+        {'id': 'q3'},
+    ]}
+    representatives = representative_ids(questions_data)
+    assert representatives == {'q2': 'q1'}
+    gold = {f"question:{representatives.get('q2', 'q2')}"}
+    keys = [result_key(r) for r in [{'question_id': 'q3'}, {'question_id': 'q1', 'duplicate_ids': ['q2']}]]
+    assert keys == ['question:q3', 'question:q1']
+    metrics = rank_metrics(keys, gold, [1, 2])
+    assert metrics == {'recall@1': 0.0, 'recall@2': 1.0, 'mrr': 0.5}
@@ -0,0 +1,36 @@
+from chunking import ChunkStore, chunk_by_tokens, estimate_tokens, sentence_spans
+
+TEXT = ('Aspirin reduces fever. It also thins the blood!\n\n'
+        '阿司匹林可以退烧。它还能抗血小板聚集？ ' + 'Take it after meals. ' * 8 + 'Long sentence word ' * 40 + 'end.')
+
+
+def test_sentence_spans_split_on_chinese_and_english_ends():
+    sentences = [TEXT[start:end] for start, end in sentence_spans(TEXT)]
+    assert sentences[:4] == ['Aspirin reduces fever.', 'It also thins the blood!',
+                             '阿司匹林可以退烧。', '它还能抗血小板聚集？']
+
+
+def test_chunks_stay_within_token_budget():
+    chunks, report = chunk_by_tokens(TEXT, max_tokens=30, overlap_tokens=8)
+    assert report['tokenizer'] == 'estimate'
+    assert report['chunks'] == len(chunks) > 1
+    assert report['max_chunk_tokens'] <= 30
+    for start, end, tokens in chunks:
+        assert estimate_tokens(TEXT[start:end]) <= 30
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(TEXT)
+    assert [start for start, _, _ in chunks] == sorted(start for start, _, _ in chunks)
+    assert any(nxt[0] < prev[1] for prev, nxt in zip(chunks, chunks[1:]))  # 相邻chunk保留重叠句子
+
+
+def test_chunk_store_round_trips_through_mmap(tmp_path):
+    chunks, _ = chunk_by_tokens(TEXT, max_tokens=30, overlap_tokens=0)
+    store = ChunkStore.from_spans(TEXT, chunks).select([0, 2, 3], duplicates={0: [1]})
+    meta = store.save(tmp_path / 'chunks.txt')
+    loaded = ChunkStore.load(tmp_path / 'chunks.txt', meta['duplicates'])
+    assert len(loaded) == 3
+    assert loaded.texts() == store.texts()
+    assert [item['id'] for item in loaded] == ['chunk_0000', 'chunk_0002', 'chunk_0003']
+    assert loaded[0]['duplicate_ids'] == ['chunk_0001']
+    # 返回给客户端的是字符偏移（文本含中文，与字节偏移不同）
+    assert [(item['start'], item['end']) for item in loaded] == [(item['start'], item['end']) for item in store]
+    assert TEXT[loaded[1]['start']:loaded[1]['end']] == loaded[1]['text']
@@ -0,0 +1,21 @@
+import flask_app as fa
+
+
+def test_stats_breakdowns_cover_the_same_questions(monkeypatch):
+    questions = [
+        {'id': 'q1', 'type': 'Fact Retrieval', 'source': 'Medical', 'original_lang': 'en', 'duplicate_ids': ['q2']},
+        {'id': 'q2', 'type': 'Fact Retrieval', 'source': 'Medical', 'original_lang': 'en', 'duplicate_of': 'q1'},
+        {'id': 'q3', 'type': 'Complex Reasoning', 'source': 'Forum', 'original_lang': 'zh'},
+    ]
+    questions_data = {'all_questions': questions, 'search_questions': [questions[0], questions[2]],
+                      'total_count': 3, 'sample_questions': questions}
+    monkeypatch.setattr(fa, 'get_data_counts', lambda: (1, 3, {'paragraphs': []}, questions_data))
+    monkeypatch.setattr(fa, 'DASHBOARD', {})
+    fa.build_dashboard_aggregates()
+    stats = fa.app.test_client().get('/api/stats').get_json()
+    assert stats['total_questions'] == 3 and stats['searchable_questions'] == 2
+    assert stats['question_types'] == {'Complex Reasoning': 1, 'Fact Retrieval': 2}
+    assert stats['question_languages'] == {'en': 2, 'zh': 1}
+    assert stats['question_sources'] == {'Forum': 1, 'Medical': 2}
+    for breakdown in ('question_types', 'question_languages', 'question_sources'):
+        assert sum(stats[breakdown].values()) == stats['total_questions']
@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pytest
+
+import flask_app as fa
+from embedding_service import EmbeddingClient, EmbeddingRequestError, EmbeddingServer, EmbeddingServiceError
+from load_test import StubEncoder
+
+
+class BrokenEncoder:
+    def encode(self, texts, show_progress_bar=False):
+        raise RuntimeError('model crashed')
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    servers = []
+
+    def start(model):
+        server = EmbeddingServer(model, f"unix:{tmp_path}/embedding.sock", max_wait=0.001)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.address
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def test_client_gets_the_same_vectors_as_the_model(start_server):
+    model = StubEncoder(dim=16)
+    client = EmbeddingClient(start_server(model), pool_size=2)
+    texts = ['fever and cough', '发烧', 'rash']
+    for _ in range(3):  # 轮流使用连接池中的连接
+        np.testing.assert_allclose(client.encode(texts), model.encode(texts))
+    assert client.stats() == {'requests': 3, 'failures': 0}
+
+
+def test_encode_errors_are_reported(start_server):
+    client = EmbeddingClient(start_server(BrokenEncoder()))
+    with pytest.raises(EmbeddingRequestError, match='model crashed'):
+        client.encode(['fever'])
+    # 服务端返回的错误只影响本次请求，服务仍然可用
+    assert client.available()
+    with pytest.raises(EmbeddingRequestError):
+        client.encode(['rash'])
+    assert client.stats() == {'requests': 2, 'failures': 2}
+
+
+def test_unreachable_service_backs_off(tmp_path):
+    client = EmbeddingClient(f"unix:{tmp_path}/missing.sock", retry_interval=60)
+    with pytest.raises(EmbeddingServiceError):
+        client.encode(['fever'])
+    assert not client.available()
+    with pytest.raises(EmbeddingServiceError, match='暂不可用'):
+        client.encode(['fever'])
+    assert client.stats() == {'requests': 1, 'failures': 1}
+
+
+def test_compute_embeddings_falls_back_to_local_model(tmp_path, monkeypatch):
+    model = StubEncoder(dim=16)
+    client = EmbeddingClient(f"unix:{tmp_path}/missing.sock", retry_interval=60)
+    monkeypatch.setattr(fa, 'HAS_EMBEDDING', True)
+    monkeypatch.setattr(fa, 'embedding_model', model)
+    monkeypatch.setattr(fa, 'embedding_client', client)
+    np.testing.assert_allclose(fa.compute_embeddings(['fever']), model.encode(['fever']))
+    assert not client.available()
+    np.testing.assert_allclose(fa.compute_embeddings(['rash']), model.encode(['rash']))
+    assert client.stats()['requests'] == 1  # 退避期间不再请求服务
@@ -0,0 +1,113 @@
+import csv
+import io
+import json
+import time
+
+import pytest
+
+import flask_app as fa
+from export_jobs import ExportManager, ExportTable, iter_csv, iter_jsonl
+
+ROWS = [('q1', '发烧怎么办', 'Rest.'), ('q2', 'cough, dry', 'Drink "water"')]
+TABLE = ExportTable('Questions', ['ID', 'Question', 'Answer'], lambda: iter(ROWS))
+
+
+def wait_done(manager, job_id):
+    for _ in range(200):
+        job = manager.status(job_id)
+        if job['state'] in ('done', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'导出任务未完成: {job}')
+
+
+def test_csv_and_jsonl_stream_every_row():
+    text = ''.join(iter_csv(TABLE, chunk_rows=1))
+    assert text.startswith('\ufeff')
+    assert list(csv.reader(io.StringIO(text[1:]))) == [TABLE.columns] + [list(row) for row in ROWS]
+    records = [json.loads(line) for line in iter_jsonl(TABLE)]
+    assert records[1] == {'ID': 'q2', 'Question': 'cough, dry', 'Answer': 'Drink "water"'}
+
+
+def test_export_is_written_once_per_snapshot(tmp_path):
+    manager = ExportManager(tmp_path)
+    job = manager.submit('v1', 'questions', 'jsonl', [TABLE])
+    job = wait_done(manager, job['id'])
+    assert job['state'] == 'done' and job['rows'] == 2
+    path = manager.artifact(job['id'])
+    assert path == tmp_path / 'v1' / 'questions.jsonl'
+    assert not list(tmp_path.glob('v1/*.part'))
+    # 其它进程（新的管理器）按任务id从磁盘上找到同一个文件
+    other = ExportManager(tmp_path)
+    assert other.status(job['id'])['cached'] is True
+    assert other.submit('v1', 'questions', 'jsonl', [TABLE])['state'] == 'done'
+    assert other.status('../v1-questions-jsonl') is None
+
+
+def test_new_snapshot_removes_old_exports(tmp_path):
+    manager = ExportManager(tmp_path)
+    wait_done(manager, manager.submit('v1', 'questions', 'csv', [TABLE])['id'])
+    wait_done(manager, manager.submit('v2', 'questions', 'csv', [TABLE])['id'])
+    assert [p.name for p in tmp_path.iterdir()] == ['v2']
+
+
+def test_failed_export_can_be_resubmitted(tmp_path):
+    def broken():
+        yield ROWS[0]
+        raise RuntimeError('snapshot gone')
+
+    manager = ExportManager(tmp_path)
+    job = wait_done(manager, manager.submit('v1', 'questions', 'csv', [TABLE._replace(rows=broken)])['id'])
+    assert job['state'] == 'failed' and 'snapshot gone' in job['error']
+    assert manager.artifact(job['id']) is None
+    assert not list(tmp_path.glob('v1/*'))
+    assert wait_done(manager, manager.submit('v1', 'questions', 'csv', [TABLE])['id'])['state'] == 'done'
+
+
+def test_xlsx_writes_one_sheet_per_table(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    manager = ExportManager(tmp_path)
+    stats = ExportTable('Statistics', ['Item', 'Value'], lambda: iter([('Questions', 2), ('Bad\x01', 'x' * 40000)]))
+    job = wait_done(manager, manager.submit('v1', 'all', 'xlsx', [TABLE, stats])['id'])
+    workbook = openpyxl.load_workbook(manager.artifact(job['id']), read_only=True)
+    assert workbook.sheetnames == ['Questions', 'Statistics']
+    rows = list(workbook['Statistics'].values)
+    assert rows[2][0] == 'Bad' and len(rows[2][1]) == 32767
+
+
+def test_export_job_endpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(fa, 'export_manager', ExportManager(tmp_path))
+    monkeypatch.setattr(fa, 'GLOBAL_DATA_VERSION', 'v1')
+    monkeypatch.setattr(fa, 'current_export_tables', lambda: {'questions': TABLE})
+    client = fa.app.test_client()
+    response = client.get('/api/export-data?format=csv&dataset=questions')
+    assert response.status_code == 200 and response.get_data(as_text=True).count('\n') == 3
+    assert client.get('/api/export-data?format=pdf').status_code == 400
+
+    response = client.post('/api/export-jobs', json={'format': 'jsonl', 'dataset': 'questions'})
+    job_id = response.get_json()['job']['id']
+    wait_done(fa.export_manager, job_id)
+    job = client.get(f'/api/export-jobs/{job_id}').get_json()['job']
+    download = client.get(job['download_url'])
+    assert download.status_code == 200
+    assert [json.loads(line)['ID'] for line in download.get_data(as_text=True).splitlines()] == ['q1', 'q2']
+    download.close()
+    assert client.get('/api/export-jobs/v1-corpus-csv').status_code == 404
+
+
+def test_chunks_export_without_vector_store(monkeypatch):
+    text = 'Aspirin reduces fever. ' * 200 + '阿司匹林可以退烧。' * 50
+    corpus_data = {'full_content': text, 'paragraphs': [text], 'doc_count': 1}
+    monkeypatch.setattr(fa, 'get_data_counts', lambda: (1, 0, corpus_data, None))
+    monkeypatch.setattr(fa, 'GLOBAL_DATA_VERSION', 'v1')
+    monkeypatch.setattr(fa, 'EXPORT_CHUNKS', {})
+    monkeypatch.setitem(fa.vector_store, 'corpus_chunks', [])
+    client = fa.app.test_client()
+    response = client.get('/api/export-data?format=jsonl&dataset=chunks')
+    chunks = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(chunks) > 1
+    assert all(text[chunk['Start']:chunk['End']] == chunk['Text'] for chunk in chunks)
+    statistics = client.get('/api/export-data?format=jsonl&dataset=statistics').get_data(as_text=True)
+    assert {'Item': 'Chunks', 'Value': len(chunks), 'Description': 'Indexed corpus chunks (near-duplicates merged)'} \
+        in [json.loads(line) for line in statistics.splitlines()]
+    assert list(fa.EXPORT_CHUNKS) == ['v1']
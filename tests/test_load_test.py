@@ -0,0 +1,17 @@
+from load_test import Recorder
+
+
+def test_percentiles_only_count_successful_requests():
+    recorder = Recorder(timeout=1.0)
+    for latency in (0.1, 0.2, 0.3):
+        recorder.record(latency, 200)
+    recorder.record(0.001, 503)  # 快速拒绝
+    recorder.record(0.002, -1)
+    recorder.record(5.0, 200)  # 超时
+    summary = recorder.summary(elapsed=1.0)
+    assert summary['requests'] == 6
+    assert summary['status_counts'] == {'-1': 1, '0': 1, '200': 3, '503': 1}
+    assert summary['p50_s'] == 0.2
+    assert summary['max_s'] == 0.3
+    assert summary['timeout_rate'] == round(1 / 6, 4)
+    assert summary['error_rate'] == round(2 / 6, 4)
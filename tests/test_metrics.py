@@ -0,0 +1,57 @@
+from metrics import (MetricsRegistry, count_request_event, enter_request_scope, exit_request_scope,
+                     observe_stage, percentile, record_stage, stage_timer)
+
+
+def test_percentile_uses_nearest_rank():
+    values = [0.4, 0.1, 0.3, 0.2]
+    assert percentile(values, 50) == 0.2
+    assert percentile(values, 99) == 0.4
+    assert percentile(values, 0) == 0.1
+    assert percentile([], 95) == 0.0
+
+
+def test_registry_renders_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.counter('test_requests_total', 'Requests', ('endpoint',))
+    latency = registry.histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    registry.callback('test_queue_depth', 'Queue depth', lambda: {(): 3})
+    requests.inc(endpoint='query')
+    requests.inc(2, endpoint='query')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    lines = registry.render().splitlines()
+    assert 'test_requests_total{endpoint="query"} 3' in lines
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'test_latency_seconds_count 2' in lines
+    assert 'test_queue_depth 3' in lines
+
+
+def test_request_scope_collects_stages_and_events():
+    @observe_stage('test_stage')
+    def stage():
+        count_request_event('cache_hit')
+
+    stage()  # 请求范围之外只记直方图
+    scope, token = enter_request_scope()
+    try:
+        stage()
+        stage()
+    finally:
+        exit_request_scope(token)
+    stage()
+    assert list(scope.stages) == ['test_stage']
+    assert scope.events == {'cache_hit': 2}
+
+
+def test_stage_timer_and_record_stage_feed_the_request_scope():
+    scope, token = enter_request_scope()
+    try:
+        with stage_timer('embedding'):
+            pass
+        record_stage('answer_extraction', 0.25)
+        record_stage('answer_extraction', 0.25)
+    finally:
+        exit_request_scope(token)
+    assert set(scope.stages) == {'embedding', 'answer_extraction'}
+    assert scope.stages['answer_extraction'] == 0.5
@@ -0,0 +1,24 @@
+from replay_requests import replay
+
+
+class RecordingTarget:
+    def __init__(self):
+        self.payloads = []
+
+    def request(self, payload, timeout):
+        self.payloads.append(payload)
+        return 200, {'sources': [{'chunk_id': 'chunk_0001'}]}
+
+
+def test_replay_sends_the_logged_filters():
+    records = [
+        {'question': 'fever', 'answer_language': 'en', 'filters': {'language': ['en']}, 'ts': 0,
+         'result_ids': ['chunk_0001']},
+        {'question': '发烧', 'use_rag': False, 'ts': 0},
+    ]
+    target = RecordingTarget()
+    summary = replay(target, records, speed=0, timeout=5, max_workers=1)
+    by_question = {payload['question']: payload for payload in target.payloads}
+    assert by_question['fever']['filters'] == {'language': ['en']}
+    assert by_question['发烧']['filters'] is None and by_question['发烧']['use_rag'] is False
+    assert summary['requests'] == 2 and summary['exact_result_match_rate'] == 1.0
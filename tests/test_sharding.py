@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import sharding
+from chunking import ChunkStore
+
+
+def test_authkey_has_no_default(monkeypatch):
+    monkeypatch.delenv('RAG_SHARD_AUTHKEY', raising=False)
+    with pytest.raises(ValueError):
+        sharding.shard_authkey()
+    monkeypatch.setenv('RAG_SHARD_AUTHKEY', 'secret')
+    assert sharding.shard_authkey() == b'secret'
+
+
+def test_shard_refuses_to_listen_without_authkey():
+    with pytest.raises(ValueError):
+        sharding.serve_shard(None, '127.0.0.1:0', b'')
+
+
+@pytest.fixture
+def shard_files(tmp_path):
+    """两个分片：chunk 0/1 在分片0，chunk 2/3 在分片1"""
+    text = 'alpha fever. beta cough. gamma rash. delta pain.'
+    spans = [(0, 12), (13, 24), (25, 36), (37, 48)]
+    embeddings = np.eye(4, dtype=np.float32)
+    paragraphs = ['fever treatment', 'cough syrup', 'rash cream', 'pain relief']
+    sharding.write_shards(ChunkStore.from_spans(text, spans), embeddings, paragraphs, 2, tmp_path)
+    return tmp_path
+
+
+def start_shard(shard_dir, shard_id, address, authkey=b'secret'):
+    thread = threading.Thread(target=sharding.serve_shard,
+                              args=(sharding.ShardIndex(shard_dir, shard_id), address, authkey), daemon=True)
+    thread.start()
+    path = address[len('unix:'):]
+    for _ in range(100):
+        if os.path.exists(path):
+            return
+        time.sleep(0.01)
+
+
+def test_coordinator_merges_shards(shard_files):
+    addresses = [f"unix:{shard_files}/shard-{i}.sock" for i in range(2)]
+    for shard_id, address in enumerate(addresses):
+        start_shard(shard_files, shard_id, address)
+    coordinator = sharding.ShardCoordinator(addresses, b'secret', pool_size=1)
+    query = np.array([[0, 0, 1, 0]], dtype=np.float32)
+    (results,), report = coordinator.search_batch(['rash'], query, top_k=2, timeout=5)
+    assert {shard: status['status'] for shard, status in report.items()} == {0: 'ok', 1: 'ok'}
+    semantic = [r for r in results if r['source'] == 'semantic_search']
+    assert [r['text'] for r in semantic] == ['gamma rash.', 'alpha fever.']
+    assert [r['text'] for r in results if r['source'] == 'keyword_search'] == ['rash cream']
+
+
+def test_unavailable_shard_is_skipped(shard_files):
+    addresses = [f"unix:{shard_files}/shard-0.sock", f"unix:{shard_files}/missing.sock"]
+    start_shard(shard_files, 0, addresses[0])
+    coordinator = sharding.ShardCoordinator(addresses, b'secret', pool_size=1, retry_interval=60)
+    query = np.array([[1, 0, 0, 0]], dtype=np.float32)
+    (results,), report = coordinator.search_batch(['fever'], query, top_k=1, timeout=5)
+    assert report[0]['status'] == 'ok' and report[1]['status'] == 'unavailable'
+    assert [r['text'] for r in results] == ['alpha fever.', 'fever treatment']
+    assert coordinator.stats()[1]['available'] is False
+
+
+def test_wrong_authkey_is_rejected(shard_files):
+    address = f"unix:{shard_files}/shard-0.sock"
+    start_shard(shard_files, 0, address)
+    coordinator = sharding.ShardCoordinator([address], b'wrong', pool_size=1)
+    (results,), report = coordinator.search_batch(['fever'], None, top_k=1, timeout=5)
+    assert results == [] and report[0]['status'] == 'unavailable'
@@ -0,0 +1,90 @@
+import time
+from pathlib import Path
+
+from translation import LocalBackend, TieredBackend, TranslationBackend, TranslationMemory, static_label
+
+TERMS_PATH = Path(__file__).resolve().parent.parent / 'medical_terms.json'
+
+
+def has_chinese(text):
+    return any('\u4e00' <= char <= '\u9fff' for char in text)
+
+
+def test_local_backend_translates_sentence_missing_from_phrase_table():
+    backend = LocalBackend(str(TERMS_PATH))
+    sentence = 'Basal cell carcinoma is treated with surgery.'
+    assert backend.lookup_batch([sentence], 'en_to_zh') == [None]
+    result = backend.translate_batch([sentence], 'en_to_zh')[0]
+    assert result is not None and result != sentence
+    assert has_chinese(result)
+
+
+def test_local_backend_through_translation_memory():
+    backend = LocalBackend(str(TERMS_PATH))
+    memory = TranslationMemory()
+    text = 'What are the symptoms of skin cancer? Surgery is one option.'
+    translated = memory.translate(text, 'en_to_zh', backend.translate_batch)
+    assert translated != text and has_chinese(translated)
+
+
+class FailingRemote(TranslationBackend):
+    def translate_batch(self, texts, direction):
+        raise RuntimeError('offline')
+
+
+def test_tiered_backend_still_sends_phrase_misses_to_remote_first():
+    class Remote(TranslationBackend):
+        def __init__(self):
+            self.calls = []
+
+        def translate_batch(self, texts, direction):
+            self.calls.append(list(texts))
+            return [f'remote:{text}' for text in texts]
+
+    remote = Remote()
+    backend = TieredBackend(LocalBackend(str(TERMS_PATH)), remote)
+    assert backend.translate_batch(['Surgery helps.'], 'en_to_zh') == ['remote:Surgery helps.']
+    assert remote.calls == [['Surgery helps.']]
+
+    fallback = TieredBackend(LocalBackend(str(TERMS_PATH)), FailingRemote())
+    assert has_chinese(fallback.translate_batch(['Surgery helps.'], 'en_to_zh')[0])
+
+
+def test_fallback_after_remote_timeout_is_not_remembered():
+    class SlowThenFastRemote(TranslationBackend):
+        def __init__(self):
+            self.slow = True
+
+        def translate_batch(self, texts, direction):
+            if self.slow:
+                time.sleep(0.2)
+            return ['今天天气很好。' for _ in texts]
+
+    remote = SlowThenFastRemote()
+    backend = TieredBackend(LocalBackend(str(TERMS_PATH)), remote, latency_budget=0.05, cooldown=0)
+    memory = TranslationMemory()
+    text = 'The weather is nice today.'
+    assert memory.translate(text, 'en_to_zh', backend.translate_batch) == text  # 兜底：没有术语可替换
+    assert backend.stats['remote_timeouts'] == 1
+    assert memory.get(text, 'en_to_zh') is None
+    # 远程恢复后重新翻译并写入记忆
+    remote.slow = False
+    assert memory.translate(text, 'en_to_zh', backend.translate_batch) == '今天天气很好。'
+    assert memory.get(text, 'en_to_zh') == '今天天气很好。'
+
+
+def test_local_fallback_is_used_but_not_remembered():
+    memory = TranslationMemory()
+    backend = LocalBackend(str(TERMS_PATH))
+    sentence = 'Surgery is one option.'
+    translated = memory.translate(sentence, 'en_to_zh', backend.translate_batch)
+    assert has_chinese(translated) and type(translated) is str
+    assert memory.stats()['entries'] == 0
+
+
+def test_static_labels_for_question_types_and_sources():
+    assert static_label('type', 'Fact Retrieval', 'zh') == '事实检索'
+    assert static_label('type', 'Contextual Summarize', 'zh') == '上下文总结'
+    assert static_label('type', 'Fact Retrieval', 'en') == 'Fact Retrieval'
+    assert static_label('source', 'Medical Database', 'zh') == '医疗数据库'
+    assert static_label('source', 'PubMed', 'zh') == 'PubMed'
@@ -0,0 +1,71 @@
+import threading
+
+import flask_app as fa
+from admission import Deadline
+from translation import TranslationBackend, TranslationMemory
+
+
+class GatedBackend(TranslationBackend):
+    """第一次调用阻塞到 gate 打开，记录每次调用的句子"""
+
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def translate_batch(self, texts, direction):
+        self.calls.append(list(texts))
+        self.started.set()
+        self.gate.wait(5)
+        return [text.upper() for text in texts]
+
+
+def test_translate_batch_returns_results():
+    backend = GatedBackend()
+    backend.gate.set()
+    translation_queue = fa.TranslationQueue(backend, workers=1)
+    assert translation_queue.translate_batch(['a', 'b'], 'en_to_zh', timeout=2) == ['A', 'B']
+    assert translation_queue.batch_events == {}
+
+
+def test_timed_out_batches_are_skipped_by_the_worker():
+    backend = GatedBackend()
+    translation_queue = fa.TranslationQueue(backend, workers=1)
+    first = threading.Thread(target=translation_queue.translate_batch, args=(['first'], 'en_to_zh', 0.05))
+    first.start()
+    assert backend.started.wait(2)
+    # 工作线程被第一批占住，第二批的等待方超时
+    assert translation_queue.translate_batch(['abandoned'], 'en_to_zh', timeout=0.05) == [None]
+    first.join()
+    backend.gate.set()
+    assert translation_queue.translate_batch(['later'], 'en_to_zh', timeout=2) == ['LATER']
+    assert backend.calls == [['first'], ['later']]
+    assert translation_queue.abandoned == 1
+    assert translation_queue.batch_events == {}
+
+
+def test_backend_errors_return_none_per_sentence():
+    class Broken(TranslationBackend):
+        def translate_batch(self, texts, direction):
+            raise RuntimeError('down')
+
+    translation_queue = fa.TranslationQueue(Broken(), workers=1)
+    assert translation_queue.translate_batch(['a', 'b'], 'en_to_zh', timeout=2) == [None, None]
+
+
+def test_default_queue_runs_one_worker_per_translation_permit():
+    assert len(fa.translation_queue.worker_threads) == fa.RAG_CONFIG['stage_concurrency']['translation']
+
+
+def test_translation_timeout_keeps_original_text(monkeypatch):
+    backend = GatedBackend()
+    monkeypatch.setattr(fa, 'translation_queue', fa.TranslationQueue(backend, workers=1))
+    monkeypatch.setattr(fa, 'translation_memory', TranslationMemory(100))
+    timeouts = fa.TRANSLATION_TIMEOUTS.values.get(('batch',), 0)
+    text = 'Zorblax syndrome is rare.'
+    assert fa.translate_with_memory(text, 'en_to_zh', timeout=0.05) == text
+    assert fa.TRANSLATION_TIMEOUTS.values[('batch',)] == timeouts + 1
+    backend.gate.set()
+    # 请求时限已用完时不再排队
+    assert fa.translate_with_memory('Another rare sentence.', 'en_to_zh', deadline=Deadline(0)) == 'Another rare sentence.'
+    assert backend.calls == [[text]]
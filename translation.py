@@ -0,0 +1,472 @@
+# translation.py - 翻译记忆与翻译后端
+"""
+翻译层：句子切分 + 翻译记忆 + 静态双语表 + 可插拔翻译后端
+
+答案文本先按句子切分，每个句子在翻译记忆中查找；只有未命中的句子
+才会在一次批量调用中发送给翻译后端，最后按原顺序拼回。
+固定的界面/免责声明文本不经过翻译后端，直接取自静态双语表。
+后端可选本地离线（短语表+术语替换）、远程（translate库）、
+分级（本地优先、远程限时）以及压测用的确定性桩后端。
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, List, Optional, Tuple
+
+# ========== 静态双语表 ==========
+STATIC_TEXTS = {
+    'disclaimer': {
+        'zh': '（以上信息基于医疗知识库，仅供参考。具体病情请咨询专业医生。）',
+        'en': '(The above information is based on the medical knowledge base and is for reference only. '
+              'Please consult a professional doctor about your specific condition.)',
+    },
+    'no_answer': {
+        'zh': '抱歉，我没有找到足够的信息来回答这个问题。',
+        'en': 'Sorry, I could not find enough information to answer this question.',
+    },
+    'advice_title': {'zh': '医疗建议', 'en': 'Medical Advice'},
+    'advice_reference': {
+        'zh': '以上信息基于医疗数据库，仅供参考',
+        'en': 'The above information is based on the medical database and is for reference only',
+    },
+    'advice_rag_reference': {
+        'zh': '以上信息基于医疗知识库的智能分析，仅供参考',
+        'en': 'The above information comes from an analysis of the medical knowledge base and is for reference only',
+    },
+    'advice_consult': {
+        'zh': '具体症状请咨询专业医生',
+        'en': 'Please consult a professional doctor about specific symptoms',
+    },
+    'advice_emergency': {
+        'zh': '如遇紧急情况，请立即就医',
+        'en': 'In an emergency, seek medical attention immediately',
+    },
+    'advice_lifestyle': {
+        'zh': '保持健康生活方式有助于疾病预防',
+        'en': 'A healthy lifestyle helps prevent disease',
+    },
+    'type_fact_retrieval': {'zh': '事实检索', 'en': 'Fact Retrieval'},
+    'type_complex_reasoning': {'zh': '复杂推理', 'en': 'Complex Reasoning'},
+    'type_contextual_summarize': {'zh': '上下文总结', 'en': 'Contextual Summarize'},
+    'type_creative_generation': {'zh': '创造性生成', 'en': 'Creative Generation'},
+    'type_medical': {'zh': '医疗信息', 'en': 'Medical'},
+    'source_medical_database': {'zh': '医疗数据库', 'en': 'Medical Database'},
+}
+
+
+def static_text(key: str, lang: str = 'zh') -> str:
+    """从静态双语表取文本，未知语言回退到中文"""
+    entry = STATIC_TEXTS[key]
+    return entry.get(lang, entry['zh'])
+
+
+def static_label(prefix: str, value: str, lang: str = 'zh') -> str:
+    """问题类型、来源等取值的显示文本（如 'Fact Retrieval' -> type_fact_retrieval），表中没有的取值原样返回"""
+    key = prefix + '_' + re.sub(r'\W+', '_', str(value).strip().lower())
+    return static_text(key, lang) if key in STATIC_TEXTS else value
+
+
+# ========== 句子切分 ==========
+# 句末标点；英文句点后需跟空白或结尾，避免切开小数
+_SENTENCE_END = re.compile(r'[。！？!?；;]+[）)”"]*|\.(?=\s|$)[）)”"]*|\n+')
+
+
+def needs_translation(text: str, direction: str) -> bool:
+    """判断文本在给定方向上是否需要翻译"""
+    if not text:
+        return False
+    if direction == 'en_to_zh':
+        return any('a' <= char.lower() <= 'z' for char in text)
+    return any('\u4e00' <= char <= '\u9fff' for char in text)
+
+
+def split_into_segments(text: str) -> List[Tuple[str, bool]]:
+    """
+    将文本切分为片段列表 [(片段, 是否为句子)]
+
+    句子片段去掉了首尾空白，空白和换行作为非句子片段保留，
+    因此 ''.join(片段) == text，翻译后可以按原格式拼回。
+    """
+    segments = []
+    pos = 0
+    for match in _SENTENCE_END.finditer(text):
+        end = match.end()
+        if match.group().startswith('\n'):
+            _append_sentence(segments, text[pos:match.start()])
+            segments.append((match.group(), False))
+        else:
+            _append_sentence(segments, text[pos:end])
+        pos = end
+    _append_sentence(segments, text[pos:])
+    return segments
+
+
+def _append_sentence(segments: List[Tuple[str, bool]], piece: str):
+    """追加一个句子片段，首尾空白单独保留"""
+    if not piece:
+        return
+    stripped = piece.strip()
+    if not stripped:
+        segments.append((piece, False))
+        return
+    leading = piece[:len(piece) - len(piece.lstrip())]
+    trailing = piece[len(piece.rstrip()):]
+    if leading:
+        segments.append((leading, False))
+    segments.append((stripped, True))
+    if trailing:
+        segments.append((trailing, False))
+
+
+# ========== 翻译记忆 ==========
+class FallbackText(str):
+    """兜底译文（本地术语替换，可能是原文或中英混杂）：拼回全文时使用，不写入翻译记忆"""
+
+
+class TranslationMemory:
+    """句级翻译记忆（LRU，线程安全）"""
+
+    def __init__(self, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.static_entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.listener = None  # 可选回调 listener(hit: bool)，如按请求统计命中情况
+        self._load_static_table()
+
+    def _load_static_table(self):
+        """预置静态双语表（不参与LRU淘汰）"""
+        for entry in STATIC_TEXTS.values():
+            pairs = [(entry['zh'], entry['en'])]
+            zh_sentences = [seg for seg, is_sentence in split_into_segments(entry['zh']) if is_sentence]
+            en_sentences = [seg for seg, is_sentence in split_into_segments(entry['en']) if is_sentence]
+            if len(zh_sentences) == len(en_sentences):
+                pairs.extend(zip(zh_sentences, en_sentences))
+            for zh, en in pairs:
+                self.static_entries[('zh_to_en', zh)] = en
+                self.static_entries[('en_to_zh', en)] = zh
+
+    def get(self, segment: str, direction: str) -> Optional[str]:
+        key = (direction, segment)
+        with self.lock:
+            value = self.static_entries.get(key)
+            if value is None:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.listener is not None:
+            self.listener(value is not None)
+        return value
+
+    def put(self, segment: str, direction: str, translation: str):
+        key = (direction, segment)
+        with self.lock:
+            self.entries[key] = translation
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def translate(self, text: str, direction: str,
+                  translate_batch: Callable[[List[str], str], List[Optional[str]]]) -> str:
+        """
+        按句翻译文本
+
+        translate_batch 接收未命中的句子列表并返回等长的译文列表，
+        译文为 None 表示该句翻译失败（保留原文，不写入记忆），
+        FallbackText 表示兜底译文（用于拼回全文，不写入记忆，下次仍会送去翻译）。
+        """
+        plan = self.lookup(text, direction)
+        if plan is None:
+            return text
+        pending = plan[2]
+        return self.complete(plan, direction, translate_batch(pending, direction) if pending else [])
+
+    def lookup(self, text: str, direction: str):
+        """
+        翻译的第一步：分句并查记忆
+
+        返回 (segments, translated, pending)，pending 为需要送去翻译的句子；
+        不需要翻译时返回 None。异步调用方在两步之间自行等待翻译结果。
+        """
+        if not needs_translation(text, direction):
+            return None
+
+        segments = split_into_segments(text)
+        translated = {}
+        pending = []
+        for segment, is_sentence in segments:
+            if not is_sentence or segment in translated:
+                continue
+            if not needs_translation(segment, direction):
+                translated[segment] = segment
+                continue
+            cached = self.get(segment, direction)
+            if cached is not None:
+                translated[segment] = cached
+            else:
+                translated[segment] = None
+                pending.append(segment)
+        return segments, translated, pending
+
+    def complete(self, plan, direction: str, results: List[Optional[str]]) -> str:
+        """翻译的第二步：写入新译文并拼回全文"""
+        segments, translated, pending = plan
+        results = list(results or [])
+        results += [None] * (len(pending) - len(results))
+        for segment, result in zip(pending, results):
+            if result is None:
+                translated[segment] = segment
+            else:
+                translated[segment] = str(result)
+                if not isinstance(result, FallbackText):
+                    self.put(segment, direction, result)
+
+        return ''.join(translated[segment] if is_sentence else segment
+                       for segment, is_sentence in segments)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'static_entries': len(self.static_entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# ========== 翻译后端 ==========
+class TranslationBackend:
+    """翻译后端接口：批量翻译，失败的句子返回None，兜底译文用 FallbackText 标记"""
+
+    name = 'base'
+
+    def translate_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        raise NotImplementedError
+
+
+class LocalBackend(TranslationBackend):
+    """
+    本地离线后端：短语表整句匹配 + 医学术语替换
+
+    短语表来自静态双语表，以及问题库中同一条目中英文都存在的条目（当前数据每条只有一种语言）；
+    术语表来自 medical_terms.json。整句命中短语表时返回短语表的译文，
+    未命中的句子用术语替换翻译（partial_translate，可能中英混杂，以 FallbackText 返回）。
+    分级后端只用 lookup_batch 查短语表，未命中的句子先交给远程后端。
+    """
+
+    name = 'local'
+
+    def __init__(self, terms_path: Optional[str] = None):
+        self.phrases = {'en_to_zh': {}, 'zh_to_en': {}}
+        self.terms = {'en_to_zh': {}, 'zh_to_en': {}}
+        self._term_patterns = {}
+        for entry in STATIC_TEXTS.values():
+            self.add_phrase(entry['zh'], entry['en'])
+        if terms_path:
+            self.load_terms(terms_path)
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return re.sub(r'\s+', ' ', text).strip().lower()
+
+    def add_phrase(self, zh: str, en: str):
+        if zh and en:
+            self.phrases['zh_to_en'][self._normalize(zh)] = en.strip()
+            self.phrases['en_to_zh'][self._normalize(en)] = zh.strip()
+
+    def add_term(self, zh: str, en: str):
+        if zh and en:
+            self.terms['en_to_zh'][en.lower()] = zh
+            self.terms['zh_to_en'].setdefault(zh, en)
+            self._term_patterns.clear()
+
+    def load_terms(self, terms_path: str):
+        """加载 medical_terms.json（分类 -> {中文: [英文同义词...]}）"""
+        import json
+        try:
+            with open(terms_path, 'r', encoding='utf-8') as f:
+                categories = json.load(f)
+        except Exception as e:
+            print(f"加载医学术语失败: {e}")
+            return
+        for terms in categories.values():
+            for zh, en_list in terms.items():
+                for en in en_list:
+                    self.add_term(zh, en)
+
+    def load_question_bank(self, questions_data: Optional[Dict]):
+        """从问题库中同时有中英文的条目提取整句短语对"""
+        if not questions_data:
+            return
+        for q in questions_data.get('all_questions', []):
+            self.add_phrase(q.get('question_cn', ''), q.get('question_en', ''))
+            self.add_phrase(q.get('answer_cn', ''), q.get('answer_en', ''))
+
+    def _term_pattern(self, direction: str):
+        pattern = self._term_patterns.get(direction)
+        if pattern is None:
+            # 长词优先，避免 "cancer" 抢先匹配 "skin cancer"
+            keys = sorted(self.terms[direction], key=len, reverse=True)
+            if not keys:
+                return None
+            escaped = '|'.join(re.escape(k) for k in keys)
+            if direction == 'en_to_zh':
+                pattern = re.compile(r'\b(?:' + escaped + r')\b', re.IGNORECASE)
+            else:
+                pattern = re.compile(escaped)
+            self._term_patterns[direction] = pattern
+        return pattern
+
+    def partial_translate(self, text: str, direction: str) -> str:
+        """术语替换（可能中英混杂，仅作兜底）"""
+        phrase = self.phrases[direction].get(self._normalize(text))
+        if phrase:
+            return phrase
+        pattern = self._term_pattern(direction)
+        if pattern is None:
+            return text
+        table = self.terms[direction]
+        if direction == 'en_to_zh':
+            return pattern.sub(lambda m: table[m.group().lower()], text)
+        return pattern.sub(lambda m: ' ' + table[m.group()] + ' ', text).replace('  ', ' ').strip()
+
+    def lookup_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        """只查短语表，未命中为None"""
+        table = self.phrases[direction]
+        return [table.get(self._normalize(text)) for text in texts]
+
+    def translate_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        return [result if result is not None else FallbackText(self.partial_translate(text, direction))
+                for text, result in zip(texts, self.lookup_batch(texts, direction))]
+
+
+class RemoteBackend(TranslationBackend):
+    """远程后端：translate库（每个方向一个Translator实例）"""
+
+    name = 'remote'
+
+    def __init__(self):
+        self.translators = {}
+
+    def _translator(self, direction: str):
+        translator = self.translators.get(direction)
+        if translator is None:
+            from translate import Translator
+            if direction == 'en_to_zh':
+                translator = Translator(to_lang="zh", from_lang="en")
+            else:
+                translator = Translator(to_lang="en", from_lang="zh")
+            self.translators[direction] = translator
+        return translator
+
+    def translate_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        """一次调用翻译多句（按行合并），行数对不上时逐句翻译"""
+        translator = self._translator(direction)
+        try:
+            merged = translator.translate('\n'.join(texts))
+            lines = [line.strip() for line in merged.split('\n')]
+            if len(lines) == len(texts):
+                return lines
+        except Exception as e:
+            print(f"批量翻译失败 ({direction}): {e}")
+            return [None] * len(texts)
+
+        results = []
+        for text in texts:
+            try:
+                results.append(translator.translate(text))
+            except Exception as e:
+                print(f"翻译失败 ({direction}): {e}")
+                results.append(None)
+        return results
+
+
+class StubBackend(TranslationBackend):
+    """确定性桩后端（压测用）：固定延迟，输出 "[方向] 原文" """
+
+    name = 'stub'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def translate_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return [f"[{direction}] {text}" for text in texts]
+
+
+class TieredBackend(TranslationBackend):
+    """
+    分级策略：本地优先，远程只在延迟预算内使用
+
+    本地短语表未命中的句子交给远程后端，等待不超过 latency_budget 秒；
+    远程超时后进入冷却期（cooldown 秒内不再调用远程），
+    超时或失败的句子用本地术语替换兜底（FallbackText，不写入翻译记忆）。
+    """
+
+    name = 'tiered'
+
+    def __init__(self, local: LocalBackend, remote: TranslationBackend,
+                 latency_budget: float = 3.0, cooldown: float = 30.0):
+        self.local = local
+        self.remote = remote
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+        self.remote_disabled_until = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='remote-translate')
+        self.stats = {'local_hits': 0, 'remote_ok': 0, 'remote_timeouts': 0, 'fallbacks': 0}
+
+    def reset_after_fork(self):
+        """fork出的子进程中线程池已失效，重新创建"""
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='remote-translate')
+
+    def translate_batch(self, texts: List[str], direction: str) -> List[Optional[str]]:
+        results = self.local.lookup_batch(texts, direction)
+        missing = [i for i, result in enumerate(results) if result is None]
+        self.stats['local_hits'] += len(texts) - len(missing)
+        if not missing:
+            return results
+
+        remote_results = [None] * len(missing)
+        if time.time() >= self.remote_disabled_until:
+            future = self.executor.submit(self.remote.translate_batch, [texts[i] for i in missing], direction)
+            try:
+                remote_results = future.result(timeout=self.latency_budget)
+                self.stats['remote_ok'] += 1
+            except FutureTimeoutError:
+                self.stats['remote_timeouts'] += 1
+                self.remote_disabled_until = time.time() + self.cooldown
+                print(f"远程翻译超出预算 {self.latency_budget}s，{self.cooldown}s 内使用本地翻译")
+            except Exception as e:
+                print(f"远程翻译失败 ({direction}): {e}")
+
+        for i, remote_result in zip(missing, remote_results):
+            if remote_result is None:
+                self.stats['fallbacks'] += 1
+                results[i] = FallbackText(self.local.partial_translate(texts[i], direction))
+            else:
+                results[i] = remote_result
+        return results
+
+
+def create_translation_backend(name: str, terms_path: Optional[str] = None,
+                               latency_budget: float = 3.0, stub_latency: float = 0.0) -> TranslationBackend:
+    """按名称创建翻译后端：local / remote / tiered / stub"""
+    if name == 'stub':
+        return StubBackend(stub_latency)
+    if name == 'remote':
+        return RemoteBackend()
+    local = LocalBackend(terms_path)
+    if name == 'local':
+        return local
+    if name == 'tiered':
+        return TieredBackend(local, RemoteBackend(), latency_budget)
+    raise ValueError(f"未知的翻译后端: {name}")